@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Ansible dynamic inventory of a federation, read from the database of the service.
+
+    FL_SERVICE_FL_IDENTIFIER=<fl_identifier> ansible-playbook -i db_inventory.py ...
+
+Uses the same database as the service, see FL_SERVICE_DATABASE_URL. Its default
+SQLite file doesn't depend on the current directory.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+if __name__ == "__main__" and __package__ in (None, ""):
+    # executed by ansible as a script, make the app package importable
+    sys.path.insert(
+        0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+    )
+
+from fastapi import HTTPException
+
+from app.ansible.inventory.dynamic_inventory import (
+    get_flower_inventory_from_database,
+    to_inventory_script_output,
+)
+from app.internal.sql.database import SesssionLocal
+
+FL_IDENTIFIER_ENV = "FL_SERVICE_FL_IDENTIFIER"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Flower federation inventory")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--list", action="store_true", help="list the inventory")
+    group.add_argument("--host", help="variables of a single host")
+    args = parser.parse_args()
+
+    fl_identifier = os.environ.get(FL_IDENTIFIER_ENV)
+    if not fl_identifier:
+        print(f"{FL_IDENTIFIER_ENV} must be set", file=sys.stderr)
+        return 1
+
+    db = SesssionLocal()
+    try:
+        output = to_inventory_script_output(
+            get_flower_inventory_from_database(db=db, fl_identifier=fl_identifier)
+        )
+    except HTTPException as e:
+        print(e.detail, file=sys.stderr)
+        return 1
+    finally:
+        db.close()
+
+    if args.list:
+        json.dump(output, sys.stdout)
+    else:
+        json.dump(output["_meta"]["hostvars"].get(args.host, {}), sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
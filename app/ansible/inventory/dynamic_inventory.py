@@ -1,13 +1,18 @@
+import copy
 import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
 
 from fastapi import Depends, HTTPException
 from sqlalchemy.orm import Session
 
-from ...internal.sql import crud
+from ...definitions import ANSIBLE_SSH_CONTROL_PERSIST
+from ...internal.sql import crud, models
+from ...internal.sql.cache import inventory_cache
 from ...internal.sql.crud import get_remote_host_by_ip_address
 from ...internal.utils.ansible import ansible_export_to_yaml, ansible_read_yaml
 from ...internal.utils.enum import FlowerType
-from ...internal.utils.file import create_file
 from ...routers.database import get_db
 
 FLOWER_SERVER_GROUP = "flower_server"
@@ -25,6 +30,171 @@ FLOWER_INVENTORY_DICT = {
     }
 }
 
+# Lets consecutive playbook runs reuse the multiplexed SSH connection of a host
+# instead of doing a handshake for every run.
+FLOWER_INVENTORY_SSH_VARS = {
+    "ansible_ssh_common_args": f"-o ControlMaster=auto -o ControlPersist={ANSIBLE_SSH_CONTROL_PERSIST}",
+}
+
+
+def get_flower_inventory_file(inventory_dirname: str) -> str:
+    """
+    Return the path of the inventory file of the federation.
+    """
+
+    # federated learning distinct directory
+    yaml_dir = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), inventory_dirname
+    )
+
+    # federated learning inventory file
+    return os.path.join(yaml_dir, f"{inventory_dirname}.yaml")
+
+
+def get_flower_inventory_group(flower_type: FlowerType) -> str:
+    if flower_type == FlowerType.client:
+        return FLOWER_CLIENTS_GROUP
+    return FLOWER_SERVER_GROUP
+
+
+class FlowerInventory:
+    """
+    Parsed inventory of a single federation, kept in memory between writes.
+
+    Mutations are serialized by a per federation lock and made inside `batch`, which
+    writes the inventory file once at its end, atomically. The file is parsed again
+    only if it has been changed by someone else since it was last read or written.
+    """
+
+    def __init__(self, inventory_dirname: str):
+        self.inventory_dirname = inventory_dirname
+        self.yaml_file = get_flower_inventory_file(inventory_dirname)
+        self.lock = threading.RLock()
+
+        self._content: dict | None = None
+        # group of every host pattern, to check for duplicates without a scan
+        self._groups: dict[str, str] = {}
+        self._mtime_ns: int | None = None
+        self._dirty = False
+
+    def _stat_mtime_ns(self) -> int | None:
+        try:
+            return os.stat(self.yaml_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self) -> dict:
+        mtime_ns = self._stat_mtime_ns()
+        if self._content != None and mtime_ns == self._mtime_ns:
+            return self._content
+
+        if mtime_ns == None:
+            content = copy.deepcopy(FLOWER_INVENTORY_DICT)
+            self._dirty = True
+        else:
+            # read the content of the file as a dict then modify rewrite again.
+            content = ansible_read_yaml(self.yaml_file)
+            if content == {}:
+                err = f"Failed to read inventory file {self.yaml_file}, check out the logs for more details"
+                raise HTTPException(status_code=500, detail=err)
+
+        self._content = content
+        self._mtime_ns = mtime_ns
+        self._groups = {
+            host_pattern: group
+            for group in (FLOWER_SERVER_GROUP, FLOWER_CLIENTS_GROUP)
+            for host_pattern in (content["all"]["children"][group]["hosts"] or {})
+        }
+        return content
+
+    def _flush(self) -> None:
+        if not self._dirty or self._content == None:
+            return
+
+        # inventories written before the SSH settings existed get them on their next write
+        self._content["all"].setdefault("vars", {}).update(FLOWER_INVENTORY_SSH_VARS)
+        os.makedirs(os.path.dirname(self.yaml_file), exist_ok=True)
+        if not ansible_export_to_yaml(self._content, self.yaml_file):
+            err = f"Failed to write inventory file {self.yaml_file}, check out the logs for more details"
+            raise HTTPException(status_code=500, detail=err)
+        self._mtime_ns = self._stat_mtime_ns()
+        self._dirty = False
+
+    @contextmanager
+    def batch(self) -> Iterator["FlowerInventory"]:
+        """
+        Hold the inventory lock for many mutations and write them with a single flush.
+
+        If the block or the write raises, its mutations are discarded.
+        """
+
+        with self.lock:
+            self._load()
+            try:
+                yield self
+                self._flush()
+            except BaseException:
+                # parsed again from the file on the next use
+                self._content = None
+                self._dirty = False
+                raise
+
+    def host_patterns(self) -> set[str]:
+        with self.lock:
+            if self._content == None and self._stat_mtime_ns() == None:
+                return set()
+            self._load()
+            return set(self._groups)
+
+    def add_host(
+        self,
+        host_pattern: str,
+        ansible_host: str,
+        ansible_user: str,
+        ansible_become_password: str,
+        flower_type: FlowerType,
+    ) -> None:
+        """
+        Add a host to the inventory, raises 409 if its host pattern is taken.
+
+        Must be called within `batch`.
+        """
+
+        content = self._load()
+        group = get_flower_inventory_group(flower_type)
+        # host names are global to the inventory, whatever their group
+        if host_pattern in self._groups:
+            err = f"Flower {FlowerType(flower_type).value} host {ansible_host} already exists in the inventory {self.yaml_file}"
+            raise HTTPException(status_code=409, detail=err)
+
+        if content["all"]["children"][group]["hosts"] == None:
+            content["all"]["children"][group]["hosts"] = {}
+        content["all"]["children"][group]["hosts"][host_pattern] = {
+            "ansible_host": ansible_host,
+            "ansible_user": ansible_user,
+            "ansible_become_password": ansible_become_password,
+        }
+        self._groups[host_pattern] = group
+        self._dirty = True
+
+
+_inventories: dict[str, FlowerInventory] = {}
+_inventories_lock = threading.Lock()
+
+
+def get_flower_inventory(inventory_dirname: str) -> FlowerInventory:
+    """
+    Return the in-memory inventory of the federation.
+    """
+
+    yaml_file = get_flower_inventory_file(inventory_dirname)
+    with _inventories_lock:
+        inventory = _inventories.get(inventory_dirname)
+        if inventory == None or inventory.yaml_file != yaml_file:
+            inventory = FlowerInventory(inventory_dirname)
+            _inventories[inventory_dirname] = inventory
+        return inventory
+
 
 def add_new_host_to_flower_inventory(
     inventory_dirname: str,
@@ -52,28 +222,6 @@ def add_new_host_to_flower_inventory(
         err = f"Host {ansible_host} not found in the database, it must be added first"
         raise HTTPException(status_code=404, detail=err)
 
-    # federated learning distinct directory
-    yaml_dir = os.path.join(
-        os.path.dirname(os.path.abspath(__file__)), inventory_dirname
-    )
-
-    # federated learning inventory file
-    yaml_file = os.path.join(yaml_dir, f"{inventory_dirname}.yaml")
-
-    if os.path.exists(yaml_file) == False:
-        if create_file(yaml_file) == False:
-            err = f"Failed to create inventory file {yaml_file}"
-            raise HTTPException(status_code=500, detail=err)
-        if not ansible_export_to_yaml(dict(FLOWER_INVENTORY_DICT), yaml_file):
-            err = f"Failed to write inventory file {yaml_file}, check out the logs for more details"
-            raise HTTPException(status_code=500, detail=err)
-
-    # read the content of the file as a dict then modify rewrite again.
-    content = ansible_read_yaml(yaml_file)
-    if content == {}:
-        err = f"Failed to read inventory file {yaml_file}, check out the logs for more details"
-        raise HTTPException(status_code=500, detail=err)
-
     if host_pattern == None:
         host_pattern = f"host_{host.id}"
 
@@ -82,33 +230,98 @@ def add_new_host_to_flower_inventory(
         db=db, ip_address=ansible_host, host_pattern=host_pattern
     )
 
-    if flower_type == FlowerType.client:
-        if (
-            host_pattern
-            in content["all"]["children"][FLOWER_CLIENTS_GROUP]["hosts"].keys()
-        ):
-            err = f"Flower client host {ansible_host} already exists in the inventory {yaml_file}"
-            raise HTTPException(status_code=409, detail=err)
+    with get_flower_inventory(inventory_dirname).batch() as inventory:
+        inventory.add_host(
+            host_pattern=host_pattern,
+            ansible_host=ansible_host,
+            ansible_user=ansible_user,
+            ansible_become_password=str(host.ssh_password),
+            flower_type=flower_type,
+        )
 
-        content["all"]["children"][FLOWER_CLIENTS_GROUP]["hosts"][host_pattern] = {
-            "ansible_host": ansible_host,
-            "ansible_user": ansible_user,
-            "ansible_become_password": host.ssh_password,
-        }
-    else:
-        if (
-            host_pattern
-            in content["all"]["children"][FLOWER_SERVER_GROUP]["hosts"].keys()
-        ):
-            err = f"Flower server host {ansible_host} already exists in the inventory {yaml_file}"
-            raise HTTPException(status_code=409, detail=err)
 
-        content["all"]["children"][FLOWER_SERVER_GROUP]["hosts"][host_pattern] = {
-            "ansible_host": ansible_host,
-            "ansible_user": ansible_user,
+def add_hosts_to_flower_inventory(
+    inventory_dirname: str, hosts: list[models.RemoteHost]
+) -> None:
+    """
+    Add many registered hosts to flower inventory file with a single write.
+
+    The hosts must have their host patterns set already. If one of them can't be added,
+    none of them is.
+    :param inventory_dirname: the name of the inventory directory
+    :param hosts: the registered remote hosts of the federation
+    """
+
+    with get_flower_inventory(inventory_dirname).batch() as inventory:
+        for host in hosts:
+            inventory.add_host(
+                host_pattern=str(host.host_pattern),
+                ansible_host=str(host.ip_address),
+                ansible_user=str(host.ssh_username),
+                ansible_become_password=str(host.ssh_password),
+                flower_type=FlowerType(host.flower_type),
+            )
+
+
+def get_flower_inventory_host_patterns(inventory_dirname: str) -> set[str]:
+    """
+    Return the host patterns already taken in the inventory of the federation.
+    """
+
+    return get_flower_inventory(inventory_dirname).host_patterns()
+
+
+def build_flower_inventory(hosts: list[models.RemoteHost]) -> dict:
+    """
+    Build the inventory of the given registered hosts of a federation.
+    """
+
+    content = copy.deepcopy(FLOWER_INVENTORY_DICT)
+    content["all"]["vars"].update(FLOWER_INVENTORY_SSH_VARS)
+    for host in hosts:
+        group = get_flower_inventory_group(FlowerType(host.flower_type))
+        content["all"]["children"][group]["hosts"][str(host.host_pattern)] = {
+            "ansible_host": str(host.ip_address),
+            "ansible_user": str(host.ssh_username),
             "ansible_become_password": host.ssh_password,
         }
+    return content
+
 
-    if not ansible_export_to_yaml(content, yaml_file):
-        err = f"Failed to write inventory file {yaml_file}, check out the logs for more details"
-        raise HTTPException(status_code=500, detail=err)
+def get_flower_inventory_from_database(db: Session, fl_identifier: str) -> dict:
+    """
+    Return the inventory of the federation built from the database.
+
+    It can be given to ansible-runner as is, instead of the inventory file. The result
+    is cached until the hosts of the federation change and must not be mutated.
+    """
+
+    def build() -> dict:
+        hosts = crud.get_remote_hosts_by_fl_identifier(
+            db=db, fl_identifier=fl_identifier
+        )
+        if len(hosts) == 0:
+            err = f"No hosts found with FL identifier {fl_identifier}"
+            raise HTTPException(status_code=404, detail=err)
+        return build_flower_inventory(hosts)
+
+    return inventory_cache.get(fl_identifier, build)
+
+
+def to_inventory_script_output(content: dict) -> dict:
+    """
+    Convert an inventory to the JSON of a dynamic inventory script's --list.
+
+    Host variables are given under _meta.hostvars, so ansible doesn't call --host.
+    """
+
+    output: dict = {
+        "_meta": {"hostvars": {}},
+        "all": {"children": [], "vars": dict(content["all"].get("vars") or {})},
+    }
+    for group, group_content in content["all"]["children"].items():
+        hosts = group_content.get("hosts") or {}
+        output["all"]["children"].append(group)
+        output[group] = {"hosts": list(hosts.keys())}
+        output["_meta"]["hostvars"].update(hosts)
+    return output
@@ -1,6 +1,16 @@
+from datetime import datetime
+
 from pydantic import BaseModel
 
-from .utils.enum import FlowerType, OsType, StatusType
+from .utils.enum import (
+    BuildStatus,
+    FlowerType,
+    InstallationStatus,
+    JobStatus,
+    OsType,
+    StatusType,
+    UploadStatus,
+)
 
 
 class Status(BaseModel):
@@ -22,6 +32,28 @@ class RemoteHostBase(BaseModel):
     description: str | None = None
 
 
+class HostTargets(BaseModel):
+    """
+    Pydantic Model: Hosts targeted by a single ansible run, either a whole federation or a list of IP addresses.
+    """
+
+    fl_identifier: str | None = None
+    ip_addresses: list[str] | None = None
+    forks: int | None = None
+
+
+class PingResult(BaseModel):
+    """
+    Pydantic Model: Reachability of a single host.
+    """
+
+    ip_address: str
+    fl_identifier: str
+    reachable: bool
+    latency: float | None = None
+    description: str | None = None
+
+
 class RemoteHostCreate(RemoteHostBase):
     """
     Pydantic Model: Remote host to connect to.
@@ -40,6 +72,35 @@ class RemoteHostCreate(RemoteHostBase):
     host_pattern: str | None
 
 
+class RemoteHostRegistration(BaseModel):
+    """
+    Pydantic Model: Registration result of a single host of a bulk registration.
+    """
+
+    ip_address: str
+    status: StatusType
+    host_pattern: str | None = None
+    description: str | None = None
+
+
+class SSHKeyRotation(BaseModel):
+    """
+    Pydantic Model: SSH key rotation, optionally revoking a previously installed key.
+    """
+
+    revoked_public_key: str | None = None
+
+
+class SSHKeyRotationResult(BaseModel):
+    """
+    Pydantic Model: SSH key rotation result of a single host.
+    """
+
+    ip_address: str
+    status: StatusType
+    description: str | None = None
+
+
 class RemoteHost(RemoteHostBase):
     """
     Pydantic Model: Remote host to connect to.
@@ -51,6 +112,41 @@ class RemoteHost(RemoteHostBase):
         orm_mode = True
 
 
+class CachedRemoteHost(BaseModel):
+    """
+    Pydantic Model: Read-only copy of a remote host kept by the lookup cache, without its SSH credentials.
+    """
+
+    id: int
+    flower_type: str | None = None
+    ip_address: str
+    ssh_username: str | None = None
+    os_type: str | None = None
+    ssh_port: int | None = None
+    description: str | None = None
+    contact_info: str | None = None
+    fl_identifier: str | None = None
+    host_pattern: str | None = None
+
+    class Config:
+        orm_mode = True
+        allow_mutation = False
+
+
+class HostCacheStats(BaseModel):
+    """
+    Pydantic Model: Counters of the remote host lookup cache.
+    """
+
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    size: int
+    max_entries: int
+    ttl_seconds: float
+
+
 class RemoteHostDockerState(BaseModel):
     host_id: str
     state_install_aptitude: str
@@ -63,3 +159,101 @@ class RemoteHostDockerState(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class RemoteHostTaskState(BaseModel):
+    """
+    Pydantic Model: Completion state of a playbook task on a remote host.
+    """
+
+    ip_address: str
+    fl_identifier: str
+    playbook: str
+    task: str
+    status: InstallationStatus
+    updated_at: datetime | None = None
+
+
+class AnsibleJob(BaseModel):
+    """
+    Pydantic Model: Asynchronous ansible-runner job.
+    """
+
+    id: str
+    playbook: str
+    fl_identifier: str
+    host_limit: str | None = None
+    status: JobStatus
+    rc: int | None = None
+    description: str | None = None
+
+    created_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+
+    class Config:
+        orm_mode = True
+
+
+class JobHostOutcome(BaseModel):
+    """
+    Pydantic Model: Task results of a single host in an ansible job.
+    """
+
+    host_pattern: str
+    ip_address: str | None = None
+    status: InstallationStatus
+    ok: int = 0
+    changed: int = 0
+    failed: int = 0
+    unreachable: int = 0
+    skipped: int = 0
+
+
+class FleetDeployment(BaseModel):
+    """
+    Pydantic Model: Rolling deployment of a federation, its server first and then its clients.
+
+    serial: Clients deployed per batch, either a number or a percentage such as "25%".
+    max_fail_percentage: Stop before the next batch once more clients than this have failed.
+    """
+
+    serial: int | str | None = None
+    max_fail_percentage: int | None = None
+    forks: int | None = None
+
+
+class UploadProgress(BaseModel):
+    """
+    Pydantic Model: Progress of a source bundle upload.
+    """
+
+    upload_id: str
+    filename: str | None = None
+    status: UploadStatus
+    received_bytes: int = 0
+    total_bytes: int | None = None
+    bytes_per_second: float | None = None
+    description: str | None = None
+
+
+class DockerImageBuild(BaseModel):
+    """
+    Pydantic Model: Docker image built from an uploaded source bundle.
+    """
+
+    id: int
+    bundle_hash: str
+    platform: str
+    arch: str
+    image_name: str
+    status: BuildStatus
+    rc: int | None = None
+    description: str | None = None
+
+    created_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+
+    class Config:
+        orm_mode = True
@@ -0,0 +1,147 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Iterable
+
+from ...definitions import HOST_CACHE_MAX_ENTRIES, HOST_CACHE_TTL_SECONDS
+
+
+class FederationCache:
+    """
+    Cache of values derived from the database, one per FL identifier.
+
+    The crud functions which change remote hosts invalidate it. A value built while an
+    invalidation happens is returned but not stored, so it can't outlive the change.
+    Cached values are shared and must not be mutated.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[str, Any] = {}
+        self._generation = 0
+
+    def get(self, fl_identifier: str, build: Callable[[], Any]) -> Any:
+        with self._lock:
+            if fl_identifier in self._entries:
+                return self._entries[fl_identifier]
+            generation = self._generation
+
+        value = build()
+        with self._lock:
+            if generation == self._generation:
+                self._entries[fl_identifier] = value
+        return value
+
+    def invalidate(self, fl_identifier: str | None = None) -> None:
+        """
+        Drop the value of the FL identifier, or every value if it is not given.
+        """
+
+        with self._lock:
+            self._generation += 1
+            if fl_identifier == None:
+                self._entries.clear()
+            else:
+                self._entries.pop(fl_identifier, None)
+
+
+# ansible inventories built from the remote hosts of each federation
+inventory_cache = FederationCache()
+
+
+class HostLookupCache:
+    """
+    Cache of remote host lookups with a time to live, least recently used entries are
+    evicted beyond the maximum number of entries.
+
+    Entries are keyed by the kind of the lookup and its key, e.g. an IP address. The
+    crud functions which change remote hosts invalidate them, the time to live bounds
+    how long changes made by other processes go unnoticed. Cached values are shared
+    and must not be mutated.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[str, str], tuple[float, Any]] = OrderedDict()
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, kind: str, key: str, build: Callable[[], Any]) -> Any:
+        """
+        Return the cached value of the lookup, or build and cache it.
+
+        None values are not cached, so a host registered by another process is found
+        right away.
+        """
+
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry != None and entry[0] > time.monotonic():
+                self._entries.move_to_end((kind, key))
+                self.hits += 1
+                return entry[1]
+            if entry != None:
+                del self._entries[(kind, key)]
+                self.expirations += 1
+            self.misses += 1
+            generation = self._generation
+
+        value = build()
+        if value == None:
+            return value
+
+        with self._lock:
+            # an invalidation while building may have made the value stale already
+            if generation == self._generation and self.ttl_seconds > 0:
+                self._entries[(kind, key)] = (
+                    time.monotonic() + self.ttl_seconds,
+                    value,
+                )
+                self._entries.move_to_end((kind, key))
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, kind: str | None = None, keys: Iterable[str] = ()) -> None:
+        """
+        Drop the entries of the given kind and keys, every entry of the kind if no key
+        is given, or every entry if the kind isn't given either.
+        """
+
+        keys = set(keys)
+        with self._lock:
+            self._generation += 1
+            if kind == None:
+                self._entries.clear()
+                return
+            for entry_key in list(self._entries):
+                if entry_key[0] == kind and (not keys or entry_key[1] in keys):
+                    del self._entries[entry_key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+
+# remote hosts looked up by their ip address and by their FL identifier
+host_cache = HostLookupCache(
+    ttl_seconds=HOST_CACHE_TTL_SECONDS, max_entries=HOST_CACHE_MAX_ENTRIES
+)
+# kinds of the host lookups
+HOST_BY_IP_ADDRESS = "ip_address"
+HOSTS_BY_FL_IDENTIFIER = "fl_identifier"
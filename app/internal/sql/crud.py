@@ -1,14 +1,45 @@
+from datetime import datetime, timezone
+from typing import Callable
+
 from fastapi import HTTPException, status
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm import Session
 
 from .. import schema
-from ..utils.enum import DOCKER_INSTALLATION_NAME
+from ..utils.enum import (
+    DOCKER_INSTALLATION_NAME,
+    DOCKER_INSTALLATION_PLAYBOOK,
+    BuildStatus,
+    JobStatus,
+)
 from . import models
+from .cache import (
+    HOST_BY_IP_ADDRESS,
+    HOSTS_BY_FL_IDENTIFIER,
+    host_cache,
+    inventory_cache,
+)
 
 # NOTE:
 # - All crud functions should throw appropriate HTTPException instead of SQLAlchemyError when an error occurs.
 
+# SQLSTATE of unique violations, reported by PostgreSQL compatible drivers
+UNIQUE_VIOLATION_SQLSTATE = "23505"
+
+
+def is_unique_violation(e: IntegrityError) -> bool:
+    """
+    Return whether the integrity error is caused by a unique constraint, on any backend.
+    """
+
+    orig = e.orig
+    sqlstate = getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)
+    if sqlstate != None:
+        return sqlstate == UNIQUE_VIOLATION_SQLSTATE
+    # sqlite3 only reports it in the message
+    return "UNIQUE constraint failed" in str(orig)
+
+
 # def from_task_enum_to_model_column(name: str) -> Column | None:
 #     match name:
 #         case DOCKER_INSTALLATION_NAME.state_install_aptitude:
@@ -35,7 +66,6 @@ def get_remote_host_docker_state(db: Session, ip_address: str) -> dict:
     try:
         remote_host = (
             db.query(models.RemoteHost)
-            .options(joinedload(models.RemoteHost.docker_state))
             .filter(
                 models.RemoteHost.ip_address == ip_address,
             )
@@ -45,27 +75,18 @@ def get_remote_host_docker_state(db: Session, ip_address: str) -> dict:
             err = f"Remote host with ip address {ip_address} not found"
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
-        docker_state_id = remote_host.docker_state.id
-
-        result = (
-            db.query(models.RemoteHostDockerState)
-            .filter(models.RemoteHostDockerState.id == docker_state_id)
-            .first()
+        task_states = (
+            db.query(models.RemoteHostTaskState.task, models.RemoteHostTaskState.status)
+            .filter(
+                models.RemoteHostTaskState.host_id == remote_host.id,
+                models.RemoteHostTaskState.playbook == DOCKER_INSTALLATION_PLAYBOOK,
+            )
+            .all()
         )
 
-        if result == None:
-            err = f"Remote host docker state with id {docker_state_id} not found"
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
-
-        return {
-            DOCKER_INSTALLATION_NAME.state_install_aptitude: result.state_install_aptitude,
-            DOCKER_INSTALLATION_NAME.state_install_required_system_packages: result.state_install_required_system_packages,
-            DOCKER_INSTALLATION_NAME.state_add_docker_gpg_apt_key: result.state_add_docker_gpg_apt_key,
-            DOCKER_INSTALLATION_NAME.state_add_docker_repository: result.state_add_docker_repository,
-            DOCKER_INSTALLATION_NAME.state_update_apt_and_install_docker_ce: result.state_update_apt_and_install_docker_ce,
-            DOCKER_INSTALLATION_NAME.state_install_docker_module_for_python: result.state_install_docker_module_for_python,
-            DOCKER_INSTALLATION_NAME.state_check_docker_command: result.state_check_docker_command,
-        }
+        result = {task: "" for task in DOCKER_INSTALLATION_NAME}
+        result.update({DOCKER_INSTALLATION_NAME(t): v for t, v in task_states})
+        return result
 
     except SQLAlchemyError as e:
         err = f"SQLAlchemy error occurred while getting remote host docker state: {e}"
@@ -97,15 +118,42 @@ def get_remote_hosts_by_contact_info(
 
 
 def get_remote_hosts(
-    db: Session, skip: int = 0, limit: int = 100
+    db: Session,
+    after: int | None = None,
+    limit: int = 100,
+    fl_identifier: str | None = None,
+    flower_type: str | None = None,
+    contact_info: str | None = None,
+    docker_state: str | None = None,
 ) -> list[models.RemoteHost]:
     """
-    Returns a list of remote hosts.
+    Returns a page of remote hosts ordered by id, optionally filtered.
+
+    Pages are addressed by the id of the last host of the previous page instead of an
+    offset, so every page costs the same regardless of how deep it is.
+
+    :param after: return only hosts with a greater id than this one
+    :param docker_state: state of the final docker installation task, the docker command check
     """
-    # TODO: Add sorting logic so that the returned list is sorted in a predictable order
 
     try:
-        return db.query(models.RemoteHost).offset(skip).limit(limit).all()
+        query = db.query(models.RemoteHost)
+        if fl_identifier != None:
+            query = query.filter(models.RemoteHost.fl_identifier == fl_identifier)
+        if flower_type != None:
+            query = query.filter(models.RemoteHost.flower_type == flower_type)
+        if contact_info != None:
+            query = query.filter(models.RemoteHost.contact_info == contact_info)
+        if docker_state != None:
+            query = query.join(models.RemoteHost.task_states).filter(
+                models.RemoteHostTaskState.playbook == DOCKER_INSTALLATION_PLAYBOOK,
+                models.RemoteHostTaskState.task
+                == DOCKER_INSTALLATION_NAME.state_check_docker_command,
+                models.RemoteHostTaskState.status == docker_state,
+            )
+        if after != None:
+            query = query.filter(models.RemoteHost.id > after)
+        return query.order_by(models.RemoteHost.id).limit(limit).all()
     except SQLAlchemyError as e:
         err = f"SQLAlchemy error occurred while getting remote hosts: {e}"
         raise HTTPException(
@@ -131,40 +179,206 @@ def get_remote_host_by_ip_address(db: Session, ip_address: str) -> models.Remote
         )
 
 
-def update_remote_host_docker_state_by_ip_address(
-    db: Session, ip_address: str, updated_docker_state: dict
-) -> None:
+def get_cached_remote_host_by_ip_address(
+    db: Session, ip_address: str
+) -> schema.CachedRemoteHost | None:
+    """
+    Returns a read-only copy of the remote host with the given ip address.
+
+    Lookups are cached, see host_cache. The copy leaves out the SSH credentials, use
+    `get_remote_host_by_ip_address` for them or to change the host.
+    """
+
+    def lookup() -> schema.CachedRemoteHost | None:
+        host = get_remote_host_by_ip_address(db=db, ip_address=ip_address)
+        return None if host == None else schema.CachedRemoteHost.from_orm(host)
+
+    return host_cache.get(HOST_BY_IP_ADDRESS, ip_address, lookup)
+
+
+def get_remote_hosts_by_ip_addresses(
+    db: Session, ip_addresses: list[str]
+) -> list[models.RemoteHost]:
+    """
+    Returns a list of remote hosts whose ip address is one of the given ones.
+    """
+
     try:
-        remote_host = (
+        return (
             db.query(models.RemoteHost)
-            .options(joinedload(models.RemoteHost.docker_state))
-            .filter(
-                models.RemoteHost.ip_address == ip_address,
-            )
-            .first()
+            .filter(models.RemoteHost.ip_address.in_(ip_addresses))
+            .all()
+        )
+    except SQLAlchemyError as e:
+        err = (
+            f"SQLAlchemy error occurred while getting remote hosts by ip addresses: {e}"
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
         )
-        if remote_host == None:
-            err = f"Remote host with ip address {ip_address} not found"
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
-        docker_state_id = remote_host.docker_state.id
 
-        db.query(models.RemoteHostDockerState).filter(
-            models.RemoteHostDockerState.id == docker_state_id
-        ).update(updated_docker_state)
-        db.commit()
+def get_remote_host_ids(db: Session, ip_addresses: list[str]) -> dict[str, int]:
+    """
+    Returns the ids of the given remote hosts, keyed by ip address.
 
+    Hosts which aren't registered are left out.
+    """
+
+    try:
+        rows = (
+            db.query(models.RemoteHost.ip_address, models.RemoteHost.id)
+            .filter(models.RemoteHost.ip_address.in_(ip_addresses))
+            .all()
+        )
     except SQLAlchemyError as e:
+        err = f"SQLAlchemy error occurred while getting remote host ids: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+    return {ip_address: host_id for ip_address, host_id in rows}
+
+
+def update_remote_host_task_states(
+    db: Session,
+    playbook: str,
+    updated_task_states: dict[int, dict[str, str]],
+    retry: bool = True,
+) -> None:
+    """
+    Updates the task states of many remote hosts, keyed by host id, in a single transaction.
+
+    States of tasks which have not been stored for the host before are inserted.
+    """
+
+    updated_at = datetime.now(timezone.utc)
+    try:
+        task_states = {
+            (task_state.host_id, task_state.task): task_state
+            for task_state in db.query(models.RemoteHostTaskState).filter(
+                models.RemoteHostTaskState.playbook == playbook,
+                models.RemoteHostTaskState.host_id.in_(updated_task_states.keys()),
+            )
+        }
+        for host_id, tasks in updated_task_states.items():
+            for task, task_status in tasks.items():
+                task_state = task_states.get((host_id, task))
+                if task_state == None:
+                    db.add(
+                        models.RemoteHostTaskState(
+                            host_id=host_id,
+                            playbook=playbook,
+                            task=task,
+                            status=task_status,
+                            updated_at=updated_at,
+                        )
+                    )
+                else:
+                    task_state.status = task_status
+                    task_state.updated_at = updated_at
+        db.commit()
+    except IntegrityError as e:
         db.rollback()
-        err = f"SQLAlchemy error occurred while updating docker state by host pattern: {e}"
+        # a concurrent run has inserted the same task state in the meantime
+        if retry and is_unique_violation(e):
+            update_remote_host_task_states(
+                db=db,
+                playbook=playbook,
+                updated_task_states=updated_task_states,
+                retry=False,
+            )
+            return
+        err = f"IntegrityError occurred while updating task states: {e}"
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
         )
-    except AttributeError as e:
+    except SQLAlchemyError as e:
         db.rollback()
-        err = (
-            f"Attribute error occurred while updating docker state by host pattern: {e}"
+        err = f"SQLAlchemy error occurred while updating task states: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def get_remote_host_task_states(
+    db: Session, playbook: str, task: str, task_status: str | None = None
+) -> list[tuple[models.RemoteHostTaskState, models.RemoteHost]]:
+    """
+    Returns the states of the given task, with their remote hosts, optionally only the
+    ones in the given state.
+    """
+
+    try:
+        query = (
+            db.query(models.RemoteHostTaskState, models.RemoteHost)
+            .join(models.RemoteHostTaskState.remote_host)
+            .filter(
+                models.RemoteHostTaskState.playbook == playbook,
+                models.RemoteHostTaskState.task == task,
+            )
         )
+        if task_status != None:
+            query = query.filter(models.RemoteHostTaskState.status == task_status)
+        return [
+            (task_state, remote_host)
+            for task_state, remote_host in query.order_by(
+                models.RemoteHostTaskState.host_id
+            )
+        ]
+    except SQLAlchemyError as e:
+        err = f"SQLAlchemy error occurred while getting task states: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def migrate_remote_host_docker_states(db: Session) -> int:
+    """
+    Moves the docker states of the legacy column per task layout into task state rows.
+
+    Task states already stored in the new layout are kept. Returns the number of
+    migrated legacy rows.
+    """
+
+    try:
+        legacy_states = db.query(models.RemoteHostDockerState).all()
+        if len(legacy_states) == 0:
+            return 0
+
+        stored = set(
+            db.query(
+                models.RemoteHostTaskState.host_id, models.RemoteHostTaskState.task
+            ).filter(
+                models.RemoteHostTaskState.playbook == DOCKER_INSTALLATION_PLAYBOOK
+            )
+        )
+        # the legacy layout has no update times, the migration time stands for them
+        updated_at = datetime.now(timezone.utc)
+        for legacy_state in legacy_states:
+            for task in DOCKER_INSTALLATION_NAME:
+                task_status = getattr(legacy_state, task.value)
+                if (
+                    legacy_state.host_id == None
+                    or not task_status
+                    or (legacy_state.host_id, task.value) in stored
+                ):
+                    continue
+                db.add(
+                    models.RemoteHostTaskState(
+                        host_id=legacy_state.host_id,
+                        playbook=DOCKER_INSTALLATION_PLAYBOOK,
+                        task=task.value,
+                        status=task_status,
+                        updated_at=updated_at,
+                    )
+                )
+        db.query(models.RemoteHostDockerState).delete()
+        db.commit()
+        return len(legacy_states)
+    except SQLAlchemyError as e:
+        db.rollback()
+        err = f"SQLAlchemy error occurred while migrating docker states: {e}"
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
         )
@@ -192,6 +406,28 @@ def get_remote_hosts_by_fl_identifier(
         )
 
 
+def get_cached_remote_hosts_by_fl_identifier(
+    db: Session, fl_identifier: str
+) -> list[schema.CachedRemoteHost]:
+    """
+    Returns read-only copies of the remote hosts that have the given fl_identifier.
+
+    Lookups are cached like the ones of `get_cached_remote_host_by_ip_address`, so a
+    federation without hosts isn't cached either.
+    """
+
+    def lookup() -> tuple[schema.CachedRemoteHost, ...] | None:
+        hosts = tuple(
+            schema.CachedRemoteHost.from_orm(host)
+            for host in get_remote_hosts_by_fl_identifier(
+                db=db, fl_identifier=fl_identifier
+            )
+        )
+        return hosts or None
+
+    return list(host_cache.get(HOSTS_BY_FL_IDENTIFIER, fl_identifier, lookup) or ())
+
+
 def update_remote_host_host_pattern_by_ip_address(
     db: Session, ip_address: str, host_pattern: str
 ):
@@ -200,6 +436,10 @@ def update_remote_host_host_pattern_by_ip_address(
             models.RemoteHost.ip_address == ip_address
         ).update({"host_pattern": host_pattern})
         db.commit()
+        inventory_cache.invalidate()
+        host_cache.invalidate(HOST_BY_IP_ADDRESS, [ip_address])
+        # the FL identifier of the host is unknown here
+        host_cache.invalidate(HOSTS_BY_FL_IDENTIFIER)
     except SQLAlchemyError as e:
         db.rollback()
         err = f"SQLAlchemy error occurred while updating remote host host pattern by ip address: {e}"
@@ -220,28 +460,13 @@ def register_remote_host(db: Session, remote_host: schema.RemoteHostCreate):
         db.add(db_remote_host)
         db.commit()
         db.refresh(db_remote_host)
-
-        state_docker_installation = {
-            "host_id": db_remote_host.id,
-            DOCKER_INSTALLATION_NAME.state_install_aptitude: "",
-            DOCKER_INSTALLATION_NAME.state_install_required_system_packages: "",
-            DOCKER_INSTALLATION_NAME.state_add_docker_gpg_apt_key: "",
-            DOCKER_INSTALLATION_NAME.state_add_docker_repository: "",
-            DOCKER_INSTALLATION_NAME.state_update_apt_and_install_docker_ce: "",
-            DOCKER_INSTALLATION_NAME.state_install_docker_module_for_python: "",
-            DOCKER_INSTALLATION_NAME.state_check_docker_command: "",
-        }
-
-        db_remote_host_docker_state = models.RemoteHostDockerState(
-            **state_docker_installation
-        )
-        db.add(db_remote_host_docker_state)
-        db.commit()
-        db.refresh(db_remote_host_docker_state)
+        inventory_cache.invalidate(remote_host.fl_identifier)
+        host_cache.invalidate(HOST_BY_IP_ADDRESS, [remote_host.ip_address])
+        host_cache.invalidate(HOSTS_BY_FL_IDENTIFIER, [remote_host.fl_identifier])
 
     except IntegrityError as e:
         db.rollback()
-        if "UNIQUE constraint failed" in str(e):
+        if is_unique_violation(e):
             raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT,
                 detail="Remote host with the given IP address already exists",
@@ -265,3 +490,341 @@ def register_remote_host(db: Session, remote_host: schema.RemoteHostCreate):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
         )
+
+
+def register_remote_hosts(
+    db: Session,
+    remote_hosts: list[schema.RemoteHostCreate],
+    before_commit: Callable[[list[models.RemoteHost]], None] | None = None,
+) -> list[models.RemoteHost]:
+    """
+    Registers many remote hosts in a single transaction.
+
+    Hosts without a host pattern get the default `host_<id>` pattern. This function
+    doesn't validate the given remote hosts, see `register_remote_host`.
+
+    before_commit is called with the hosts once their ids and host patterns are
+    assigned, e.g. to write them to the inventory. If it raises, nothing is registered.
+    """
+
+    try:
+        db_remote_hosts = [
+            models.RemoteHost(**remote_host.dict()) for remote_host in remote_hosts
+        ]
+        db.add_all(db_remote_hosts)
+        # assigns the ids the default host patterns are derived from
+        db.flush()
+        for db_remote_host in db_remote_hosts:
+            if db_remote_host.host_pattern == None:
+                db_remote_host.host_pattern = f"host_{db_remote_host.id}"
+        if before_commit != None:
+            try:
+                before_commit(db_remote_hosts)
+            except Exception:
+                db.rollback()
+                raise
+        db.commit()
+        fl_identifiers = {remote_host.fl_identifier for remote_host in remote_hosts}
+        for fl_identifier in fl_identifiers:
+            inventory_cache.invalidate(fl_identifier)
+        host_cache.invalidate(
+            HOST_BY_IP_ADDRESS, [remote_host.ip_address for remote_host in remote_hosts]
+        )
+        host_cache.invalidate(HOSTS_BY_FL_IDENTIFIER, fl_identifiers)
+        return db_remote_hosts
+
+    except IntegrityError as e:
+        db.rollback()
+        if is_unique_violation(e):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="A remote host with one of the given IP addresses already exists",
+            )
+        err = f"IntegrityError occurred while registering remote hosts: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+    except SQLAlchemyError as e:
+        db.rollback()
+        err = f"SQLAlchemyError occurred while registering remote hosts: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def create_ansible_job(
+    db: Session,
+    job_id: str,
+    playbook: str,
+    fl_identifier: str,
+    host_limit: str | None = None,
+) -> models.AnsibleJob:
+    """
+    Persists a new ansible job in pending state.
+    """
+
+    try:
+        db_job = models.AnsibleJob(
+            id=job_id,
+            playbook=playbook,
+            fl_identifier=fl_identifier,
+            host_limit=host_limit,
+            status=JobStatus.pending,
+            created_at=datetime.now(timezone.utc),
+        )
+        db.add(db_job)
+        db.commit()
+        db.refresh(db_job)
+        return db_job
+    except SQLAlchemyError as e:
+        db.rollback()
+        err = f"SQLAlchemyError occurred while creating ansible job: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def get_ansible_job(db: Session, job_id: str) -> models.AnsibleJob | None:
+    """
+    Returns the ansible job with the given id.
+    """
+
+    try:
+        return (
+            db.query(models.AnsibleJob).filter(models.AnsibleJob.id == job_id).first()
+        )
+    except SQLAlchemyError as e:
+        err = f"SQLAlchemy error occurred while getting ansible job: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def get_ansible_jobs(
+    db: Session, fl_identifier: str | None = None, skip: int = 0, limit: int = 100
+) -> list[models.AnsibleJob]:
+    """
+    Returns a list of ansible jobs, most recent first.
+    """
+
+    try:
+        query = db.query(models.AnsibleJob)
+        if fl_identifier is not None:
+            query = query.filter(models.AnsibleJob.fl_identifier == fl_identifier)
+        return (
+            query.order_by(models.AnsibleJob.created_at.desc())
+            .offset(skip)
+            .limit(limit)
+            .all()
+        )
+    except SQLAlchemyError as e:
+        err = f"SQLAlchemy error occurred while getting ansible jobs: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def update_ansible_job(db: Session, job_id: str, updated_job: dict) -> None:
+    try:
+        db.query(models.AnsibleJob).filter(models.AnsibleJob.id == job_id).update(
+            updated_job
+        )
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        err = f"SQLAlchemy error occurred while updating ansible job: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def fail_unfinished_ansible_jobs(db: Session) -> int:
+    """
+    Marks pending and running jobs as failed, returns the number of affected jobs.
+
+    Jobs are executed in-process, so unfinished ones cannot survive a restart.
+    """
+
+    try:
+        count = (
+            db.query(models.AnsibleJob)
+            .filter(
+                models.AnsibleJob.status.in_([JobStatus.pending, JobStatus.running])
+            )
+            .update(
+                {
+                    "status": JobStatus.failed,
+                    "description": "Interrupted by a service restart",
+                    "finished_at": datetime.now(timezone.utc),
+                },
+                synchronize_session=False,
+            )
+        )
+        db.commit()
+        return count
+    except SQLAlchemyError as e:
+        db.rollback()
+        err = f"SQLAlchemy error occurred while failing unfinished ansible jobs: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def get_docker_image_build(
+    db: Session, bundle_hash: str, platform: str, arch: str, dockerfile_hash: str
+) -> models.DockerImageBuild | None:
+    """
+    Returns the build of the given bundle, platform, architecture and dockerfile.
+    """
+
+    try:
+        return (
+            db.query(models.DockerImageBuild)
+            .filter(
+                models.DockerImageBuild.bundle_hash == bundle_hash,
+                models.DockerImageBuild.platform == platform,
+                models.DockerImageBuild.arch == arch,
+                models.DockerImageBuild.dockerfile_hash == dockerfile_hash,
+            )
+            .first()
+        )
+    except SQLAlchemyError as e:
+        err = f"SQLAlchemy error occurred while getting docker image build: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def get_docker_image_build_by_id(
+    db: Session, build_id: int
+) -> models.DockerImageBuild | None:
+    """
+    Returns the docker image build with the given id.
+    """
+
+    try:
+        return (
+            db.query(models.DockerImageBuild)
+            .filter(models.DockerImageBuild.id == build_id)
+            .first()
+        )
+    except SQLAlchemyError as e:
+        err = f"SQLAlchemy error occurred while getting docker image build: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def queue_docker_image_build(
+    db: Session,
+    bundle_hash: str,
+    platform: str,
+    arch: str,
+    dockerfile_hash: str,
+    image_name: str,
+) -> tuple[models.DockerImageBuild, bool]:
+    """
+    Creates the build of the given key in queued state, or requeues a previous one.
+
+    Returns the build and whether it was queued by this call, a concurrent request may
+    have queued the same build first.
+    """
+
+    try:
+        build = get_docker_image_build(
+            db=db,
+            bundle_hash=bundle_hash,
+            platform=platform,
+            arch=arch,
+            dockerfile_hash=dockerfile_hash,
+        )
+        if build == None:
+            build = models.DockerImageBuild(
+                bundle_hash=bundle_hash,
+                platform=platform,
+                arch=arch,
+                dockerfile_hash=dockerfile_hash,
+            )
+            db.add(build)
+
+        build.image_name = image_name
+        build.status = BuildStatus.queued
+        build.rc = None
+        build.description = None
+        build.created_at = datetime.now(timezone.utc)
+        build.started_at = None
+        build.finished_at = None
+        db.commit()
+        db.refresh(build)
+        return build, True
+    except IntegrityError:
+        # the same build has been queued by a concurrent request in the meantime
+        db.rollback()
+        build = get_docker_image_build(
+            db=db,
+            bundle_hash=bundle_hash,
+            platform=platform,
+            arch=arch,
+            dockerfile_hash=dockerfile_hash,
+        )
+        if build == None:
+            err = "Docker image build could not be queued"
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+            )
+        return build, False
+    except SQLAlchemyError as e:
+        db.rollback()
+        err = f"SQLAlchemyError occurred while queueing docker image build: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def update_docker_image_build(db: Session, build_id: int, updated_build: dict) -> None:
+    try:
+        db.query(models.DockerImageBuild).filter(
+            models.DockerImageBuild.id == build_id
+        ).update(updated_build)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        err = f"SQLAlchemy error occurred while updating docker image build: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
+
+def fail_unfinished_docker_image_builds(db: Session) -> int:
+    """
+    Marks queued and running builds as failed, returns the number of affected builds.
+
+    Builds are executed in-process, so unfinished ones cannot survive a restart.
+    """
+
+    try:
+        count = (
+            db.query(models.DockerImageBuild)
+            .filter(
+                models.DockerImageBuild.status.in_(
+                    [BuildStatus.queued, BuildStatus.running]
+                )
+            )
+            .update(
+                {
+                    "status": BuildStatus.failed,
+                    "description": "Interrupted by a service restart",
+                    "finished_at": datetime.now(timezone.utc),
+                },
+                synchronize_session=False,
+            )
+        )
+        db.commit()
+        return count
+    except SQLAlchemyError as e:
+        db.rollback()
+        err = f"SQLAlchemy error occurred while failing unfinished docker image builds: {e}"
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
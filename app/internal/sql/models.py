@@ -1,4 +1,12 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    UniqueConstraint,
+)
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -10,6 +18,12 @@ class RemoteHost(Base):
     """
 
     __tablename__ = "remote_host"
+    # keyset pagination walks the hosts by id within each filter
+    __table_args__ = (
+        Index("ix_remote_host_fl_identifier_id", "fl_identifier", "id"),
+        Index("ix_remote_host_flower_type_id", "flower_type", "id"),
+        Index("ix_remote_host_contact_info_id", "contact_info", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     flower_type = Column(String)
@@ -30,18 +44,22 @@ class RemoteHost(Base):
         back_populates="remote_host",
         uselist=False,
     )
-    host_pattern = Column(String)
+    task_states = relationship("RemoteHostTaskState", back_populates="remote_host")
+    host_pattern = Column(String, index=True)
 
 
 class RemoteHostDockerState(Base):
     """
     Model for docker state of the remote host.
+
+    Legacy layout with a column per task, its rows are migrated to RemoteHostTaskState
+    on startup.
     """
 
     __tablename__ = "remote_host_docker_state"
 
     id = Column(Integer, primary_key=True, index=True)
-    host_id = Column(Integer, ForeignKey("remote_host.id"))
+    host_id = Column(Integer, ForeignKey("remote_host.id"), index=True)
     remote_host = relationship("RemoteHost", back_populates="docker_state")
 
     # each task completion state
@@ -52,3 +70,73 @@ class RemoteHostDockerState(Base):
     state_update_apt_and_install_docker_ce = Column(String)
     state_install_docker_module_for_python = Column(String)
     state_check_docker_command = Column(String)
+
+
+class AnsibleJob(Base):
+    """
+    Model for asynchronous ansible-runner jobs.
+    """
+
+    __tablename__ = "ansible_job"
+
+    id = Column(String(36), primary_key=True, index=True)
+    playbook = Column(String)
+    fl_identifier = Column(String, index=True)
+    host_limit = Column(String)
+    status = Column(String)
+    rc = Column(Integer)
+    description = Column(String)
+
+    created_at = Column(DateTime(timezone=True))
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+
+
+class DockerImageBuild(Base):
+    """
+    Model for docker images built from uploaded source bundles.
+
+    A build is identified by the bundle content, the target platform and the generated
+    dockerfile, so identical uploads can reuse an existing image.
+    """
+
+    __tablename__ = "docker_image_build"
+    __table_args__ = (
+        UniqueConstraint("bundle_hash", "platform", "arch", "dockerfile_hash"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    bundle_hash = Column(String(64), index=True)
+    platform = Column(String)
+    arch = Column(String)
+    dockerfile_hash = Column(String(64))
+    image_name = Column(String)
+    status = Column(String)
+    rc = Column(Integer)
+    description = Column(String)
+
+    created_at = Column(DateTime(timezone=True))
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+
+
+class RemoteHostTaskState(Base):
+    """
+    Model for the completion state of a single playbook task on the remote host.
+    """
+
+    __tablename__ = "remote_host_task_state"
+    __table_args__ = (
+        UniqueConstraint("host_id", "playbook", "task"),
+        # hosts in a given state of a task, without scanning all states
+        Index("ix_remote_host_task_state_task_status", "playbook", "task", "status"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    host_id = Column(Integer, ForeignKey("remote_host.id"), index=True)
+    remote_host = relationship("RemoteHost", back_populates="task_states")
+
+    playbook = Column(String)
+    task = Column(String)
+    status = Column(String)
+    updated_at = Column(DateTime(timezone=True))
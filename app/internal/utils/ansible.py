@@ -1,8 +1,83 @@
+import copy
 import logging
 import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import IO, Any
 
 import yaml
 
+logger = logging.getLogger(__name__)
+
+# libyaml bindings are an order of magnitude faster, but PyYAML may be built without them
+try:
+    from yaml import CSafeDumper as YamlDumper
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
+    from yaml import SafeLoader as YamlLoader
+
+YAML_CACHE_SIZE = 128
+
+# parsed content of recently read files, keyed by path, with the stat it was read at
+_yaml_cache: OrderedDict[str, tuple[tuple[int, int, int], Any]] = OrderedDict()
+_yaml_cache_lock = threading.Lock()
+
+
+def _yaml_file_key(filepath: str) -> tuple[int, int, int]:
+    stat = os.stat(filepath)
+    # files are replaced by rename, so a new inode tells a rewrite within the same mtime
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def load_yaml(stream: str | IO) -> Any:
+    """
+    Parse yaml content with the fastest available safe loader.
+    """
+
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+def dump_yaml(content: Any, stream: IO | None = None) -> str | None:
+    """
+    Serialize to yaml with the fastest available safe dumper, keeping the key order.
+    """
+
+    return yaml.dump(
+        content,
+        stream,
+        Dumper=YamlDumper,
+        default_flow_style=False,
+        sort_keys=False,
+    )
+
+
+def load_yaml_file(filepath: str) -> Any:
+    """
+    Parse a yaml file, reusing the result of the last parse if the file is unchanged.
+
+    A copy is returned, so callers are free to modify it. Raises yaml.YAMLError and
+    OSError like a plain parse.
+    """
+
+    key = _yaml_file_key(filepath)
+    with _yaml_cache_lock:
+        cached = _yaml_cache.get(filepath)
+        if cached != None and cached[0] == key:
+            _yaml_cache.move_to_end(filepath)
+            return copy.deepcopy(cached[1])
+
+    with open(filepath, "r") as yaml_file:
+        content = load_yaml(yaml_file)
+
+    with _yaml_cache_lock:
+        _yaml_cache[filepath] = (key, content)
+        _yaml_cache.move_to_end(filepath)
+        while len(_yaml_cache) > YAML_CACHE_SIZE:
+            _yaml_cache.popitem(last=False)
+    return copy.deepcopy(content)
+
 
 def ansible_read_yaml(filepath: str) -> dict:
     """
@@ -10,10 +85,9 @@ def ansible_read_yaml(filepath: str) -> dict:
     """
 
     try:
-        with open(filepath, "r") as yaml_file:
-            return yaml.safe_load(yaml_file)
+        return load_yaml_file(filepath)
     except (yaml.YAMLError, OSError) as e:
-        logging.error(f"Failed to read {filepath} as a yaml file, {e}")
+        logger.error(f"Failed to read {filepath} as a yaml file, {e}")
         return {}
 
 
@@ -22,18 +96,32 @@ def ansible_export_to_yaml(
 ) -> bool:
     """
     Export a dictionary to a yaml file.
+
+    The file is written next to its destination first and then renamed over it, so
+    readers never see a partially written file.
     """
 
+    tmp_filepath = None
     try:
-        with open(filepath, "w") as yaml_file:
+        fd, tmp_filepath = tempfile.mkstemp(
+            dir=os.path.dirname(filepath) or ".",
+            prefix=f".{os.path.basename(filepath)}.",
+            suffix=".tmp",
+        )
+        with os.fdopen(fd, "w") as yaml_file:
             if not is_playbook:
                 yaml_file.write("# code: language=ansible" + 2 * os.linesep)
             else:
                 yaml_file.write("---" + os.linesep)
-            yaml.dump(dict, yaml_file, default_flow_style=False, sort_keys=False)
-        logging.info(f"Successfully exported dictionary to {filepath}")
-    except (IOError, OSError) as e:
-        logging.error(f"Failed to export dictionary to {filepath} as a yaml file, {e}")
+            dump_yaml(dict, yaml_file)
+        # mkstemp creates the file readable by the owner only
+        os.chmod(tmp_filepath, 0o644)
+        os.replace(tmp_filepath, filepath)
+        logger.info(f"Successfully exported dictionary to {filepath}")
+    except (IOError, OSError, yaml.YAMLError) as e:
+        logger.error(f"Failed to export dictionary to {filepath} as a yaml file, {e}")
+        if tmp_filepath != None and os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
         return False
     else:
         return True
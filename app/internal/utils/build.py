@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+from starlette.concurrency import run_in_threadpool
+
+from ...definitions import BUNDLE_STORE_DIR, MAX_CONCURRENT_BUILDS
+from ..sql import crud
+from ..sql.database import SesssionLocal
+from .enum import BuildStatus
+from .image import distribute_image
+from .log import log_context
+from .metrics import docker_build_duration
+
+logger = logging.getLogger(__name__)
+
+BUILD_LOG_DIR = os.path.join(BUNDLE_STORE_DIR, "logs")
+
+_build_queue: asyncio.Queue | None = None
+_build_workers: list[asyncio.Task] = []
+
+
+def get_build_log_path(build_id: int) -> str:
+    return os.path.join(BUILD_LOG_DIR, f"{build_id}.log")
+
+
+def read_build_log(build_id: int, tail: int | None = None) -> str | None:
+    """
+    Return the captured output of the build, optionally only its last lines.
+
+    Returns None if the build has not produced a log yet.
+    """
+
+    try:
+        with open(get_build_log_path(build_id), "r", errors="replace") as log_file:
+            if tail == None:
+                return log_file.read()
+            return "".join(log_file.readlines()[-tail:])
+    except FileNotFoundError:
+        return None
+
+
+def queue_build(
+    build_id: int, context_dir: str, command: list[str], image_name: str | None = None
+) -> None:
+    """
+    Queue a build command, it runs in the context directory once a worker is free.
+
+    If the image name is given, the image is distributed to the remote hosts once it
+    is built, see distribute_image. Must be called from the event loop after the
+    workers are started.
+    """
+
+    if _build_queue == None:
+        raise RuntimeError("Docker build workers are not started")
+    _build_queue.put_nowait((build_id, context_dir, command, image_name))
+    logger.info(
+        f"Docker image build {build_id} is queued, {_build_queue.qsize()} waiting"
+    )
+
+
+def _update_build(build_id: int, updated_build: dict) -> None:
+    db = SesssionLocal()
+    try:
+        crud.update_docker_image_build(
+            db=db, build_id=build_id, updated_build=updated_build
+        )
+    finally:
+        db.close()
+
+
+def _distribute_image(build_id: int, image_name: str) -> int:
+    # the output goes to the log of the build
+    with open(get_build_log_path(build_id), "ab") as log_file:
+        return distribute_image(image_name, log_file)
+
+
+async def _run_build(
+    build_id: int, context_dir: str, command: list[str], image_name: str | None
+) -> None:
+    await run_in_threadpool(
+        _update_build,
+        build_id,
+        {"status": BuildStatus.running, "started_at": datetime.now(timezone.utc)},
+    )
+
+    os.makedirs(BUILD_LOG_DIR, exist_ok=True)
+    try:
+        with open(get_build_log_path(build_id), "wb") as log_file:
+            started_at = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                cwd=context_dir,
+                stdout=log_file,
+                stderr=asyncio.subprocess.STDOUT,
+                stdin=asyncio.subprocess.DEVNULL,
+            )
+            rc = await process.wait()
+            build_status = BuildStatus.successful if rc == 0 else BuildStatus.failed
+            docker_build_duration.observe(
+                time.perf_counter() - started_at, status=build_status.value
+            )
+    except OSError as e:
+        err = f"Docker image build {build_id} could not be started: {e}"
+        logger.error(err)
+        await run_in_threadpool(
+            _update_build,
+            build_id,
+            {
+                "status": BuildStatus.failed,
+                "description": err,
+                "finished_at": datetime.now(timezone.utc),
+            },
+        )
+        return
+
+    if rc == 0 and image_name != None:
+        try:
+            distribution_rc = await run_in_threadpool(
+                _distribute_image, build_id, image_name
+            )
+        except OSError as e:
+            logger.error(f"Distribution of image {image_name} failed: {e}")
+            distribution_rc = 1
+    else:
+        distribution_rc = 0
+
+    if rc == 0 and distribution_rc != 0:
+        err = f"Docker image {image_name} of build {build_id} could not be distributed, exit code {distribution_rc}"
+        logger.error(err)
+        updated_build = {"status": BuildStatus.failed, "description": err}
+    elif rc == 0:
+        logger.info(f"Docker image build {build_id} is successful")
+        updated_build = {"status": BuildStatus.successful}
+    else:
+        err = f"Docker image build {build_id} failed with exit code {rc}"
+        logger.error(err)
+        updated_build = {"status": BuildStatus.failed, "description": err}
+
+    await run_in_threadpool(
+        _update_build,
+        build_id,
+        dict(updated_build, rc=rc, finished_at=datetime.now(timezone.utc)),
+    )
+
+
+async def _build_worker() -> None:
+    assert _build_queue != None
+    while True:
+        build_id, context_dir, command, image_name = await _build_queue.get()
+        try:
+            with log_context(build_id=str(build_id)):
+                await _run_build(build_id, context_dir, command, image_name)
+        except Exception as e:
+            logger.error(f"Docker image build {build_id} failed unexpectedly: {e}")
+        finally:
+            _build_queue.task_done()
+
+
+def start_build_workers() -> None:
+    """
+    Start the workers which run queued builds, must be called from the event loop.
+    """
+
+    global _build_queue
+
+    _build_queue = asyncio.Queue()
+    _build_workers.extend(
+        asyncio.create_task(_build_worker()) for _ in range(MAX_CONCURRENT_BUILDS)
+    )
+
+
+async def stop_build_workers() -> None:
+    for worker in _build_workers:
+        worker.cancel()
+    await asyncio.gather(*_build_workers, return_exceptions=True)
+    _build_workers.clear()
@@ -0,0 +1,55 @@
+import logging
+import os
+import shutil
+import uuid
+
+from ...definitions import BUNDLE_STORE_DIR
+from .upload import extract_zip
+
+logger = logging.getLogger(__name__)
+
+# uploads are received here before they are moved into the store
+BUNDLE_INCOMING_DIR = os.path.join(BUNDLE_STORE_DIR, "incoming")
+
+
+def get_bundle_dir(bundle_hash: str) -> str:
+    """
+    Return the directory of the extracted bundle with the given content hash.
+    """
+
+    return os.path.join(BUNDLE_STORE_DIR, os.path.basename(bundle_hash))
+
+
+def store_bundle(zippath: str, bundle_hash: str) -> tuple[str, bool]:
+    """
+    Store the uploaded zip file under its content hash, the zip file is removed.
+
+    The bundle is extracted only if the same content has not been stored before.
+    Returns the bundle directory and whether it was already in the store.
+    """
+
+    bundle_dir = get_bundle_dir(bundle_hash)
+    try:
+        if os.path.isdir(bundle_dir):
+            logger.info(f"Bundle {bundle_hash} is already stored, skipping extraction")
+            return bundle_dir, True
+
+        # extract next to the final location, then publish it with an atomic rename
+        # so that a half extracted bundle is never visible under its hash.
+        staging_dir = f"{bundle_dir}.{uuid.uuid4().hex}.tmp"
+        try:
+            extract_zip(zippath, staging_dir)
+            os.rename(staging_dir, bundle_dir)
+        except OSError:
+            if not os.path.isdir(bundle_dir):
+                raise
+            # a concurrent upload of the same content has won the race
+            return bundle_dir, True
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        logger.info(f"Bundle {bundle_hash} is stored in {bundle_dir}")
+        return bundle_dir, False
+
+    finally:
+        os.remove(zippath)
@@ -1,5 +1,8 @@
 from enum import Enum
 
+# playbook of the docker installation, its task states are stored under this name
+DOCKER_INSTALLATION_PLAYBOOK = "docker_ubuntu_focal.yaml"
+
 
 class DOCKER_INSTALLATION_NAME(str, Enum):
     state_install_aptitude = "state_install_aptitude"
@@ -50,3 +53,38 @@ class FlowerType(str, Enum):
 
     server = "server"
     client = "client"
+
+
+class JobStatus(str, Enum):
+    """
+    Ansible job status, terminal values mirror ansible-runner statuses.
+    """
+
+    pending = "pending"
+    running = "running"
+    successful = "successful"
+    failed = "failed"
+    timeout = "timeout"
+    canceled = "canceled"
+
+
+class UploadStatus(str, Enum):
+    """
+    Source bundle upload status.
+    """
+
+    receiving = "receiving"
+    extracting = "extracting"
+    completed = "completed"
+    failed = "failed"
+
+
+class BuildStatus(str, Enum):
+    """
+    Docker image build status.
+    """
+
+    queued = "queued"
+    running = "running"
+    successful = "successful"
+    failed = "failed"
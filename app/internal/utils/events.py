@@ -0,0 +1,301 @@
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Callable
+
+from ...definitions import (
+    EVENT_BUFFER_SIZE,
+    EVENT_MAX_CHANNELS,
+    EVENT_SUBSCRIBER_QUEUE_SIZE,
+)
+from .enum import JobStatus
+from .metrics import observe_task_event
+
+# published when a run is over, it is the last message of the channel of the run
+RUN_FINISHED_EVENT = "run_finished"
+
+
+def get_federation_topic(fl_identifier: str) -> str:
+    return f"fl-identifier/{fl_identifier}"
+
+
+class _Subscriber:
+    """
+    Queue of a single subscriber, filled from the publishing threads through its loop.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, maxsize: int):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        # set once a message is dropped because the queue was full
+        self.lagging = False
+
+    def offer(self, item: tuple[int, dict] | None) -> None:
+        # runs in the loop of the subscriber
+        if self.lagging:
+            return
+        if self.queue.full():
+            self.lagging = True
+            return
+        self.queue.put_nowait(item)
+
+
+class EventChannel:
+    """
+    Messages of a single topic, numbered by their offset from 0.
+
+    The last messages are kept in a ring buffer, so subscribers can replay them from an
+    offset. A subscriber which doesn't keep up is never waited for, its messages are
+    dropped and it catches up from the ring buffer once it has consumed its queue.
+    Messages which have left the ring buffer by then are skipped.
+    """
+
+    def __init__(self, buffer_size: int, queue_size: int):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._buffer: deque[tuple[int, dict]] = deque(maxlen=buffer_size)
+        self._next_offset = 0
+        self._subscribers: set[_Subscriber] = set()
+        self.closed = False
+
+    @property
+    def next_offset(self) -> int:
+        with self._lock:
+            return self._next_offset
+
+    @property
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def _notify(self, subscribers: list[_Subscriber], item: tuple | None) -> None:
+        for subscriber in subscribers:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber.offer, item)
+            except RuntimeError:
+                # the loop of the subscriber is closed, it is gone
+                with self._lock:
+                    self._subscribers.discard(subscriber)
+
+    def publish(self, message: dict) -> int:
+        """
+        Publish a message, from any thread, returns its offset.
+        """
+
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("Event channel is closed")
+            offset = self._next_offset
+            self._next_offset += 1
+            self._buffer.append((offset, message))
+            subscribers = list(self._subscribers)
+        self._notify(subscribers, (offset, message))
+        return offset
+
+    def close(self) -> None:
+        """
+        End the channel, subscribers finish once they have received every message.
+        """
+
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            subscribers = list(self._subscribers)
+        self._notify(subscribers, None)
+
+    def _read(self, offset: int) -> tuple[list[tuple[int, dict]], bool]:
+        with self._lock:
+            return [item for item in self._buffer if item[0] >= offset], self.closed
+
+    async def subscribe(
+        self, offset: int | None = None, idle_timeout: float | None = None
+    ) -> AsyncIterator[tuple[int, dict] | None]:
+        """
+        Yield the messages of the channel from the given offset, until it is closed.
+
+        Without an offset, only the messages published from now on are yielded. None
+        is yielded whenever no message has arrived for `idle_timeout` seconds.
+        """
+
+        subscriber = _Subscriber(asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            next_offset = self._next_offset if offset == None else offset
+
+        try:
+            while True:
+                # catch up from the buffer, messages published since then are queued
+                subscriber.lagging = False
+                backlog, closed = self._read(next_offset)
+                for item in backlog:
+                    next_offset = item[0] + 1
+                    yield item
+                if closed:
+                    return
+
+                while not (subscriber.lagging and subscriber.queue.empty()):
+                    try:
+                        item = await asyncio.wait_for(
+                            subscriber.queue.get(), idle_timeout
+                        )
+                    except asyncio.TimeoutError:
+                        yield None
+                        continue
+
+                    if item == None:
+                        # closed, anything missed is still in the buffer
+                        break
+                    if item[0] < next_offset:
+                        # already yielded from the buffer
+                        continue
+                    next_offset = item[0] + 1
+                    yield item
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+
+class EventBroker:
+    """
+    In-process publish/subscribe of live events, one channel per topic.
+
+    The least recently used channels without subscribers are dropped beyond the
+    maximum number of channels.
+    """
+
+    def __init__(
+        self,
+        max_channels: int = EVENT_MAX_CHANNELS,
+        buffer_size: int = EVENT_BUFFER_SIZE,
+        queue_size: int = EVENT_SUBSCRIBER_QUEUE_SIZE,
+    ):
+        self.max_channels = max_channels
+        self.buffer_size = buffer_size
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._channels: OrderedDict[str, EventChannel] = OrderedDict()
+
+    def get_channel(self, topic: str, create: bool = False) -> EventChannel | None:
+        with self._lock:
+            channel = self._channels.get(topic)
+            if channel == None and create:
+                channel = EventChannel(self.buffer_size, self.queue_size)
+                self._channels[topic] = channel
+            if channel != None:
+                self._channels.move_to_end(topic)
+                self._evict()
+            return channel
+
+    def _evict(self) -> None:
+        excess = len(self._channels) - self.max_channels
+        # the most recently used channel is the one being returned
+        for topic in list(self._channels)[:-1]:
+            if excess <= 0:
+                return
+            if self._channels[topic].subscriber_count == 0:
+                del self._channels[topic]
+                excess -= 1
+
+    def publish(self, topic: str, message: dict) -> int:
+        channel = self.get_channel(topic, create=True)
+        assert channel != None
+        return channel.publish(message)
+
+    def close(self, topic: str) -> None:
+        channel = self.get_channel(topic)
+        if channel != None:
+            channel.close()
+
+
+# live events of the ansible runs, per run id and per federation
+event_broker = EventBroker()
+
+
+def to_live_event(run_id: str, fl_identifier: str, data: dict) -> dict:
+    """
+    Reduce an ansible-runner event to the fields streamed to the subscribers.
+    """
+
+    event_data = data.get("event_data", {})
+    message = {
+        "run_id": run_id,
+        "fl_identifier": fl_identifier,
+        "event": data.get("event"),
+        "counter": data.get("counter"),
+        "created": data.get("created"),
+        "host": event_data.get("host"),
+        "play": event_data.get("play"),
+        "task": event_data.get("task"),
+    }
+    res = event_data.get("res")
+    if isinstance(res, dict):
+        message["changed"] = bool(res.get("changed"))
+        if "msg" in res and data.get("event") != "runner_on_ok":
+            message["msg"] = res["msg"]
+    return message
+
+
+class RunEventPublisher:
+    """
+    Ansible event handler which publishes the task results of a run to the channel of
+    the run and to the channel of its federation, then hands the event to the wrapped
+    handler if there is one. Task durations are observed per playbook.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        fl_identifier: str,
+        handler: Callable[[dict], bool] | None = None,
+        broker: EventBroker = event_broker,
+        playbook: str | None = None,
+    ):
+        self.run_id = run_id
+        self.fl_identifier = fl_identifier
+        self.handler = handler
+        self.playbook = playbook
+        self.broker = broker
+        # kept, so the run publishes to the same channel even if it is evicted
+        self.channel = broker.get_channel(run_id, create=True)
+        assert self.channel != None
+        self.finished = False
+
+    def __enter__(self) -> "RunEventPublisher":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        # a run which has not reported its status has failed on the way
+        if not self.finished:
+            self.finish(JobStatus.failed)
+
+    def __call__(self, data: dict) -> bool:
+        if str(data.get("event", "")).startswith("runner_on_"):
+            message = to_live_event(self.run_id, self.fl_identifier, data)
+            self.channel.publish(message)
+            self.broker.publish(get_federation_topic(self.fl_identifier), message)
+            observe_task_event(self.playbook, data)
+
+        if self.handler != None:
+            return self.handler(data)
+        return True
+
+    def flush(self) -> None:
+        if hasattr(self.handler, "flush"):
+            self.handler.flush()  # type: ignore[union-attr]
+
+    def finish(self, status: str) -> None:
+        """
+        Publish the final status of the run and close its channel.
+        """
+
+        self.finished = True
+        message = {
+            "run_id": self.run_id,
+            "fl_identifier": self.fl_identifier,
+            "event": RUN_FINISHED_EVENT,
+            "status": status,
+        }
+        self.channel.publish(message)
+        self.broker.publish(get_federation_topic(self.fl_identifier), message)
+        self.channel.close()
@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import uuid
+from typing import IO
+
+from ...definitions import IMAGE_ARCHIVE_DIR, IMAGE_ARCHIVE_REMOTE_DIR, IMAGE_REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# same as the gzip command line default, the best level costs much more time
+IMAGE_ARCHIVE_COMPRESSLEVEL = 6
+IMAGE_ARCHIVE_CHUNK_SIZE = 1024 * 1024
+
+
+def get_deployment_image(image_name: str) -> str:
+    """
+    Return the reference the remote hosts run the built image by.
+    """
+
+    if IMAGE_REGISTRY != None:
+        return f"{IMAGE_REGISTRY}/{image_name}"
+    return image_name
+
+
+def get_image_archive_path(image_name: str) -> str:
+    # image names contain / and :, which are not welcome in file names
+    filename = image_name.replace("/", "_").replace(":", "_") + ".tar.gz"
+    return os.path.join(IMAGE_ARCHIVE_DIR, filename)
+
+
+def get_image_archive(image_name: str) -> dict | None:
+    """
+    Return the local path, the remote path and the checksum of the exported archive of
+    the image, for the deployment playbooks.
+
+    Returns None if the image has not been exported.
+    """
+
+    path = get_image_archive_path(image_name)
+    try:
+        with open(f"{path}.sha256", "r") as checksum_file:
+            checksum = checksum_file.read().strip()
+    except FileNotFoundError:
+        return None
+
+    return {
+        "name": image_name,
+        "src": path,
+        "dest": os.path.join(IMAGE_ARCHIVE_REMOTE_DIR, os.path.basename(path)),
+        "checksum": checksum,
+    }
+
+
+class _HashingWriter:
+    """
+    Write through to a file while computing the sha256 of what is written.
+    """
+
+    def __init__(self, file: IO[bytes]):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+
+def push_image(image_name: str, log_file: IO[bytes]) -> int:
+    """
+    Push the image to the registry, returns the exit code of the failed command or 0.
+    """
+
+    registry_image = get_deployment_image(image_name)
+    for command in (
+        ["docker", "tag", image_name, registry_image],
+        ["docker", "push", registry_image],
+    ):
+        rc = subprocess.run(
+            command,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+        ).returncode
+        if rc != 0:
+            return rc
+    logger.info(f"Image {image_name} is pushed as {registry_image}")
+    return 0
+
+
+def export_image(image_name: str, log_file: IO[bytes]) -> int:
+    """
+    Export the image with docker save as a gzip archive with its sha256 next to it.
+
+    Images are tagged by content, so an image which has been exported before is not
+    exported again. Returns the exit code of docker save, or 1 if the archive can't
+    be written.
+    """
+
+    path = get_image_archive_path(image_name)
+    if get_image_archive(image_name) != None:
+        logger.info(f"Image {image_name} is already exported to {path}")
+        return 0
+
+    os.makedirs(IMAGE_ARCHIVE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    process = subprocess.Popen(
+        ["docker", "save", image_name],
+        stdout=subprocess.PIPE,
+        stderr=log_file,
+        stdin=subprocess.DEVNULL,
+    )
+    assert process.stdout != None
+    try:
+        with open(tmp_path, "wb") as raw_file:
+            writer = _HashingWriter(raw_file)
+            # without a timestamp in the header, an image always gives the same archive
+            with gzip.GzipFile(
+                filename="",
+                mode="wb",
+                fileobj=writer,  # type: ignore[arg-type]
+                compresslevel=IMAGE_ARCHIVE_COMPRESSLEVEL,
+                mtime=0,
+            ) as archive_file:
+                shutil.copyfileobj(
+                    process.stdout, archive_file, IMAGE_ARCHIVE_CHUNK_SIZE
+                )
+        rc = process.wait()
+        if rc != 0:
+            return rc
+
+        os.replace(tmp_path, path)
+        # the checksum file marks the archive as complete, it is written last
+        with open(f"{tmp_path}.sha256", "w") as checksum_file:
+            checksum_file.write(writer.sha256.hexdigest() + "\n")
+        os.replace(f"{tmp_path}.sha256", f"{path}.sha256")
+    except OSError as e:
+        logger.error(f"Failed to export image {image_name} to {path}, {e}")
+        process.kill()
+        process.wait()
+        return 1
+    finally:
+        process.stdout.close()
+        for leftover in (tmp_path, f"{tmp_path}.sha256"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    logger.info(f"Image {image_name} is exported to {path}")
+    return 0
+
+
+def distribute_image(image_name: str, log_file: IO[bytes]) -> int:
+    """
+    Make a built image available to the remote hosts, returns 0 on success.
+
+    It is pushed to the registry if there is one, otherwise it is exported as an
+    archive which the deployment playbooks copy to the hosts which don't have it.
+    """
+
+    if IMAGE_REGISTRY != None:
+        return push_image(image_name, log_file)
+    return export_image(image_name, log_file)
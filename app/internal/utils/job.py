@@ -0,0 +1,196 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable
+
+import ansible_runner
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from ...definitions import ANSIBLE_MAX_CONCURRENT_JOBS
+from ..sql import crud, models
+from ..sql.database import SesssionLocal
+from .enum import InstallationStatus, JobStatus
+from .events import RunEventPublisher, event_broker
+from .log import log_context
+from .metrics import ansible_run_duration
+from .workspace import create_run_workspace, release_run_workspace
+
+logger = logging.getLogger(__name__)
+
+# Every job occupies one worker for the whole ansible-runner process, so the pool
+# size is the concurrency limit. Submitted jobs beyond it wait as pending.
+_executor = ThreadPoolExecutor(
+    max_workers=ANSIBLE_MAX_CONCURRENT_JOBS, thread_name_prefix="ansible-job"
+)
+
+EventHandlerFactory = Callable[[Session], Callable[[dict], bool]]
+
+
+def submit_ansible_job(
+    db: Session,
+    playbook: str,
+    fl_identifier: str,
+    runner_config: dict,
+    event_handler_factory: EventHandlerFactory | None = None,
+) -> models.AnsibleJob:
+    """
+    Persist a new ansible job and queue it for execution, returns immediately.
+
+    :param db: the database session of the caller
+    :param playbook: the name of the playbook, used for display purposes
+    :param fl_identifier: the federation the job belongs to
+    :param runner_config: keyword arguments for ansible_runner.run, except private_data_dir
+    :param event_handler_factory: builds the event handler with the job's own session
+    """
+
+    job_id, private_data_dir = create_run_workspace()
+    runner_config = dict(runner_config, private_data_dir=private_data_dir)
+
+    try:
+        job = crud.create_ansible_job(
+            db=db,
+            job_id=job_id,
+            playbook=playbook,
+            fl_identifier=fl_identifier,
+            host_limit=runner_config.get("limit"),
+        )
+    except HTTPException:
+        release_run_workspace(job_id, retain=False)
+        raise
+
+    # subscribers can wait for the events of the job while it is pending
+    event_broker.get_channel(str(job.id), create=True)
+    _executor.submit(
+        _run_ansible_job,
+        str(job.id),
+        playbook,
+        fl_identifier,
+        runner_config,
+        event_handler_factory,
+    )
+    logger.info(f"Ansible job {job.id} ({playbook}) is queued")
+    return job
+
+
+def _run_ansible_job(
+    job_id: str,
+    playbook: str,
+    fl_identifier: str,
+    runner_config: dict,
+    event_handler_factory: EventHandlerFactory | None,
+) -> None:
+    with log_context(job_id=job_id, fl_identifier=fl_identifier):
+        # request sessions are closed once the response is sent, the job needs its own.
+        db = SesssionLocal()
+        publisher = RunEventPublisher(
+            run_id=job_id, fl_identifier=fl_identifier, playbook=playbook
+        )
+        final_status = JobStatus.failed
+        try:
+            crud.update_ansible_job(
+                db=db,
+                job_id=job_id,
+                updated_job={
+                    "status": JobStatus.running,
+                    "started_at": datetime.now(timezone.utc),
+                },
+            )
+
+            config = dict(runner_config, ident=job_id)
+            if event_handler_factory is not None:
+                publisher.handler = event_handler_factory(db)
+            config["event_handler"] = publisher
+
+            try:
+                with ansible_run_duration.time(playbook=playbook):
+                    runner = ansible_runner.run(**config)
+            finally:
+                # buffering handlers keep the tail of the run until they are flushed
+                publisher.flush()
+            logger.info(f"Ansible job {job_id} finished with status {runner.status}")
+            final_status = runner.status
+            crud.update_ansible_job(
+                db=db,
+                job_id=job_id,
+                updated_job={
+                    "status": runner.status,
+                    "rc": runner.rc,
+                    "finished_at": datetime.now(timezone.utc),
+                },
+            )
+
+        except Exception as e:
+            err = f"Ansible job {job_id} failed unexpectedly: {e}"
+            logger.error(err)
+            db.rollback()
+            crud.update_ansible_job(
+                db=db,
+                job_id=job_id,
+                updated_job={
+                    "status": JobStatus.failed,
+                    "description": err,
+                    "finished_at": datetime.now(timezone.utc),
+                },
+            )
+
+        finally:
+            publisher.finish(final_status)
+            release_run_workspace(job_id)
+            db.close()
+
+
+# runner events which finish a task on a host, mapped to the result they count as
+HOST_OUTCOME_EVENTS = {
+    "runner_on_ok": "ok",
+    "runner_on_failed": "failed",
+    "runner_on_unreachable": "unreachable",
+    "runner_on_skipped": "skipped",
+}
+
+
+def summarize_host_outcomes(events: list[dict]) -> dict[str, dict]:
+    """
+    Count the task results of every host from the events of a run, keyed by the
+    inventory host name, i.e. the host pattern.
+
+    Hosts which have not finished any task are not listed.
+    """
+
+    outcomes: dict[str, dict] = {}
+    for data in events:
+        result = HOST_OUTCOME_EVENTS.get(data.get("event"))
+        event_data = data.get("event_data", {})
+        host = event_data.get("host")
+        if result == None or host == None:
+            continue
+
+        # ignored failures don't stop the host, ansible reports them as ok as well
+        if result == "failed" and event_data.get("ignore_errors"):
+            result = "ok"
+        counts = outcomes.setdefault(
+            host,
+            {"ok": 0, "changed": 0, "failed": 0, "unreachable": 0, "skipped": 0},
+        )
+        counts[result] += 1
+        if result == "ok" and (event_data.get("res") or {}).get("changed"):
+            counts["changed"] += 1
+
+    for counts in outcomes.values():
+        if counts["unreachable"] > 0:
+            counts["status"] = InstallationStatus.unreachable
+        elif counts["failed"] > 0:
+            counts["status"] = InstallationStatus.failed
+        elif counts["ok"] == 0:
+            counts["status"] = InstallationStatus.skipped
+        else:
+            counts["status"] = InstallationStatus.ok
+    return outcomes
+
+
+def shutdown_ansible_jobs() -> None:
+    """
+    Stop accepting new jobs, running ones are left to finish.
+    """
+
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,150 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Iterator
+
+from ...definitions import (
+    LOG_BACKUP_COUNT,
+    LOG_FILE,
+    LOG_LEVEL,
+    LOG_LEVELS,
+    LOG_MAX_BYTES,
+    LOG_QUEUE_SIZE,
+)
+from .metrics import log_records_dropped
+
+# fields added to the records logged in the current context, e.g. the run id
+_log_context: ContextVar[dict[str, str]] = ContextVar("log_context", default={})
+
+_queue_handler: logging.Handler | None = None
+_listener: logging.handlers.QueueListener | None = None
+
+
+@contextmanager
+def log_context(**fields: str) -> Iterator[None]:
+    """
+    Add the given fields to every record logged inside the block, in this thread or
+    task and in the threadpool calls made from it.
+    """
+
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format a record as a single line JSON object, with the fields of its log context.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "context", {}))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand records to the writer thread without formatting them.
+
+    The record is only reduced to what can be formatted later: its message, its
+    exception text and its log context, which is read here in the logging thread.
+    A record which doesn't fit in the full queue is dropped and counted.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.context = _log_context.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+def parse_log_levels(levels: str) -> dict[str, str]:
+    """
+    Parse logger levels given as name=LEVEL pairs separated by commas.
+    """
+
+    parsed = {}
+    for pair in levels.split(","):
+        if not pair.strip():
+            continue
+        name, sep, level = pair.partition("=")
+        if not sep or not name.strip():
+            raise ValueError(f"Log level {pair!r} is not given as name=LEVEL")
+        parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def configure_logging() -> None:
+    """
+    Send the records of every logger through a queue to a background thread, which
+    writes them as JSON lines to the rotated log file.
+
+    Logging calls only put the record in the queue, so file writes don't hold up
+    the request and event handler threads. Calling it again does nothing.
+    """
+
+    global _queue_handler, _listener
+
+    if _listener != None:
+        return
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+    )
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL.upper())
+    _queue_handler = ContextQueueHandler(log_queue)
+    root.addHandler(_queue_handler)
+    for name, level in parse_log_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """
+    Stop the writer thread once it has written the records left in the queue.
+    """
+
+    global _queue_handler, _listener
+
+    if _listener != None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _listener.stop()
+        _queue_handler = _listener = None
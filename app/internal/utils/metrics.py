@@ -0,0 +1,327 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# media type of the Prometheus text exposition format, the charset is added by the
+# response
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# bucket upper bounds in seconds, for requests and queries
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# bucket upper bounds in seconds, for ansible runs, tasks and docker builds
+LONG_DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# bucket upper bounds in bytes per second, from 100KB/s to 1GB/s
+THROUGHPUT_BUCKETS = (1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8, 1e9)
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape_label_value(value)}"' for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: "MetricsRegistry | None" = None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        (registry or metrics_registry).register(self)
+
+    def _label_values(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Metric {self.name} takes the labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, values: tuple[str, ...], **extra: str) -> dict[str, str]:
+        return dict(zip(self.labelnames, values), **extra)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [
+            f"# HELP {self.name} {_escape_help(self.documentation)}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing value, one per combination of label values.
+    """
+
+    type_name = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self._labels(key))} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values over fixed buckets, one per combination of label
+    values. Buckets are cumulative in the exposition, as Prometheus expects.
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # per label values: the count of each bucket, the sum and the count
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * len(self.buckets), [0.0, 0])
+            bucket_counts, totals = self._values[key]
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[i] += 1
+                    break
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Observe the time the block takes in seconds, even if it raises.
+        """
+
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(
+                (key, (list(bucket_counts), list(totals)))
+                for key, (bucket_counts, totals) in self._values.items()
+            )
+
+        lines = []
+        for key, (bucket_counts, (total, count)) in values:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = self._labels(key, le=_format_value(upper_bound))
+                lines.append(f"{self.name}_bucket{_format_labels(labels)} {cumulative}")
+            labels_text = _format_labels(self._labels(key))
+            lines.append(f"{self.name}_sum{labels_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels_text} {_format_value(count)}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Metrics of the process, exposed in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def expose(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.expose() for metric in metrics) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+
+http_request_duration = Histogram(
+    "fl_service_http_request_duration_seconds",
+    "Time until the response headers are sent, per route template.",
+    ("method", "route", "status"),
+)
+ansible_run_duration = Histogram(
+    "fl_service_ansible_run_duration_seconds",
+    "Duration of ansible_runner.run, per playbook.",
+    ("playbook",),
+    buckets=LONG_DURATION_BUCKETS,
+)
+ansible_task_duration = Histogram(
+    "fl_service_ansible_task_duration_seconds",
+    "Duration of ansible tasks on a single host, from the runner events.",
+    ("playbook", "task", "result"),
+    buckets=LONG_DURATION_BUCKETS,
+)
+docker_build_duration = Histogram(
+    "fl_service_docker_build_duration_seconds",
+    "Duration of docker buildx build commands.",
+    ("status",),
+    buckets=LONG_DURATION_BUCKETS,
+)
+upload_throughput = Histogram(
+    "fl_service_upload_bytes_per_second",
+    "Average receive rate of finished uploads.",
+    buckets=THROUGHPUT_BUCKETS,
+)
+upload_bytes = Counter(
+    "fl_service_upload_bytes_total",
+    "Bytes received by finished uploads.",
+)
+log_records_dropped = Counter(
+    "fl_service_log_records_dropped_total",
+    "Log records dropped because the queue of the log writer was full.",
+)
+db_query_duration = Histogram(
+    "fl_service_db_query_duration_seconds",
+    "Duration of database statements, per statement type.",
+    ("operation",),
+)
+
+# runner events which finish a task on a host, mapped to their result label
+TASK_RESULT_EVENTS = {
+    "runner_on_ok": "ok",
+    "runner_on_failed": "failed",
+    "runner_on_unreachable": "unreachable",
+    "runner_on_skipped": "skipped",
+}
+
+
+def observe_task_event(playbook: str | None, data: dict) -> None:
+    """
+    Observe the task duration carried by a runner event which finishes a task.
+    """
+
+    result = TASK_RESULT_EVENTS.get(data.get("event", ""))
+    if result == None:
+        return
+    event_data = data.get("event_data", {})
+    duration = event_data.get("duration")
+    if not isinstance(duration, (int, float)):
+        return
+    ansible_task_duration.observe(
+        duration,
+        playbook=playbook or event_data.get("playbook") or "",
+        task=event_data.get("task") or "",
+        result=result,
+    )
+
+
+def observe_query(statement: str, seconds: float) -> None:
+    parts = statement.lstrip().split(None, 1)
+    operation = parts[0].upper() if parts else ""
+    db_query_duration.observe(seconds, operation=operation)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware observing the latency of HTTP requests.
+
+    Requests are labelled by the path template of the matched route, so path
+    parameters don't create new series, and by the status code. Streamed responses,
+    e.g. the event streams, are measured until their headers are sent.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._routes: dict[object, str] = {}
+
+    def _get_route(self, scope: Scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint == None:
+            return "unmatched"
+        if endpoint not in self._routes:
+            route_path = next(
+                (
+                    route.path
+                    for route in scope["app"].routes
+                    if getattr(route, "endpoint", None) is endpoint
+                ),
+                "unmatched",
+            )
+            self._routes[endpoint] = route_path
+        return self._routes[endpoint]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.perf_counter()
+        observed = False
+
+        def observe(status_code: int) -> None:
+            nonlocal observed
+            observed = True
+            http_request_duration.observe(
+                time.perf_counter() - started_at,
+                method=scope["method"],
+                route=self._get_route(scope),
+                status=str(status_code),
+            )
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            if not observed:
+                observe(500)
+            raise
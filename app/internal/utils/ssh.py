@@ -1,6 +1,28 @@
+import hashlib
+import hmac
 import logging
 import os
+import secrets
+import shlex
 import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+import paramiko
+
+from ...definitions import (
+    SSH_CONNECT_TIMEOUT,
+    SSH_KEEPALIVE_SECONDS,
+    SSH_POOL_IDLE_SECONDS,
+    SSH_POOL_MAX_PER_HOST,
+)
+
+logger = logging.getLogger(__name__)
+
+# interval between two evictions of the idle pooled connections
+JANITOR_INTERVAL_SECONDS = 60
 
 
 def validate_command(cmd: str) -> bool:
@@ -18,7 +40,263 @@ def validate_command(cmd: str) -> bool:
                 ["which", cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE
             )
     except subprocess.CalledProcessError or subprocess.TimeoutExpired as e:
-        logging.warning(f"Exception while checking if command {cmd} exists: {e}")
+        logger.warning(f"Exception while checking if command {cmd} exists: {e}")
         return False
     else:
         return result.returncode == 0
+
+
+def build_authorized_key_script(
+    public_key: str, revoked_public_key: str | None = None
+) -> str:
+    """
+    Build a shell script which installs the public key into the authorized keys once.
+
+    The script is idempotent, creates ~/.ssh with the expected permissions and stops at
+    the first failing step. If given, the revoked key is removed after the new key is
+    installed, so the host stays reachable with the new key whatever happens.
+    """
+
+    key = shlex.quote(public_key.strip())
+    steps = [
+        "umask 077",
+        "mkdir -p ~/.ssh",
+        "touch ~/.ssh/authorized_keys",
+        "chmod 700 ~/.ssh",
+        "chmod 600 ~/.ssh/authorized_keys",
+        # the key is appended on its own line, even if the last line has no newline
+        f"{{ grep -qxF {key} ~/.ssh/authorized_keys || {{ "
+        '{ [ ! -s ~/.ssh/authorized_keys ] || [ -z "$(tail -c 1 ~/.ssh/authorized_keys)" ] || echo >> ~/.ssh/authorized_keys; } && '
+        f"printf '%s\\n' {key} >> ~/.ssh/authorized_keys; }}; }}",
+    ]
+    if revoked_public_key != None:
+        revoked_key = shlex.quote(revoked_public_key.strip())
+        steps += [
+            # grep exits with 1 when no line is left, which is not an error
+            f"{{ grep -vxF {revoked_key} ~/.ssh/authorized_keys > ~/.ssh/authorized_keys.tmp; [ $? -le 1 ]; }}",
+            "mv ~/.ssh/authorized_keys.tmp ~/.ssh/authorized_keys",
+        ]
+    return " && ".join(steps)
+
+
+# (host, port, user, credential fingerprint)
+PoolKey = tuple[str, int, str, str]
+
+# secret of the credential fingerprints, the passwords themselves are never kept
+_CREDENTIAL_SECRET = secrets.token_bytes(32)
+
+
+def get_credential_fingerprint(password: str | None) -> str:
+    return hmac.new(
+        _CREDENTIAL_SECRET, (password or "").encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+
+
+class SSHConnectionPool:
+    """
+    Pool of authenticated paramiko clients, keyed by (host, port, user) and by a
+    fingerprint of the password they were authenticated with.
+
+    Clients are handed out by `connection` and returned to the pool afterwards, so
+    repeated operations against the same host skip the handshake and authentication.
+    A client is only handed out for the credentials it was opened with, so wrong
+    credentials still fail against a warm pool. At most `max_per_host` clients exist
+    per key, idle clients are closed by `evict_idle` and open ones send keepalives.
+    """
+
+    def __init__(
+        self,
+        max_per_host: int = SSH_POOL_MAX_PER_HOST,
+        idle_seconds: float = SSH_POOL_IDLE_SECONDS,
+        keepalive_seconds: int = SSH_KEEPALIVE_SECONDS,
+        connect_timeout: float = SSH_CONNECT_TIMEOUT,
+    ):
+        self.max_per_host = max_per_host
+        self.idle_seconds = idle_seconds
+        self.keepalive_seconds = keepalive_seconds
+        self.connect_timeout = connect_timeout
+
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        # idle clients with the time they were returned, most recently used last
+        self._idle: dict[PoolKey, list[tuple[paramiko.SSHClient, float]]] = {}
+        # number of clients per key, idle and in use
+        self._opened: dict[PoolKey, int] = {}
+
+    @staticmethod
+    def _is_active(client: paramiko.SSHClient) -> bool:
+        transport = client.get_transport()
+        return transport != None and transport.is_active()
+
+    def _connect(
+        self, hostname: str, port: int, username: str, password: str | None
+    ) -> paramiko.SSHClient:
+        client = paramiko.SSHClient()
+        try:
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(
+                hostname=hostname,
+                username=username,
+                password=password,
+                port=port,
+                timeout=self.connect_timeout,
+            )
+            transport = client.get_transport()
+            if transport != None:
+                transport.set_keepalive(self.keepalive_seconds)
+        except BaseException:
+            client.close()
+            raise
+        logger.debug(f"Opened pooled SSH connection to {username}@{hostname}:{port}")
+        return client
+
+    def _acquire(self, key: PoolKey, password: str | None) -> paramiko.SSHClient:
+        deadline = time.monotonic() + self.connect_timeout
+        with self._lock:
+            while True:
+                idle = self._idle.get(key, [])
+                while idle:
+                    client, _ = idle.pop()
+                    if self._is_active(client):
+                        return client
+                    # the remote end has closed it while it was idle
+                    self._opened[key] -= 1
+                    client.close()
+
+                if self._opened.get(key, 0) < self.max_per_host:
+                    self._opened[key] = self._opened.get(key, 0) + 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._released.wait(remaining):
+                    raise paramiko.SSHException(
+                        f"No free SSH connection to {key[2]}@{key[0]}:{key[1]}, "
+                        f"{self.max_per_host} are in use"
+                    )
+
+        try:
+            return self._connect(key[0], key[1], key[2], password)
+        except BaseException:
+            with self._lock:
+                self._opened[key] -= 1
+                self._released.notify()
+            raise
+
+    def _release(self, key: PoolKey, client: paramiko.SSHClient, reuse: bool) -> None:
+        with self._lock:
+            if reuse and self._is_active(client):
+                self._idle.setdefault(key, []).append((client, time.monotonic()))
+                client = None
+            else:
+                self._opened[key] -= 1
+            self._released.notify()
+        if client != None:
+            client.close()
+
+    @contextmanager
+    def connection(
+        self,
+        hostname: str,
+        port: int = 22,
+        username: str = "root",
+        password: str | None = None,
+    ) -> Iterator[paramiko.SSHClient]:
+        """
+        Borrow a connected client for the host, opening one if none is idle.
+
+        Only clients opened with the same password are reused, the password is used
+        when a new connection has to be opened. Clients are discarded instead of
+        returned when an SSH or socket error escapes the block.
+        """
+
+        key = (hostname, port, username, get_credential_fingerprint(password))
+        client = self._acquire(key, password)
+        reuse = True
+        try:
+            yield client
+        except (paramiko.SSHException, OSError, EOFError):
+            reuse = False
+            raise
+        finally:
+            self._release(key, client, reuse)
+
+    def evict_idle(self) -> int:
+        """
+        Close the clients which have been idle longer than the idle timeout.
+
+        Returns the number of closed clients.
+        """
+
+        now = time.monotonic()
+        evicted: list[paramiko.SSHClient] = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                kept = []
+                for client, released_at in idle:
+                    if now - released_at > self.idle_seconds or not self._is_active(
+                        client
+                    ):
+                        evicted.append(client)
+                        self._opened[key] -= 1
+                    else:
+                        kept.append((client, released_at))
+                idle[:] = kept
+            if evicted:
+                self._released.notify_all()
+
+        for client in evicted:
+            client.close()
+        return len(evicted)
+
+    def close_all(self) -> None:
+        """
+        Close every idle client, clients in use are closed when they are returned.
+        """
+
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            for key, clients in idle.items():
+                self._opened[key] -= len(clients)
+            self._released.notify_all()
+
+        for clients in idle.values():
+            for client, _ in clients:
+                client.close()
+
+
+ssh_pool = SSHConnectionPool()
+
+_janitor_stop = threading.Event()
+_janitor_thread: threading.Thread | None = None
+
+
+def _janitor() -> None:
+    while not _janitor_stop.wait(JANITOR_INTERVAL_SECONDS):
+        try:
+            evicted = ssh_pool.evict_idle()
+            if evicted > 0:
+                logger.debug(f"{evicted} idle SSH connections are closed")
+        except Exception as e:
+            logger.error(f"SSH connection pool eviction failed: {e}")
+
+
+def start_ssh_pool_janitor() -> None:
+    """
+    Start the background thread which closes idle pooled connections periodically.
+    """
+
+    global _janitor_thread
+
+    if _janitor_thread != None and _janitor_thread.is_alive():
+        return
+
+    _janitor_stop.clear()
+    _janitor_thread = threading.Thread(
+        target=_janitor, name="ssh-pool-janitor", daemon=True
+    )
+    _janitor_thread.start()
+
+
+def stop_ssh_pool_janitor() -> None:
+    _janitor_stop.set()
+    ssh_pool.close_all()
@@ -0,0 +1,243 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+
+import multipart
+from fastapi import HTTPException, Request, status
+from multipart.multipart import parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+from ..schema import UploadProgress
+from .enum import UploadStatus
+from .metrics import upload_bytes, upload_throughput
+
+logger = logging.getLogger(__name__)
+
+# received file data is written to disk in chunks of at least this size
+UPLOAD_WRITE_CHUNK_BYTES = 1024 * 1024
+# progress of this many finished uploads is kept for late queries
+MAX_TRACKED_UPLOADS = 1000
+
+_uploads: OrderedDict[str, UploadProgress] = OrderedDict()
+_uploads_lock = threading.Lock()
+
+
+def track_upload(upload_id: str | None = None) -> UploadProgress:
+    """
+    Start tracking the progress of a new upload.
+    """
+
+    progress = UploadProgress(
+        upload_id=upload_id or str(uuid.uuid4()), status=UploadStatus.receiving
+    )
+    with _uploads_lock:
+        _uploads[progress.upload_id] = progress
+        while len(_uploads) > MAX_TRACKED_UPLOADS:
+            _uploads.popitem(last=False)
+    return progress
+
+
+def get_upload_progress(upload_id: str) -> UploadProgress | None:
+    with _uploads_lock:
+        return _uploads.get(upload_id)
+
+
+class MultipartFileReceiver:
+    """
+    Receive a single file field of a multipart request straight into a file on disk.
+
+    The request body is parsed while it arrives, so the file is written only once,
+    the size limit is enforced before the whole body is received and the progress
+    is updated on every chunk. Disk writes and hashing run in the threadpool.
+    """
+
+    def __init__(
+        self,
+        request: Request,
+        field_name: str,
+        dest_dir: str,
+        max_bytes: int,
+        progress: UploadProgress,
+    ):
+        self.request = request
+        self.field_name = field_name
+        self.dest_dir = dest_dir
+        self.max_bytes = max_bytes
+        self.progress = progress
+
+        self.filepath: str | None = None
+        self.sha256 = hashlib.sha256()
+        self._file = None
+        self._in_file_part = False
+        self._buffer = bytearray()
+        self._header_field = b""
+        self._header_value = b""
+        self._content_disposition = b""
+
+    def on_part_begin(self) -> None:
+        self._in_file_part = False
+        self._content_disposition = b""
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        if self._header_field.lower() == b"content-disposition":
+            self._content_disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._content_disposition)
+        if (
+            options.get(b"name", b"").decode("latin-1") == self.field_name
+            and b"filename" in options
+            and self.filepath == None
+        ):
+            filename = os.path.basename(options[b"filename"].decode("utf-8", "replace"))
+            if not filename:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Uploaded file has no name",
+                )
+            # concurrent uploads may share the same file name
+            self.filepath = os.path.join(
+                self.dest_dir, f"{uuid.uuid4().hex}-{filename}"
+            )
+            self.progress.filename = filename
+            self._in_file_part = True
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if not self._in_file_part:
+            return
+
+        self.progress.received_bytes += end - start
+        if self.progress.received_bytes > self.max_bytes:
+            err = f"Uploaded file exceeds the limit of {self.max_bytes} bytes"
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=err
+            )
+        self._buffer += data[start:end]
+
+    def on_part_end(self) -> None:
+        self._in_file_part = False
+
+    def _write(self, data: bytes) -> None:
+        if self._file == None:
+            self._file = open(str(self.filepath), "wb")
+        self._file.write(data)
+        self.sha256.update(data)
+
+    async def _flush(self, force: bool = False) -> None:
+        if len(self._buffer) == 0 or (
+            not force and len(self._buffer) < UPLOAD_WRITE_CHUNK_BYTES
+        ):
+            return
+        data, self._buffer = bytes(self._buffer), bytearray()
+        await run_in_threadpool(self._write, data)
+
+    async def receive(self) -> str:
+        """
+        Receive the file and return its path.
+        """
+
+        content_type, params = parse_options_header(
+            self.request.headers.get("content-type", "")
+        )
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Request body must be multipart/form-data",
+            )
+
+        content_length = self.request.headers.get("content-length")
+        if content_length != None and content_length.isdigit():
+            self.progress.total_bytes = int(content_length)
+
+        parser = multipart.MultipartParser(
+            params[b"boundary"],
+            {
+                "on_part_begin": self.on_part_begin,
+                "on_part_data": self.on_part_data,
+                "on_part_end": self.on_part_end,
+                "on_header_field": self.on_header_field,
+                "on_header_value": self.on_header_value,
+                "on_header_end": self.on_header_end,
+                "on_headers_finished": self.on_headers_finished,
+            },
+        )
+
+        started_at = time.monotonic()
+        try:
+            async for chunk in self.request.stream():
+                parser.write(chunk)
+                await self._flush()
+                elapsed = time.monotonic() - started_at
+                if elapsed > 0:
+                    self.progress.bytes_per_second = (
+                        self.progress.received_bytes / elapsed
+                    )
+            parser.finalize()
+            await self._flush(force=True)
+            elapsed = time.monotonic() - started_at
+            if elapsed > 0:
+                upload_throughput.observe(self.progress.received_bytes / elapsed)
+            upload_bytes.inc(self.progress.received_bytes)
+        except BaseException:
+            self._close()
+            if self.filepath != None and os.path.exists(self.filepath):
+                os.remove(self.filepath)
+            raise
+        self._close()
+
+        if self.filepath == None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Request has no file field named {self.field_name}",
+            )
+        if self._file == None:
+            # empty file, nothing was written
+            open(self.filepath, "wb").close()
+        return self.filepath
+
+    def _close(self) -> None:
+        if self._file != None:
+            self._file.close()
+
+
+def extract_zip(zippath: str, dest_dir: str) -> None:
+    """
+    Extract the zip file into the given directory member by member.
+
+    Members which would be written outside of the destination directory are rejected.
+    """
+
+    dest_dir = os.path.realpath(dest_dir)
+    try:
+        with zipfile.ZipFile(zippath, "r") as zip_ref:
+            for member in zip_ref.infolist():
+                target = os.path.realpath(os.path.join(dest_dir, member.filename))
+                if os.path.commonpath([dest_dir, target]) != dest_dir:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f"Zip member {member.filename} points outside of the upload directory",
+                    )
+                if member.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with zip_ref.open(member) as source, open(target, "wb") as dest:
+                    shutil.copyfileobj(source, dest, UPLOAD_WRITE_CHUNK_BYTES)
+    except zipfile.BadZipFile as e:
+        err = f"Uploaded file is not a valid zip file: {e}"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
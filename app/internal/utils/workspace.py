@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from ...definitions import (
+    ANSIBLE_RUN_MAX_AGE_SECONDS,
+    ANSIBLE_RUN_MAX_RETAINED,
+    ANSIBLE_RUN_RETENTION_SECONDS,
+    ANSIBLE_RUNS_DIR,
+)
+
+logger = logging.getLogger(__name__)
+
+# marker file which tells the janitor that nothing is using the workspace anymore
+FINISHED_MARKER = ".finished"
+# interval between two cleanups of the finished run workspaces
+JANITOR_INTERVAL_SECONDS = 60
+
+_janitor_stop = threading.Event()
+_janitor_thread: threading.Thread | None = None
+
+
+def get_run_workspace(run_id: str) -> str:
+    """
+    Return the private data directory of the given run, it may not exist.
+    """
+
+    return os.path.join(ANSIBLE_RUNS_DIR, os.path.basename(run_id))
+
+
+def create_run_workspace(run_id: str | None = None) -> tuple[str, str]:
+    """
+    Create a unique private data directory for a single ansible-runner run.
+
+    Returns the run id and the directory. The run id should also be used as the
+    runner ident, so the artifacts of the run end up in a predictable location.
+    """
+
+    if run_id == None:
+        run_id = str(uuid.uuid4())
+
+    path = get_run_workspace(run_id)
+    os.makedirs(path, exist_ok=False)
+    return run_id, path
+
+
+def release_run_workspace(run_id: str, retain: bool = True) -> None:
+    """
+    Mark the workspace of the run as finished.
+
+    Retained workspaces are removed later by the janitor according to the retention
+    policy, the others are removed in the background right away.
+    """
+
+    path = get_run_workspace(run_id)
+    if not retain:
+        threading.Thread(
+            target=shutil.rmtree,
+            args=(path,),
+            kwargs={"ignore_errors": True},
+            daemon=True,
+        ).start()
+        return
+
+    try:
+        with open(os.path.join(path, FINISHED_MARKER), "w"):
+            # intentionally left blank
+            pass
+    except OSError as e:
+        logger.warning(f"Failed to mark run workspace {path} as finished: {e}")
+
+
+def get_run_events(run_id: str, event: str | None = None) -> list[dict] | None:
+    """
+    Return the events of a run from its artifact directory, ordered by counter.
+
+    Returns None if the artifacts of the run do not exist (anymore).
+    """
+
+    events_dir = os.path.join(
+        get_run_workspace(run_id), "artifacts", os.path.basename(run_id), "job_events"
+    )
+    if not os.path.isdir(events_dir):
+        return None
+
+    events = []
+    for filename in os.listdir(events_dir):
+        # partial files are still being written by the runner
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(events_dir, filename), "r") as event_file:
+                data = json.load(event_file)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Failed to read event {filename} of run {run_id}: {e}")
+            continue
+        if event == None or data.get("event") == event:
+            events.append(data)
+
+    events.sort(key=lambda data: data.get("counter", 0))
+    return events
+
+
+def cleanup_run_workspaces() -> int:
+    """
+    Remove finished run workspaces which are out of the retention policy.
+
+    Workspaces which were never marked as finished, e.g. of jobs dropped at shutdown
+    or of runs cut off by a crash, are removed once they are older than the maximum
+    age of a run. Returns the number of removed workspaces.
+    """
+
+    if not os.path.isdir(ANSIBLE_RUNS_DIR):
+        return 0
+
+    finished = []
+    abandoned = []
+    abandoned_deadline = time.time() - ANSIBLE_RUN_MAX_AGE_SECONDS
+    for run_id in os.listdir(ANSIBLE_RUNS_DIR):
+        path = get_run_workspace(run_id)
+        try:
+            finished.append(
+                (os.path.getmtime(os.path.join(path, FINISHED_MARKER)), run_id)
+            )
+            continue
+        except OSError:
+            # either still running, abandoned or not a workspace at all
+            pass
+        try:
+            if os.path.isdir(path) and os.path.getmtime(path) < abandoned_deadline:
+                abandoned.append(run_id)
+        except OSError:
+            continue
+
+    finished.sort(reverse=True)
+    deadline = time.time() - ANSIBLE_RUN_RETENTION_SECONDS
+    expired = [
+        run_id
+        for i, (finished_at, run_id) in enumerate(finished)
+        if finished_at < deadline or i >= ANSIBLE_RUN_MAX_RETAINED
+    ]
+
+    for run_id in expired + abandoned:
+        shutil.rmtree(get_run_workspace(run_id), ignore_errors=True)
+
+    if expired:
+        logger.info(f"Removed {len(expired)} expired run workspaces")
+    if abandoned:
+        logger.warning(f"Removed {len(abandoned)} run workspaces never finished")
+    return len(expired) + len(abandoned)
+
+
+def _janitor() -> None:
+    while not _janitor_stop.wait(JANITOR_INTERVAL_SECONDS):
+        try:
+            cleanup_run_workspaces()
+        except Exception as e:
+            logger.error(f"Run workspace cleanup failed: {e}")
+
+
+def start_run_workspace_janitor() -> None:
+    """
+    Start the background thread which applies the retention policy periodically.
+    """
+
+    global _janitor_thread
+
+    if _janitor_thread != None and _janitor_thread.is_alive():
+        return
+
+    os.makedirs(ANSIBLE_RUNS_DIR, exist_ok=True)
+    _janitor_stop.clear()
+    _janitor_thread = threading.Thread(
+        target=_janitor, name="run-workspace-janitor", daemon=True
+    )
+    _janitor_thread.start()
+
+
+def stop_run_workspace_janitor() -> None:
+    _janitor_stop.set()
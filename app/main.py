@@ -1,34 +1,110 @@
 import logging
 import os
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 from typing import Annotated
 
 import ansible_runner
-from fastapi import Depends, FastAPI, HTTPException, Path, status
+from fastapi import Body, Depends, FastAPI, HTTPException, Path, status
+from fastapi.responses import PlainTextResponse
 
-from .definitions import ANSIBLE_INVENTORY_DIR, ANSIBLE_PLAYBOOK_DIR
-from .internal.schema import Status
-from .internal.sql import crud
+from .ansible.inventory.dynamic_inventory import get_flower_inventory_from_database
+from .definitions import ANSIBLE_MAX_FORKS, ANSIBLE_PLAYBOOK_DIR, ANSIBLE_VERBOSITY
+from .internal.schema import HostTargets, PingResult, Status
+from .internal.sql import crud, models
+from .internal.sql.database import SesssionLocal
+from .internal.utils.build import start_build_workers, stop_build_workers
 from .internal.utils.enum import StatusType
-from .routers import database, ssh
+from .internal.utils.events import RunEventPublisher
+from .internal.utils.job import shutdown_ansible_jobs
+from .internal.utils.log import configure_logging, log_context
+from .internal.utils.metrics import (
+    METRICS_CONTENT_TYPE,
+    MetricsMiddleware,
+    ansible_run_duration,
+    metrics_registry,
+)
+from .internal.utils.ssh import start_ssh_pool_janitor, stop_ssh_pool_janitor
+from .internal.utils.workspace import (
+    create_run_workspace,
+    release_run_workspace,
+    start_run_workspace_janitor,
+    stop_run_workspace_janitor,
+)
+from .routers import database, job, ssh
 from .routers.docker import docker, upload
 
-logging.basicConfig(
-    filename="uvicorn.log",
-    filemode="a",
-    format="%(asctime)s:%(levelname)s:%(message)s",
-    datefmt="%m/%d/%Y %I:%M:%S %p",
-    level=logging.DEBUG,
-)
+logger = logging.getLogger(__name__)
 
-logging.info("Starting a fresh uvicorn!")
+configure_logging()
+
+logger.info("Starting a fresh uvicorn!")
 
 app = FastAPI(debug=True)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(ssh.router)
 app.include_router(database.router)
 app.include_router(docker.router)
 app.include_router(upload.router)
+app.include_router(job.router)
+
+
+@app.on_event("startup")
+def start_run_workspace_cleanup():
+    start_run_workspace_janitor()
+
+
+@app.on_event("startup")
+def migrate_docker_states():
+    db = SesssionLocal()
+    try:
+        count = crud.migrate_remote_host_docker_states(db=db)
+        if count > 0:
+            logger.info(f"Docker states of {count} hosts are migrated to task states")
+    finally:
+        db.close()
+
+
+@app.on_event("startup")
+def start_ssh_connection_pool():
+    start_ssh_pool_janitor()
+
+
+@app.on_event("startup")
+def fail_interrupted_jobs():
+    db = SesssionLocal()
+    try:
+        count = crud.fail_unfinished_ansible_jobs(db=db)
+        if count > 0:
+            logger.warning(f"{count} unfinished ansible jobs are marked as failed")
+        count = crud.fail_unfinished_docker_image_builds(db=db)
+        if count > 0:
+            logger.warning(f"{count} unfinished docker builds are marked as failed")
+    finally:
+        db.close()
+
+
+@app.on_event("startup")
+async def start_docker_build_workers():
+    start_build_workers()
+
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    shutdown_ansible_jobs()
+    stop_run_workspace_janitor()
+    stop_ssh_pool_janitor()
+    await stop_build_workers()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Metrics of the service in the Prometheus text format.
+    """
+
+    return PlainTextResponse(metrics_registry.expose(), media_type=METRICS_CONTENT_TYPE)
+
 
 @app.get("/ping/{ip_address}")
 def ping(ip_address: Annotated[str, Path()], db=Depends(database.get_db)):
@@ -39,43 +115,141 @@ def ping(ip_address: Annotated[str, Path()], db=Depends(database.get_db)):
     """
 
 
-    host = crud.get_remote_host_by_ip_address(db=db, ip_address=ip_address)
+    host = crud.get_cached_remote_host_by_ip_address(db=db, ip_address=ip_address)
     if host == None:
         err = f"Remote host with ip address {ip_address} not found in database"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
-    inventory_path = os.path.join(
-        ANSIBLE_INVENTORY_DIR, str(host.fl_identifier), f"{host.fl_identifier}.yaml"
+    inventory = get_flower_inventory_from_database(
+        db=db, fl_identifier=str(host.fl_identifier)
     )
-    if not os.path.exists(inventory_path):
-        err = f"Inventory file for {host.fl_identifier} not found at {inventory_path}"
-        logging.error(err)
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
-    tmp_path = os.path.join(ANSIBLE_INVENTORY_DIR, "ping-tmp")
-    if os.path.exists(tmp_path):
-        shutil.rmtree(tmp_path, ignore_errors=True)
-    os.makedirs(os.path.join(ANSIBLE_INVENTORY_DIR, "ping-tmp"), exist_ok=True)
+    run_id, private_data_dir = create_run_workspace()
 
     runner_config = {
-        "private_data_dir": tmp_path,
-        "inventory": inventory_path,
+        "private_data_dir": private_data_dir,
+        "ident": run_id,
+        "inventory": inventory,
         "playbook": os.path.join(ANSIBLE_PLAYBOOK_DIR, "ping.yaml"),
-        "verbosity": 2,
+        "verbosity": ANSIBLE_VERBOSITY,
         "limit": str(host.host_pattern),
     }
-    runner = ansible_runner.run(**runner_config)
-    logging.info(runner.status)
+    try:
+        with RunEventPublisher(
+            run_id=run_id, fl_identifier=str(host.fl_identifier), playbook="ping.yaml"
+        ) as publisher:
+            with log_context(run_id=run_id), ansible_run_duration.time(
+                playbook="ping.yaml"
+            ):
+                runner = ansible_runner.run(**runner_config, event_handler=publisher)
+            publisher.finish(runner.status)
+    finally:
+        release_run_workspace(run_id, retain=False)
+
+    logger.info(runner.status)
     if runner.status == "failed":
         err = f"Ansible runner failed with status {runner.status}"
-        logging.error(err)
-        if os.path.exists(tmp_path):
-            shutil.rmtree(tmp_path, ignore_errors=True)
+        logger.error(err)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
         )
     else:
-        if os.path.exists(tmp_path):
-            shutil.rmtree(tmp_path, ignore_errors=True)
         return Status(status=StatusType.success, description="Ping successful!")
+
+
+def ping_inventory(
+    fl_identifier: str, inventory: dict, hosts: list[models.RemoteHost], forks: int
+) -> list[PingResult]:
+    """
+    Ping the given hosts of a single inventory with one ansible-runner process.
+    """
+
+    hosts_by_pattern = {str(host.host_pattern): host for host in hosts}
+    results: dict[str, PingResult] = {}
+
+    def ping_event_handler(data: dict):
+        if data["event"] not in (
+            "runner_on_ok",
+            "runner_on_failed",
+            "runner_on_unreachable",
+        ):
+            return True
+
+        event_data = data.get("event_data", {})
+        host = hosts_by_pattern.get(event_data.get("host"))
+        if host == None:
+            return True
+
+        reachable = data["event"] == "runner_on_ok"
+        results[str(host.host_pattern)] = PingResult(
+            ip_address=str(host.ip_address),
+            fl_identifier=fl_identifier,
+            reachable=reachable,
+            latency=event_data.get("duration") if reachable else None,
+            description=None if reachable else event_data.get("res", {}).get("msg"),
+        )
+        return True
+
+    run_id, private_data_dir = create_run_workspace()
+    try:
+        with RunEventPublisher(
+            run_id=run_id,
+            fl_identifier=fl_identifier,
+            handler=ping_event_handler,
+            playbook="ping.yaml",
+        ) as publisher:
+            with log_context(run_id=run_id), ansible_run_duration.time(
+                playbook="ping.yaml"
+            ):
+                runner = ansible_runner.run(
+                    private_data_dir=private_data_dir,
+                    ident=run_id,
+                    inventory=inventory,
+                    playbook=os.path.join(ANSIBLE_PLAYBOOK_DIR, "ping.yaml"),
+                    limit=":".join(hosts_by_pattern.keys()),
+                    forks=forks,
+                    quiet=True,
+                    event_handler=publisher,
+                )
+            publisher.finish(runner.status)
+        logger.info(f"Pinging {fl_identifier} finished with status {runner.status}")
+    finally:
+        release_run_workspace(run_id, retain=False)
+
+    return [
+        results.get(
+            pattern,
+            PingResult(
+                ip_address=str(host.ip_address),
+                fl_identifier=fl_identifier,
+                reachable=False,
+                description="No ping result received from the host",
+            ),
+        )
+        for pattern, host in hosts_by_pattern.items()
+    ]
+
+
+@app.post("/ping", response_model=list[PingResult])
+def ping_hosts(targets: Annotated[HostTargets, Body()], db=Depends(database.get_db)):
+    """
+    Ping many remote hosts at once, either a whole federation or a list of IP addresses.
+
+    Hosts are pinged with one ansible-runner process per inventory, and inventories are pinged in parallel.
+    """
+
+    groups = database.get_target_hosts_by_fl_identifier(db=db, targets=targets)
+
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        futures = [
+            executor.submit(
+                ping_inventory,
+                fl_identifier,
+                get_flower_inventory_from_database(db=db, fl_identifier=fl_identifier),
+                hosts,
+                targets.forks or min(len(hosts), ANSIBLE_MAX_FORKS),
+            )
+            for fl_identifier, hosts in groups.items()
+        ]
+        return [result for future in futures for result in future.result()]
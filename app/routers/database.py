@@ -1,19 +1,31 @@
 import logging
 from typing import Annotated, Any
 
-from fastapi import APIRouter, Depends, HTTPException, Path, status
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Response, status
 from sqlalchemy.orm import Session
 
+from app.internal.schema import HostCacheStats, HostTargets
 from app.internal.sql import crud, models
+from app.internal.sql.cache import host_cache
 from app.internal.sql.database import SesssionLocal, engine
+from app.internal.utils.enum import FlowerType, InstallationStatus
 from app.internal.utils.validator import validate_ip_address
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(
     prefix="/remote-hosts",
     tags=["remote-hosts"],
 )
 
+MAX_REMOTE_HOSTS_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
 models.Base.metadata.create_all(bind=engine)
+# create_all skips indexes which are added to an already existing table
+for table in models.Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
 
 
 # Dependency
@@ -29,17 +41,96 @@ def get_db():
         db.close()
 
 
+def get_target_hosts_by_fl_identifier(
+    db: Session, targets: HostTargets
+) -> dict[str, list[models.RemoteHost]]:
+    """
+    Resolve the hosts of a bulk request, grouped by their FL identifier.
+
+    Every group shares one inventory file, so it can be handled by a single ansible run.
+    """
+
+    if targets.fl_identifier == None and not targets.ip_addresses:
+        err = "Either fl_identifier or ip_addresses must be given"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
+
+    if targets.forks != None and targets.forks < 1:
+        err = f"Invalid forks: {targets.forks}, it must be a positive number"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
+
+    if targets.ip_addresses:
+        invalid = [ip for ip in targets.ip_addresses if not validate_ip_address(ip)]
+        if invalid:
+            err = f"Invalid IP addresses: {', '.join(invalid)}"
+            logger.error(err)
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
+
+        hosts = crud.get_remote_hosts_by_ip_addresses(
+            db=db, ip_addresses=targets.ip_addresses
+        )
+        missing = set(targets.ip_addresses) - {str(host.ip_address) for host in hosts}
+        if missing:
+            err = f"Remote hosts not found in database: {', '.join(sorted(missing))}"
+            logger.error(err)
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+
+        if targets.fl_identifier != None:
+            hosts = [h for h in hosts if h.fl_identifier == targets.fl_identifier]
+    else:
+        hosts = crud.get_remote_hosts_by_fl_identifier(
+            db=db, fl_identifier=str(targets.fl_identifier)
+        )
+
+    if len(hosts) == 0:
+        err = "No hosts found for the given targets"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+
+    groups: dict[str, list[models.RemoteHost]] = {}
+    for host in hosts:
+        groups.setdefault(str(host.fl_identifier), []).append(host)
+    return groups
+
+
 @router.get("")
-def get_remote_hosts(db: Session = Depends(get_db)) -> Any:
+def get_remote_hosts(
+    response: Response,
+    after: int | None = Query(None),
+    limit: int = Query(100, ge=1, le=MAX_REMOTE_HOSTS_PAGE_SIZE),
+    fl_identifier: str | None = Query(None),
+    flower_type: FlowerType | None = Query(None),
+    contact_info: str | None = Query(None),
+    docker_state: InstallationStatus | None = Query(None),
+    db: Session = Depends(get_db),
+) -> Any:
     """
-    Get all remote hosts.
+    Get remote hosts page by page, ordered by id.
+
+    If there are more hosts, the cursor of the next page is returned in the
+    X-Next-Cursor header, pass it as `after` to get the next page. `docker_state` filters
+    by the state of the final docker installation task, which checks the docker command.
     """
 
-    hosts = crud.get_remote_hosts(db=db, skip=0, limit=100)
+    # one extra host tells whether there is a next page
+    hosts = crud.get_remote_hosts(
+        db=db,
+        after=after,
+        limit=limit + 1,
+        fl_identifier=fl_identifier,
+        flower_type=flower_type,
+        contact_info=contact_info,
+        docker_state=docker_state,
+    )
     if len(hosts) == 0:
         err = "No hosts found"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+
+    if len(hosts) > limit:
+        hosts = hosts[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = str(hosts[-1].id)
     return [
         {
             "fl_identifier": host.fl_identifier,
@@ -51,6 +142,15 @@ def get_remote_hosts(db: Session = Depends(get_db)) -> Any:
     ]
 
 
+@router.get("/cache/stats", response_model=HostCacheStats)
+def get_host_cache_stats() -> Any:
+    """
+    Get the hit, miss and eviction counters of the remote host lookup cache.
+    """
+
+    return host_cache.stats()
+
+
 @router.get("/{ip_address}")
 def get_remote_host_by_ip_address(
     ip_address: Annotated[str, Path(max_length=40)], db: Session = Depends(get_db)
@@ -61,13 +161,13 @@ def get_remote_host_by_ip_address(
 
     if not validate_ip_address(ip_address):
         err = f"Invalid IP address: {ip_address}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
 
-    host = crud.get_remote_host_by_ip_address(ip_address=ip_address, db=db)
+    host = crud.get_cached_remote_host_by_ip_address(ip_address=ip_address, db=db)
     if host == None:
         err = f"Host with IP address {ip_address} not found"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
     return {
         "fl_identifier": host.fl_identifier,
@@ -85,11 +185,11 @@ def get_remote_hosts_by_contact_info(
     Get a list of remote hosts with the given contact info.
     """
 
-    logging.info(f"Getting remote hosts with contact info {contact_info}")
+    logger.info(f"Getting remote hosts with contact info {contact_info}")
     hosts = crud.get_remote_hosts_by_contact_info(db=db, contact_info=contact_info)
     if len(hosts) == 0:
         err = f"No hosts found with contact info {contact_info}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
     return [
         {
@@ -109,10 +209,12 @@ def get_remote_host_by_fl_identifier(
     Get a remote hosts with the given FL identifier.
     """
 
-    hosts = crud.get_remote_hosts_by_fl_identifier(db=db, fl_identifier=fl_identifier)
+    hosts = crud.get_cached_remote_hosts_by_fl_identifier(
+        db=db, fl_identifier=fl_identifier
+    )
     if len(hosts) == 0:
         err = f"No hosts found with FL identifier {fl_identifier}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
     return [
         {
@@ -1,18 +1,31 @@
 import logging
 import os
-import shutil
+import threading
+import time
 from typing import Annotated, Any
 
-import ansible_runner
-from fastapi import APIRouter, Depends, HTTPException, Path, status
+from fastapi import APIRouter, Body, Depends, HTTPException, Path, Query, status
 from sqlalchemy.orm import Session
 
-from ...definitions import ANSIBLE_INVENTORY_DIR, ANSIBLE_PLAYBOOK_DIR
-from ...internal.schema import Status
-from ...internal.sql import crud
-from ...internal.utils.enum import InstallationStatus, StatusType
+from ...ansible.inventory.dynamic_inventory import get_flower_inventory_from_database
+from ...definitions import (
+    ANSIBLE_MAX_FORKS,
+    ANSIBLE_PLAYBOOK_DIR,
+    ANSIBLE_VERBOSITY,
+    DOCKER_STATE_FLUSH_INTERVAL,
+)
+from ...internal.schema import AnsibleJob, HostTargets, RemoteHostTaskState
+from ...internal.sql import crud, models
+from ...internal.utils.enum import (
+    DOCKER_INSTALLATION_NAME,
+    DOCKER_INSTALLATION_PLAYBOOK,
+    InstallationStatus,
+)
+from ...internal.utils.job import submit_ansible_job
 from ...internal.utils.validator import validate_ip_address
-from ...routers.database import get_db
+from ...routers.database import get_db, get_target_hosts_by_fl_identifier
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/docker",
@@ -20,166 +33,248 @@ router = APIRouter(
 )
 
 
+@router.get("/states", response_model=list[RemoteHostTaskState])
+def docker_task_states(
+    task: DOCKER_INSTALLATION_NAME = Query(...),
+    task_status: InstallationStatus | None = Query(None, alias="status"),
+    db: Session = Depends(get_db),
+) -> Any:
+    """
+    Get the hosts whose docker installation task is in the given state, e.g. the hosts
+    which failed a task.
+    """
+
+    return [
+        RemoteHostTaskState(
+            ip_address=remote_host.ip_address,
+            fl_identifier=remote_host.fl_identifier,
+            playbook=task_state.playbook,
+            task=task_state.task,
+            status=task_state.status,
+            updated_at=task_state.updated_at,
+        )
+        for task_state, remote_host in crud.get_remote_host_task_states(
+            db=db,
+            playbook=DOCKER_INSTALLATION_PLAYBOOK,
+            task=task,
+            task_status=task_status,
+        )
+    ]
+
+
 @router.get("/states/{ip_address}")
 def docker_states(ip_address: Annotated[str, Path()], db: Session = Depends(get_db)):
-    logging.info(f"Validating ip address {ip_address}...")
+    logger.info(f"Validating ip address {ip_address}...")
     if not validate_ip_address(ip_address):
         err = f"IP address {ip_address} is not valid"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
 
     return crud.get_remote_host_docker_state(db=db, ip_address=ip_address)
 
 
-def closure_docker_installation_event_handler(
-    ip_address: str, db: Session = Depends(get_db)
-):
-    def docker_installation_event_handler(data: dict):
-        if (
-            "event_data" in data
-            and "task" in data["event_data"]
-            and data["event_data"]["task"] == "Gathering Facts"
-        ):
-            return
+# runner events which finish a task on a host, mapped to the stored task state
+DOCKER_INSTALLATION_EVENT_STATES = {
+    "runner_on_ok": InstallationStatus.ok,
+    "runner_on_failed": InstallationStatus.failed,
+    "runner_on_unreachable": InstallationStatus.unreachable,
+    "runner_on_skipped": InstallationStatus.skipped,
+}
 
-        match data["event"]:
-            case "playbook_on_task_start":
-                logging.info("playbook_on_task_start")
-            case "runner_on_start":
-                logging.info("runner_on_start")
-            case "runner_on_ok":
-                logging.info("runner_on_ok")
-                info = f"Task {data['event_data']['task']} completed successfully..."
-                logging.info(info)
-                info = f"Updating database..."
-                logging.info(info)
-
-                crud.update_remote_host_docker_state_by_ip_address(
-                    db=db,
-                    ip_address=ip_address,
-                    updated_docker_state={
-                        str(data["event_data"]["task"]): InstallationStatus.ok
-                    },
-                )
+DOCKER_INSTALLATION_TASKS = {task.value for task in DOCKER_INSTALLATION_NAME}
 
-                info = f"Database updated..."
-                logging.info(info)
 
-            case "runner_on_failed":
-                logging.info("runner_on_failed")
-                info = f"Task {data['event_data']['task']} is failed..."
-                logging.info(info)
+class DockerInstallationEventSink:
+    """
+    Ansible event handler which buffers docker installation task states and writes
+    them to the database in bulk.
 
-                info = f"Updating database..."
-                logging.info(info)
+    Buffered states are flushed once the flush interval has passed since the last
+    flush, at the end of the playbook and when `flush` is called explicitly.
+    """
 
-                crud.update_remote_host_docker_state_by_ip_address(
-                    db=db,
-                    ip_address=ip_address,
-                    updated_docker_state={
-                        str(data["event_data"]["task"]): InstallationStatus.failed
-                    },
+    def __init__(
+        self,
+        db: Session,
+        ip_addresses_by_pattern: dict[str, str],
+        flush_interval: float = DOCKER_STATE_FLUSH_INTERVAL,
+    ):
+        """
+        :param db: the database session owned by the run
+        :param ip_addresses_by_pattern: ip addresses of the targeted hosts, keyed by their inventory host pattern
+        :param flush_interval: minimum number of seconds between two flushes
+        """
+
+        self.db = db
+        self.flush_interval = flush_interval
+        # resolved once per run instead of once per event
+        host_ids = crud.get_remote_host_ids(
+            db=db, ip_addresses=list(ip_addresses_by_pattern.values())
+        )
+        self.host_ids: dict[str, int] = {}
+        for host_pattern, ip_address in ip_addresses_by_pattern.items():
+            if ip_address not in host_ids:
+                # deleted since the run was queued, its events are ignored
+                logger.warning(
+                    f"Remote host {ip_address} not found, its states are not recorded"
                 )
+                continue
+            self.host_ids[host_pattern] = host_ids[ip_address]
+
+        self._lock = threading.Lock()
+        self._pending: dict[int, dict[str, InstallationStatus]] = {}
+        self._last_flush = time.monotonic()
+
+    def __call__(self, data: dict) -> bool:
+        event = data.get("event")
+        if event == "playbook_on_stats":
+            self.flush()
+            return True
+
+        state = DOCKER_INSTALLATION_EVENT_STATES.get(event)
+        event_data = data.get("event_data", {})
+        task = event_data.get("task")
+        if state == None or task not in DOCKER_INSTALLATION_TASKS:
+            return True
+
+        # events carry the inventory host name, which is the host pattern
+        host_id = self.host_ids.get(event_data.get("host"))
+        if host_id == None:
+            logger.warning(f"Event of unknown host {event_data.get('host')} ignored")
+            return True
+
+        # called for every event, the message is only built if debug is enabled
+        logger.debug("Task %s finished with state %s", task, state.value)
+        with self._lock:
+            self._pending.setdefault(host_id, {})[task] = state
+
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+        return True
 
-                info = f"Database updated..."
-                logging.info(info)
+    def flush(self) -> None:
+        """
+        Write the buffered task states to the database in a single transaction.
 
-            case "runner_on_unreachable":
-                logging.info("runner_on_unreachable)")
-                info = f"Task {data['event_data']['task']} is unreachable..."
-                logging.info(info)
+        It runs in the event handler of the run, a failed write is logged and its
+        states are dropped instead of aborting the run.
+        """
 
-                info = f"Updating database..."
-                logging.info(info)
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
 
-                crud.update_remote_host_docker_state_by_ip_address(
-                    db=db,
-                    ip_address=ip_address,
-                    updated_docker_state={
-                        str(data["event_data"]["task"]): InstallationStatus.unreachable
-                    },
-                )
+        if not pending:
+            return
+        try:
+            crud.update_remote_host_task_states(
+                db=self.db,
+                playbook=DOCKER_INSTALLATION_PLAYBOOK,
+                updated_task_states=pending,
+            )
+        except HTTPException as e:
+            logger.error(f"Docker states of {len(pending)} hosts are lost: {e.detail}")
+            return
+        except Exception:
+            logger.exception(f"Docker states of {len(pending)} hosts are lost")
+            return
+        logger.info(f"Docker states of {len(pending)} hosts are updated")
 
-                info = f"Database updated..."
-                logging.info(info)
 
-            case "runner_on_skipped":
-                logging.info("runner_on_skipped")
-                info = f"Task {data['event_data']['task']} is skipped..."
-                logging.info(info)
+def closure_docker_installation_event_handler(
+    ip_addresses_by_pattern: dict[str, str], db: Session = Depends(get_db)
+) -> DockerInstallationEventSink:
+    return DockerInstallationEventSink(
+        db=db, ip_addresses_by_pattern=ip_addresses_by_pattern
+    )
 
-                info = f"Updating database..."
-                logging.info(info)
 
-                crud.update_remote_host_docker_state_by_ip_address(
-                    db=db,
-                    ip_address=ip_address,
-                    updated_docker_state={
-                        str(data["event_data"]["task"]): InstallationStatus.skipped
-                    },
-                )
+def submit_docker_installation_job(
+    db: Session, fl_identifier: str, hosts: list[models.RemoteHost], forks: int
+) -> models.AnsibleJob:
+    """
+    Queue one docker installation run for the given hosts of a single inventory.
+    """
 
-                info = f"Database updated..."
-                logging.info(info)
-        return True
+    inventory = get_flower_inventory_from_database(db=db, fl_identifier=fl_identifier)
+
+    ip_addresses_by_pattern = {
+        str(host.host_pattern): str(host.ip_address) for host in hosts
+    }
+    runner_config = {
+        "inventory": inventory,
+        "playbook": os.path.join(ANSIBLE_PLAYBOOK_DIR, DOCKER_INSTALLATION_PLAYBOOK),
+        "verbosity": ANSIBLE_VERBOSITY,
+        "limit": ":".join(ip_addresses_by_pattern.keys()),
+        "forks": forks,
+    }
+
+    return submit_ansible_job(
+        db=db,
+        playbook=DOCKER_INSTALLATION_PLAYBOOK,
+        fl_identifier=fl_identifier,
+        runner_config=runner_config,
+        event_handler_factory=lambda job_db: closure_docker_installation_event_handler(
+            ip_addresses_by_pattern, db=job_db
+        ),
+    )
+
+
+@router.post(
+    "/install",
+    response_model=list[AnsibleJob],
+    status_code=status.HTTP_202_ACCEPTED,
+)
+def install_docker_on_hosts(
+    targets: Annotated[HostTargets, Body()], db: Session = Depends(get_db)
+) -> Any:
+    """
+    Install Docker on many remote hosts, either a whole federation or a list of IP addresses.
 
-    return docker_installation_event_handler
+    One background job is started per inventory, targeting all of its given hosts in a single run.
+    """
+
+    groups = get_target_hosts_by_fl_identifier(db=db, targets=targets)
+    return [
+        submit_docker_installation_job(
+            db=db,
+            fl_identifier=fl_identifier,
+            hosts=hosts,
+            forks=targets.forks or min(len(hosts), ANSIBLE_MAX_FORKS),
+        )
+        for fl_identifier, hosts in groups.items()
+    ]
 
 
-@router.post("/install/{ip_address}")
+@router.post(
+    "/install/{ip_address}",
+    response_model=AnsibleJob,
+    status_code=status.HTTP_202_ACCEPTED,
+)
 def install_docker(
     ip_address: Annotated[str, Path()], db: Session = Depends(get_db)
 ) -> Any:
     """
     Install Docker on the remote host. The hostmachine is needed to be registered in the database first.
+
+    The installation runs in the background, the returned job can be polled through `/jobs/{job_id}`.
     """
 
-    logging.info(f"Validating ip address {ip_address}...{os.linesep}")
+    logger.info(f"Validating ip address {ip_address}...{os.linesep}")
     if not validate_ip_address(ip_address):
         err = f"IP address {ip_address} is not valid"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
 
-    logging.info(
+    logger.info(
         f"Checking if remote host with ip address {ip_address} exists in database..."
     )
     host = crud.get_remote_host_by_ip_address(db=db, ip_address=ip_address)
     if host == None:
         err = f"Remote host with ip address {ip_address} not found in database"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
-    logging.info(
-        f"Checking if inventory directory for remote host with ip address {ip_address} exists..."
+    return submit_docker_installation_job(
+        db=db, fl_identifier=str(host.fl_identifier), hosts=[host], forks=1
     )
-    inventory_path = os.path.join(ANSIBLE_INVENTORY_DIR, str(host.fl_identifier))
-    if not os.path.exists(inventory_path):
-        err = f"Inventory directory for remote host with ip address {ip_address} not found"
-        logging.error(err)
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
-
-    tmp_path = os.path.join(inventory_path, "tmp")
-    if os.path.exists(tmp_path):
-        shutil.rmtree(tmp_path)
-    os.makedirs(os.path.join(inventory_path, "tmp"), exist_ok=True)
-
-    handler = closure_docker_installation_event_handler(str(host.ip_address), db=db)
-    runner_config = {
-        "private_data_dir": os.path.join(inventory_path, "tmp"),
-        "inventory": os.path.join(inventory_path, f"{host.fl_identifier}.yaml"),
-        "playbook": os.path.join(ANSIBLE_PLAYBOOK_DIR, "docker_ubuntu_focal.yaml"),
-        "verbosity": 4,
-        "limit": str(host.host_pattern),
-        "event_handler": handler,
-    }
-
-    runner = ansible_runner.run(**runner_config)
-    if runner.status == "successful":
-        return Status(
-            status=StatusType.success, description="Ansible playbook run successfully"
-        )
-    else:
-        err = "Ansible docker installation playbook failed!"
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
-        )
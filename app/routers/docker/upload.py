@@ -1,29 +1,71 @@
+import hashlib
 import logging
 import os
-import shutil
-import subprocess
-import zipfile
-import string
 import random
-from typing import Annotated
+import re
+import string
+from typing import Annotated, Any
 
 import ansible_runner
 import yaml
-from fastapi import (APIRouter, Depends, File, HTTPException, Path, UploadFile,
-                     status)
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    status,
+)
+from fastapi.responses import PlainTextResponse
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 from app.routers.docker.docker import router
 
-from ...definitions import ANSIBLE_INVENTORY_DIR
-from ...internal.schema import Status
-from ...internal.sql import crud
-from ...internal.utils.enum import StatusType
+from ...ansible.inventory.dynamic_inventory import (
+    FLOWER_CLIENTS_GROUP,
+    FLOWER_SERVER_GROUP,
+    get_flower_inventory_from_database,
+)
+from ...definitions import (
+    ANSIBLE_INVENTORY_DIR,
+    ANSIBLE_MAX_FORKS,
+    ANSIBLE_VERBOSITY,
+    IMAGE_ARCHIVE_REMOTE_DIR,
+    IMAGE_REGISTRY,
+    MAX_UPLOAD_BYTES,
+)
+from ...internal.schema import (
+    AnsibleJob,
+    CachedRemoteHost,
+    DockerImageBuild,
+    FleetDeployment,
+    Status,
+    UploadProgress,
+)
+from ...internal.sql import crud, models
+from ...internal.utils.ansible import dump_yaml, load_yaml_file
+from ...internal.utils.build import queue_build, read_build_log
+from ...internal.utils.bundle import BUNDLE_INCOMING_DIR, store_bundle
+from ...internal.utils.enum import BuildStatus, StatusType, UploadStatus
+from ...internal.utils.events import RunEventPublisher
+from ...internal.utils.image import get_deployment_image, get_image_archive
+from ...internal.utils.job import submit_ansible_job
+from ...internal.utils.log import log_context
+from ...internal.utils.metrics import ansible_run_duration
+from ...internal.utils.upload import (
+    MultipartFileReceiver,
+    extract_zip,
+    get_upload_progress,
+    track_upload,
+)
 from ...internal.utils.validator import validate_ip_address
+from ...internal.utils.workspace import create_run_workspace, release_run_workspace
 from ...routers.database import get_db
 
-# Have in mind that this means that the whole contents will be stored in memory.
-# This will work well for small files.
+logger = logging.getLogger(__name__)
 
 # take ip address
 # source files which will be deployed
@@ -37,44 +79,234 @@ router = APIRouter(
     tags=["docker"],
 )
 
+SUPPORTED_ARCHS = ("amd64", "arm64")
+# builds the image for every supported architecture in a single upload
+MULTI_ARCH = "multi"
+# values of the ansible_architecture fact, per docker architecture
+ANSIBLE_ARCHITECTURES = {
+    "amd64": ("x86_64", "amd64"),
+    "arm64": ("aarch64", "arm64"),
+}
+# image of a host in a deployment of several architectures, see get_ansible_images
+ANSIBLE_IMAGE_EXPRESSION = "{{ images[ansible_architecture] }}"
+ANSIBLE_IMAGE_ARCHIVE_EXPRESSION = "{{ image_archives[ansible_architecture] }}"
+# name of fleet deployment jobs, their playbook is generated for every deployment
+FLEET_DEPLOYMENT_PLAYBOOK = "fleet_deployment"
+# container options of the deployments
+DEPLOYMENT_ASYNC_SECONDS = 600
+DEPLOYMENT_POLL_SECONDS = 5
+
+# Copy the archive of the image, see get_image_archive, to the hosts which don't have
+# the image. The copy is skipped if the archive on the host has the same checksum.
+IMAGE_ARCHIVE_TASKS = [
+    {
+        "name": "Check the image on the host",
+        "community.docker.docker_image_info": {"name": "{{ image_archive.name }}"},
+        "register": "image_archive_info",
+    },
+    {
+        "name": "Check the image archive on the host",
+        "ansible.builtin.stat": {
+            "path": "{{ image_archive.dest }}",
+            "get_checksum": True,
+            "checksum_algorithm": "sha256",
+        },
+        "register": "image_archive_stat",
+        "when": "image_archive_info.images | length == 0",
+    },
+    {
+        "name": "Copy the image archive to the host",
+        "block": [
+            {
+                "name": "Create the image archive directory",
+                "ansible.builtin.file": {
+                    "path": IMAGE_ARCHIVE_REMOTE_DIR,
+                    "state": "directory",
+                    "mode": "0755",
+                },
+            },
+            {
+                "name": "Copy the image archive",
+                "ansible.builtin.copy": {
+                    "src": "{{ image_archive.src }}",
+                    "dest": "{{ image_archive.dest }}",
+                    "mode": "0644",
+                },
+            },
+        ],
+        "when": [
+            "image_archive_info.images | length == 0",
+            "not image_archive_stat.stat.exists or image_archive_stat.stat.checksum != image_archive.checksum",
+        ],
+    },
+    {
+        "name": "Load the image archive",
+        "community.docker.docker_image": {
+            "name": "{{ image_archive.name }}",
+            "source": "load",
+            "load_path": "{{ image_archive.dest }}",
+        },
+        "when": "image_archive_info.images | length == 0",
+    },
+]
+
+
+def get_ansible_images(images_by_arch: dict[str, str]) -> dict[str, str]:
+    """
+    Map every ansible_architecture fact value to the image built for it.
+    """
+
+    return {
+        ansible_arch: arch_image
+        for arch, arch_image in images_by_arch.items()
+        for ansible_arch in ANSIBLE_ARCHITECTURES[arch]
+    }
+
 
 # Assumes that there is a definition.yaml in the given zip file which includes
 # entrypoint command string and datadir in it.
 # entrypoint will be used in the dockerfile but the datadir will be mount in the ansible docker playbook.
 
 
+def generate_deployment_play(
+    name: str,
+    hosts: str,
+    image: str,
+    sourcedir: str,
+    targetdir: str,
+    container_name: str,
+    images_by_arch: dict[str, str] | None = None,
+) -> dict:
+    """
+    Generate a play which runs the container of the given image on the hosts.
+
+    Without an image registry, the exported archive of the image is copied to the
+    hosts which don't have the image yet, and loaded there before.
+    """
+
+    play: dict = {"name": name, "hosts": hosts, "become": True, "vars": {}}
+    # with images of several architectures, each host picks its own one from its facts
+    if images_by_arch and len(images_by_arch) > 1:
+        ansible_images = get_ansible_images(images_by_arch)
+        play["vars"]["images"] = {
+            ansible_arch: get_deployment_image(arch_image)
+            for ansible_arch, arch_image in ansible_images.items()
+        }
+        play["vars"]["image"] = ANSIBLE_IMAGE_EXPRESSION
+        archives = {
+            ansible_arch: get_image_archive(arch_image)
+            for ansible_arch, arch_image in ansible_images.items()
+        }
+        if IMAGE_REGISTRY == None and None not in archives.values():
+            play["vars"]["image_archives"] = archives
+            play["vars"]["image_archive"] = ANSIBLE_IMAGE_ARCHIVE_EXPRESSION
+    else:
+        play["vars"]["image"] = get_deployment_image(image)
+        archive = get_image_archive(image)
+        if IMAGE_REGISTRY == None and archive != None:
+            play["vars"]["image_archive"] = archive
+
+    play["tasks"] = []
+    if "image_archive" in play["vars"]:
+        play["tasks"] += IMAGE_ARCHIVE_TASKS
+    elif IMAGE_REGISTRY == None:
+        logger.warning(f"Image {image} is not exported, hosts must have it already")
+
+    play["tasks"].append(
+        {
+            "name": "Run the container of the given docker image",
+            "community.docker.docker_container": {
+                "name": container_name,
+                "image": "{{ image }}",
+                "network_mode": "host",
+                "mounts": [
+                    {
+                        "type": "bind",
+                        "read_only": True,
+                        "source": sourcedir,
+                        "target": targetdir,
+                    }
+                ],
+            },
+            "async": DEPLOYMENT_ASYNC_SECONDS,
+            "poll": DEPLOYMENT_POLL_SECONDS,
+        }
+    )
+    return play
+
+
 def generate_deployment_ansible_playbook(
-        dest: str, image: str, sourcedir: str, targetdir: str, container_name: str
+    dest: str,
+    image: str,
+    sourcedir: str,
+    targetdir: str,
+    container_name: str,
+    images_by_arch: dict[str, str] | None = None,
 ):
-    content = f"""- name: Deploy given docker image
-  hosts: all
-  become: yes
-
-  tasks:
-  - name: 
-    community.docker.docker_container:
-      name: {container_name}
-      image: {image}
-      network_mode: host
-      mounts:
-        - type: "bind"
-          read_only: true
-          source: {sourcedir}
-          target: {targetdir}
-    async: 600
-    poll: 5
-"""
-    logging.info(f"Creating ansible playbook in {sourcedir}...")
+    play = generate_deployment_play(
+        "Deploy given docker image",
+        "all",
+        image,
+        sourcedir,
+        targetdir,
+        container_name,
+        images_by_arch=images_by_arch,
+    )
+    logger.info(f"Creating ansible playbook in {sourcedir}...")
     try:
         with open(os.path.join(dest, "deployment.yaml"), "w") as file:
-            file.write(content)
-    except (IOError, OSError) as e:
+            dump_yaml([play], file)
+    except (IOError, OSError, yaml.YAMLError) as e:
         err = f"Failed to create ansible playbook in {dest}, {e}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
 
-def generate_dockerfile_pytorch(entrypoint: str, sourcedir: str):
+def generate_fleet_deployment_plays(
+    image: str,
+    sourcedir: str,
+    targetdir: str,
+    container_name: str,
+    images_by_arch: dict[str, str] | None = None,
+    serial: int | str | None = None,
+    max_fail_percentage: int | None = None,
+) -> list[dict]:
+    """
+    Generate the plays which deploy the given image to the server of a federation
+    and then to its clients, in batches of `serial` clients.
+
+    The server play stops the whole run if it fails, clients are not deployed
+    without their server.
+    """
+
+    server_play = generate_deployment_play(
+        "Deploy to the flower server",
+        FLOWER_SERVER_GROUP,
+        image,
+        sourcedir,
+        targetdir,
+        container_name,
+        images_by_arch=images_by_arch,
+    )
+    server_play["any_errors_fatal"] = True
+
+    clients_play = generate_deployment_play(
+        "Deploy to the flower clients",
+        FLOWER_CLIENTS_GROUP,
+        image,
+        sourcedir,
+        targetdir,
+        container_name,
+        images_by_arch=images_by_arch,
+    )
+    if serial != None:
+        clients_play["serial"] = serial
+    if max_fail_percentage != None:
+        clients_play["max_fail_percentage"] = max_fail_percentage
+    return [server_play, clients_play]
+
+
+def generate_dockerfile_pytorch(entrypoint: str, sourcedir: str) -> str:
     content = f"""#syntax=docker/dockerfile:1
 FROM pytorch/pytorch:2.0.1-cuda11.7-cudnn8-runtime
 
@@ -96,172 +328,427 @@ RUN if [ -e requirements.txt ]; then pip install -r requirements.txt; \
 
 ENTRYPOINT {entrypoint}"""
 
-    logging.info(f"Creating dockerfile in {sourcedir}...")
+    dockerfile = os.path.join(sourcedir, "dockerfile")
     try:
-        with open(os.path.join(sourcedir, "dockerfile"), "w") as file:
+        # stored bundles are shared, an identical dockerfile may be in use by a build
+        if os.path.exists(dockerfile):
+            with open(dockerfile, "r") as file:
+                if file.read() == content:
+                    return content
+
+        logger.info(f"Creating dockerfile in {sourcedir}...")
+        with open(dockerfile, "w") as file:
             file.write(content)
     except (IOError, OSError) as e:
         err = f"Failed to create dockerfile, {e}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+    return content
+
+
+@router.get("/uploads/{upload_id}", response_model=UploadProgress)
+def get_upload(upload_id: Annotated[str, Path()]):
+    """
+    Get the progress of a source files upload.
+    """
+
+    progress = get_upload_progress(upload_id)
+    if progress == None:
+        err = f"Upload {upload_id} not found"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+    return progress
+
+
+@router.get("/builds/{build_id}", response_model=DockerImageBuild)
+def get_build(build_id: Annotated[int, Path()], db: Session = Depends(get_db)):
+    """
+    Get a docker image build.
+    """
+
+    build = crud.get_docker_image_build_by_id(db=db, build_id=build_id)
+    if build == None:
+        err = f"Build {build_id} not found"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+    return build
+
+
+@router.get("/builds/{build_id}/logs", response_class=PlainTextResponse)
+def get_build_logs(
+    build_id: Annotated[int, Path()],
+    tail: int | None = Query(None, ge=1),
+    db: Session = Depends(get_db),
+):
+    """
+    Get the captured output of a docker image build.
 
+    tail: Only return the last lines of the output.
+    """
+
+    if crud.get_docker_image_build_by_id(db=db, build_id=build_id) == None:
+        err = f"Build {build_id} not found"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
-@router.post("/upload-source-files/{ip_address}/{platform}/{arch}/")
+    log = read_build_log(build_id=build_id, tail=tail)
+    if log == None:
+        err = f"Build {build_id} has no logs yet"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+    return log
+
+
+@router.post(
+    "/upload-source-files/{ip_address}/{platform}/{arch}/",
+    response_model=list[DockerImageBuild],
+    status_code=status.HTTP_202_ACCEPTED,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": ["file"],
+                        "properties": {
+                            "file": {
+                                "type": "string",
+                                "format": "binary",
+                                "description": "Zip file which includes project source code",
+                            }
+                        },
+                    }
+                }
+            },
+        }
+    },
+)
 async def create_upload_file(
+    request: Request,
     ip_address: Annotated[str, Path()],
     platform: Annotated[str, Path()],
-    arch: Annotated[str, Path()],
-    file: UploadFile = File(description="Zip file which includes project source code"),
+    arch: Annotated[str, Path(description="amd64, arm64 or multi for both")],
+    upload_id: str | None = Query(None, max_length=64),
     db: Session = Depends(get_db),
 ):
-    logging.info(f"Validating ip address {ip_address}...")
+    """
+    Upload a zip file of the project source code, then build a docker image out of it.
+
+    Uploads are stored by content hash, an upload identical to a previous one reuses its
+    extracted sources and, for the same platform and architecture, its image.
+
+    The image is built in the background, the returned builds can be polled through
+    `/docker/builds/{build_id}`. With the `multi` architecture the image is built for
+    every supported architecture concurrently out of the same extracted sources, one
+    build per architecture, and each host deploys the image of its own architecture.
+
+    The zip file is streamed to disk while it is received. Its progress can be followed
+    through `/docker/uploads/{upload_id}`, with an upload_id chosen by the client.
+    """
+
+    logger.info(f"Validating ip address {ip_address}...")
     if not validate_ip_address(ip_address):
         err = f"IP address {ip_address} is not valid"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
 
-    logging.info(
+    logger.info(
         f"Checking if remote host with ip address {ip_address} exists in database..."
     )
 
-    host = crud.get_remote_host_by_ip_address(db=db, ip_address=ip_address)
+    host = await run_in_threadpool(
+        crud.get_cached_remote_host_by_ip_address, db=db, ip_address=ip_address
+    )
     if host == None:
         err = f"Remote host with ip address {ip_address} not found in database"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
+    if arch == MULTI_ARCH:
+        archs = list(SUPPORTED_ARCHS)
+    elif arch in SUPPORTED_ARCHS:
+        archs = [arch]
+    else:
+        err = f"Architecture {arch} is not supported, use one of {', '.join(SUPPORTED_ARCHS + (MULTI_ARCH,))}"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
+
     upload_dir = os.path.join(ANSIBLE_INVENTORY_DIR, host.fl_identifier, "source")
     # Create the upload directory if it doesn't exist
-    if not os.path.exists(upload_dir):
-        os.makedirs(upload_dir)
+    os.makedirs(upload_dir, exist_ok=True)
+    os.makedirs(BUNDLE_INCOMING_DIR, exist_ok=True)
+
+    progress = track_upload(upload_id)
+    try:
+        receiver = MultipartFileReceiver(
+            request=request,
+            field_name="file",
+            dest_dir=BUNDLE_INCOMING_DIR,
+            max_bytes=MAX_UPLOAD_BYTES,
+            progress=progress,
+        )
+        zipsource = await receiver.receive()
+        bundle_hash = receiver.sha256.hexdigest()
+
+        # extract the zip into the bundle store, unless the same content is there
+        progress.status = UploadStatus.extracting
+        bundle_dir, _ = await run_in_threadpool(store_bundle, zipsource, bundle_hash)
+    except HTTPException as e:
+        progress.status = UploadStatus.failed
+        progress.description = e.detail
+        logger.error(e.detail)
+        raise e
+    progress.status = UploadStatus.completed
+    logger.info(f"Upload {progress.upload_id} is stored as bundle {bundle_hash}")
+
+    # the database and the files are only touched in the threadpool, the loop keeps
+    # serving the other requests meanwhile. The builds are queued here, on the loop.
+    builds, build_commands = await run_in_threadpool(
+        prepare_bundle_builds,
+        db=db,
+        bundle_dir=bundle_dir,
+        bundle_hash=bundle_hash,
+        upload_dir=upload_dir,
+        platform=platform,
+        archs=archs,
+    )
+    for build_command in build_commands:
+        queue_build(**build_command)
+    return builds
+
+
+def prepare_bundle_builds(
+    db: Session,
+    bundle_dir: str,
+    bundle_hash: str,
+    upload_dir: str,
+    platform: str,
+    archs: list[str],
+) -> tuple[list[DockerImageBuild], list[dict[str, Any]]]:
+    """
+    Record the image builds of a stored bundle and write its deployment files.
+
+    Returns the builds, and the arguments of queue_build for those which have to run.
+    Blocks on the database and the disk, it is run in the threadpool.
+    """
+
+    bundle_definition = os.path.join(bundle_dir, "definition.yaml")
+    entrypoint, image_name, sourcedir, targetdir = read_source_definition(
+        bundle_definition
+    )
+    dockerfile = generate_dockerfile_pytorch(entrypoint, bundle_dir)
+    dockerfile_hash = hashlib.sha256(dockerfile.encode("utf-8")).hexdigest()
+    logger.info(f"Successfully created dockerfile in {bundle_dir}")
+
+    # every architecture is queued on its own, so the builds run concurrently on the
+    # build workers. They share the extracted bundle as their build context.
+    builds = []
+    build_commands = []
+    for build_arch in archs:
+        build, build_command = queue_bundle_build(
+            db=db,
+            bundle_dir=bundle_dir,
+            bundle_hash=bundle_hash,
+            platform=platform,
+            arch=build_arch,
+            dockerfile_hash=dockerfile_hash,
+            image_name=image_name,
+            # the plain image name can only point to a single architecture
+            tag_image_name=len(archs) == 1,
+        )
+        builds.append(DockerImageBuild.from_orm(build))
+        if build_command != None:
+            build_commands.append(build_command)
+    images_by_arch = {build.arch: build.image_name for build in builds}
+
+    # deployment only needs the definition, the sources stay in the bundle store.
+    # The content addressed tags keep pointing to these builds even when the image
+    # name of the definition is reused by a different bundle.
+    write_source_definition(
+        bundle_definition,
+        os.path.join(upload_dir, "definition.yaml"),
+        images_by_arch=images_by_arch,
+    )
+    generate_deployment_ansible_playbook(
+        upload_dir,
+        builds[0].image_name,
+        sourcedir,
+        targetdir,
+        "".join(random.choices(string.ascii_uppercase + string.digits, k=5)),
+        images_by_arch=images_by_arch,
+    )
+    return builds, build_commands
+
+
+def queue_bundle_build(
+    db: Session,
+    bundle_dir: str,
+    bundle_hash: str,
+    platform: str,
+    arch: str,
+    dockerfile_hash: str,
+    image_name: str,
+    tag_image_name: bool = True,
+) -> tuple[models.DockerImageBuild, dict[str, Any] | None]:
+    """
+    Record the image build of the bundle for a single architecture.
+
+    An image already built, or being built, out of the same bundle and dockerfile for
+    the same platform and architecture is reused instead. Returns the build, and the
+    arguments of queue_build if it was recorded as a new build which has to run.
+    """
+
+    build_key = {
+        "bundle_hash": bundle_hash,
+        "platform": platform,
+        "arch": arch,
+        "dockerfile_hash": dockerfile_hash,
+    }
+    build = crud.get_docker_image_build(db=db, **build_key)
+    if build != None and build.status != BuildStatus.failed:
+        logger.info(f"Reusing image {build.image_name} of build {build.id}")
+        return build, None
 
-    # destination of the new zip file in the server filesystem
-    zipsource = os.path.join(upload_dir, file.filename)
-    with open(zipsource, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    build, queued = crud.queue_docker_image_build(
+        db=db, image_name=get_build_image_tag(image_name, build_key), **build_key
+    )
+    if not queued:
+        return build, None
 
-    # extract the zip to the regarding host directory
-    with zipfile.ZipFile(zipsource, "r") as zip_ref:
-        zip_ref.extractall(upload_dir)
+    tags = (
+        [image_name, str(build.image_name)]
+        if tag_image_name
+        else [str(build.image_name)]
+    )
+    command = ["docker", "buildx", "build", "--load", "--platform", f"linux/{arch}"]
+    for tag in tags:
+        command += ["--tag", tag]
+    return build, {
+        "build_id": int(build.id),
+        "context_dir": bundle_dir,
+        "command": command + ["."],
+        "image_name": str(build.image_name),
+    }
 
-    os.remove(os.path.join(upload_dir, file.filename))
 
-    defyaml = os.path.join(upload_dir, "definition.yaml")
-    image_name = ""
-    sourcedir = ""
-    targetdir = ""
+def get_build_image_tag(image_name: str, build_key: dict) -> str:
+    """
+    Return a content addressed tag for the image name, derived from the build key.
+    """
+
+    repository = image_name
+    if ":" in image_name.rsplit("/", 1)[-1]:
+        repository = image_name.rsplit(":", 1)[0]
+
+    digest = hashlib.sha256(
+        "\0".join(str(build_key[key]) for key in sorted(build_key)).encode("utf-8")
+    ).hexdigest()
+    return f"{repository}:{digest[:12]}"
+
+
+def read_source_definition(defyaml: str) -> tuple[str, str, str, str]:
+    """
+    Read definition.yaml of a source bundle.
+
+    Returns the dockerfile entrypoint, the image name, the data source directory on
+    the remote host and its mount target in the container.
+    """
+
     try:
-        with open(defyaml, "r") as yaml_file:
-            content = yaml.safe_load(yaml_file)
-            cmds = [f'"{i}"' for i in content["entrypoint"]]
-            cmdstr = ""
-            for i, cmd in enumerate(cmds):
-                if i == 0:
-                    cmdstr += f"[{cmd}, "
-                elif i == len(cmds) - 1:
-                    cmdstr += f"{cmd}]"
-                else:
-                    cmdstr += f"{cmd}, "
-
-            generate_dockerfile_pytorch(cmdstr, upload_dir)
-            image_name = content["image_name"]
-            sourcedir = content["sourcedir"]
-            targetdir = content["targetdir"]
-            logging.info(f"Successfully created dockerfile in {upload_dir}")
+        content = load_yaml_file(defyaml)
+        cmds = [f'"{i}"' for i in content["entrypoint"]]
+        cmdstr = ""
+        for i, cmd in enumerate(cmds):
+            if i == 0:
+                cmdstr += f"[{cmd}, "
+            elif i == len(cmds) - 1:
+                cmdstr += f"{cmd}]"
+            else:
+                cmdstr += f"{cmd}, "
+
+        return (
+            cmdstr,
+            content["image_name"],
+            content["sourcedir"],
+            content["targetdir"],
+        )
 
     except (yaml.YAMLError, OSError) as e:
         err = f"Failed to read {defyaml} as a yaml file, {e}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
-    logging.info("Starting to build an image in server host")
-
-    match arch:
-        case "amd64":
-            command = [
-                "docker",
-                "buildx",
-                "build",
-                "--load",
-                "--platform",
-                "linux/amd64",
-                "--tag",
-                image_name,
-                ".",
-            ]
-            p = subprocess.Popen(command, cwd=upload_dir)
-            p.wait()
-        case "arm64":
-            command = [
-                "docker",
-                "buildx",
-                "build",
-                "--load",
-                "--platform",
-                "linux/arm64",
-                "--tag",
-                image_name,
-                ".",
-            ]
-            p = subprocess.Popen(command, cwd=upload_dir)
-            p.wait()
-
-    logging.info("Docker image is successfully built in server host")
-    
-    generate_deployment_ansible_playbook(upload_dir, image_name, sourcedir, targetdir, ''.join(random.choices(string.ascii_uppercase +
-                             string.digits, k=5)))
 
+def write_source_definition(
+    source: str, dest: str, images_by_arch: dict[str, str]
+) -> None:
+    """
+    Copy definition.yaml of a source bundle with the built images of each architecture.
+
+    The image name is replaced by the first image, for readers of a single image.
+    """
 
-def change_container_name(upload_dir: str):
-    defyaml = os.path.join(upload_dir, "definition.yaml")
-    image_name = ""
-    sourcedir = ""
-    targetdir = ""
     try:
-        with open(defyaml, "r") as yaml_file:
-            content = yaml.safe_load(yaml_file)
-            cmds = [f'"{i}"' for i in content["entrypoint"]]
-            cmdstr = ""
-            for i, cmd in enumerate(cmds):
-                if i == 0:
-                    cmdstr += f"[{cmd}, "
-                elif i == len(cmds) - 1:
-                    cmdstr += f"{cmd}]"
-                else:
-                    cmdstr += f"{cmd}, "
-
-            generate_dockerfile_pytorch(cmdstr, upload_dir)
-            image_name = content["image_name"]
-            sourcedir = content["sourcedir"]
-            targetdir = content["targetdir"]
-            logging.info(f"Successfully created dockerfile in {upload_dir}")
+        content = load_yaml_file(source)
+        content["image_name"] = next(iter(images_by_arch.values()))
+        content["images"] = images_by_arch
+        with open(dest, "w") as yaml_file:
+            dump_yaml(content, yaml_file)
+    except (yaml.YAMLError, OSError) as e:
+        err = f"Failed to copy {source} to {dest}, {e}"
+        logger.error(err)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
+        )
+
 
+def read_source_images(defyaml: str) -> dict[str, str]:
+    """
+    Read the built images of each architecture from a copied definition.yaml.
+    """
+
+    try:
+        return load_yaml_file(defyaml).get("images") or {}
     except (yaml.YAMLError, OSError) as e:
         err = f"Failed to read {defyaml} as a yaml file, {e}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
-    generate_deployment_ansible_playbook(upload_dir, image_name, sourcedir, targetdir, ''.join(random.choices(string.ascii_uppercase +
-                             string.digits, k=8)))
+
+def change_container_name(upload_dir: str):
+    defyaml = os.path.join(upload_dir, "definition.yaml")
+    _, image_name, sourcedir, targetdir = read_source_definition(defyaml)
+
+    generate_deployment_ansible_playbook(
+        upload_dir,
+        image_name,
+        sourcedir,
+        targetdir,
+        "".join(random.choices(string.ascii_uppercase + string.digits, k=8)),
+        images_by_arch=read_source_images(defyaml),
+    )
 
 
+def prepare_host_deployment(
+    db: Session, ip_address: str
+) -> tuple[CachedRemoteHost, str, dict[str, Any]]:
+    """
+    Regenerate the deployment playbook of the host with a new container name and
+    create the workspace of its run. Returns the host, the run id and the runner
+    configuration.
 
-@router.post("/deploy/{ip_address}/")
-async def deploy(ip_address: Annotated[str, Path()], db: Session = Depends(get_db)):
-    logging.info(f"Validating ip address {ip_address}...")
-    if not validate_ip_address(ip_address):
-        err = f"IP address {ip_address} is not valid"
-        logging.error(err)
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
+    Blocks on the database and the disk, it is run in the threadpool.
+    """
 
-    logging.info(
+    logger.info(
         f"Checking if remote host with ip address {ip_address} exists in database..."
     )
 
-    host = crud.get_remote_host_by_ip_address(db=db, ip_address=ip_address)
+    host = crud.get_cached_remote_host_by_ip_address(db=db, ip_address=ip_address)
     if host == None:
         err = f"Remote host with ip address {ip_address} not found in database"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
     dplfile = os.path.join(
@@ -271,32 +758,60 @@ async def deploy(ip_address: Annotated[str, Path()], db: Session = Depends(get_d
     # Create the upload directory if it doesn't exist
     if not os.path.exists(dplfile):
         err = f"Deployment file {dplfile} not found"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
 
     upload_dir = os.path.join(ANSIBLE_INVENTORY_DIR, host.fl_identifier, "source")
     change_container_name(upload_dir)
 
-    inventory_path = os.path.join(ANSIBLE_INVENTORY_DIR, str(host.fl_identifier))
-    if not os.path.exists(inventory_path):
-        err = f"Inventory directory for remote host with ip address {ip_address} not found"
-        logging.error(err)
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+    inventory = get_flower_inventory_from_database(
+        db=db, fl_identifier=str(host.fl_identifier)
+    )
 
-    tmp_path = os.path.join(inventory_path, "tmp")
-    if os.path.exists(tmp_path):
-        shutil.rmtree(tmp_path)
-    os.makedirs(os.path.join(inventory_path, "tmp"), exist_ok=True)
+    run_id, private_data_dir = create_run_workspace()
 
     runner_config = {
-        "private_data_dir": os.path.join(inventory_path, "tmp"),
-        "inventory": os.path.join(inventory_path, f"{host.fl_identifier}.yaml"),
+        "private_data_dir": private_data_dir,
+        "ident": run_id,
+        "inventory": inventory,
         "playbook": dplfile,
-        "verbosity": 4,
+        "verbosity": ANSIBLE_VERBOSITY,
         "limit": str(host.host_pattern),
     }
+    return host, run_id, runner_config
+
+
+@router.post("/deploy/{ip_address}/")
+async def deploy(ip_address: Annotated[str, Path()], db: Session = Depends(get_db)):
+    logger.info(f"Validating ip address {ip_address}...")
+    if not validate_ip_address(ip_address):
+        err = f"IP address {ip_address} is not valid"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
+
+    # the database and the files are only touched in the threadpool, the loop keeps
+    # serving meanwhile, e.g. the event streams of other runs
+    host, run_id, runner_config = await run_in_threadpool(
+        prepare_host_deployment, db=db, ip_address=ip_address
+    )
+
+    try:
+        with RunEventPublisher(
+            run_id=run_id,
+            fl_identifier=str(host.fl_identifier),
+            playbook="deployment.yaml",
+        ) as publisher:
+            # the loop keeps serving, e.g. the event streams of this run
+            with log_context(run_id=run_id), ansible_run_duration.time(
+                playbook="deployment.yaml"
+            ):
+                runner = await run_in_threadpool(
+                    ansible_runner.run, **runner_config, event_handler=publisher
+                )
+            publisher.finish(runner.status)
+    finally:
+        await run_in_threadpool(release_run_workspace, run_id)
 
-    runner = ansible_runner.run(**runner_config)
     if runner.status == "successful":
         return Status(
             status=StatusType.success, description="Ansible playbook run successfully"
@@ -306,3 +821,90 @@ async def deploy(ip_address: Annotated[str, Path()], db: Session = Depends(get_d
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err
         )
+
+
+@router.post(
+    "/deploy/fl-identifier/{fl_identifier}",
+    response_model=AnsibleJob,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+def deploy_federation(
+    fl_identifier: Annotated[str, Path()],
+    deployment: FleetDeployment | None = Body(None),
+    db: Session = Depends(get_db),
+) -> Any:
+    """
+    Deploy the uploaded image to a whole federation in a single run, its server first
+    and then its clients in rolling batches.
+
+    The deployment runs in the background, the outcome of every host can be polled
+    through `/jobs/{job_id}/hosts`.
+    """
+
+    if deployment == None:
+        deployment = FleetDeployment()
+
+    if isinstance(deployment.serial, str) and not re.fullmatch(
+        r"[1-9][0-9]?%|100%", deployment.serial
+    ):
+        err = (
+            f"Invalid serial: {deployment.serial}, it must be a number or a percentage"
+        )
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
+
+    if isinstance(deployment.serial, int) and deployment.serial < 1:
+        err = f"Invalid serial: {deployment.serial}, it must be a positive number"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
+
+    if deployment.max_fail_percentage != None and not (
+        0 <= deployment.max_fail_percentage <= 100
+    ):
+        err = f"Invalid max_fail_percentage: {deployment.max_fail_percentage}, it must be between 0 and 100"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
+
+    if deployment.forks != None and deployment.forks < 1:
+        err = f"Invalid forks: {deployment.forks}, it must be a positive number"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
+
+    # also fails with 404 if the federation has no hosts
+    inventory = get_flower_inventory_from_database(db=db, fl_identifier=fl_identifier)
+
+    defyaml = os.path.join(
+        ANSIBLE_INVENTORY_DIR, fl_identifier, "source", "definition.yaml"
+    )
+    if not os.path.exists(defyaml):
+        err = f"Source files of {fl_identifier} not found, they must be uploaded first"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+
+    _, image_name, sourcedir, targetdir = read_source_definition(defyaml)
+    plays = generate_fleet_deployment_plays(
+        image=image_name,
+        sourcedir=sourcedir,
+        targetdir=targetdir,
+        container_name="".join(
+            random.choices(string.ascii_uppercase + string.digits, k=8)
+        ),
+        images_by_arch=read_source_images(defyaml),
+        serial=deployment.serial,
+        max_fail_percentage=deployment.max_fail_percentage,
+    )
+
+    clients = inventory["all"]["children"][FLOWER_CLIENTS_GROUP]["hosts"]
+    runner_config = {
+        "inventory": inventory,
+        "playbook": plays,
+        "verbosity": ANSIBLE_VERBOSITY,
+        "forks": deployment.forks or max(1, min(len(clients), ANSIBLE_MAX_FORKS)),
+    }
+
+    return submit_ansible_job(
+        db=db,
+        playbook=FLEET_DEPLOYMENT_PLAYBOOK,
+        fl_identifier=fl_identifier,
+        runner_config=runner_config,
+    )
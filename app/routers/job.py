@@ -0,0 +1,269 @@
+import asyncio
+import json
+import logging
+from typing import Annotated, Any
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Path, Query, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.internal.schema import AnsibleJob, JobHostOutcome
+from app.internal.sql import crud
+from app.internal.sql.database import SesssionLocal
+from app.internal.utils.enum import JobStatus
+from app.internal.utils.events import (
+    RUN_FINISHED_EVENT,
+    EventChannel,
+    event_broker,
+    get_federation_topic,
+    to_live_event,
+)
+from app.internal.utils.job import summarize_host_outcomes
+from app.internal.utils.workspace import get_run_events
+from app.routers.database import get_db
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["jobs"],
+)
+
+# interval between two status checks of a streamed job
+JOB_STREAM_POLL_INTERVAL = 1.0
+# idle event streams get a keepalive this often
+EVENT_STREAM_KEEPALIVE_INTERVAL = 15.0
+
+UNFINISHED_JOB_STATUSES = (JobStatus.pending, JobStatus.running)
+
+
+@router.get("", response_model=list[AnsibleJob])
+def get_jobs(
+    fl_identifier: str | None = Query(None),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db),
+) -> Any:
+    """
+    Get ansible jobs, most recent first.
+    """
+
+    return crud.get_ansible_jobs(
+        db=db, fl_identifier=fl_identifier, skip=skip, limit=limit
+    )
+
+
+@router.get("/{job_id}", response_model=AnsibleJob)
+def get_job(job_id: Annotated[str, Path()], db: Session = Depends(get_db)) -> Any:
+    """
+    Get an ansible job with the given id.
+    """
+
+    job = crud.get_ansible_job(db=db, job_id=job_id)
+    if job == None:
+        err = f"Job {job_id} not found"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+    return job
+
+
+@router.get("/{job_id}/events")
+def get_job_events(
+    job_id: Annotated[str, Path()],
+    event: str | None = Query(None),
+    db: Session = Depends(get_db),
+) -> Any:
+    """
+    Get the ansible-runner events of a job from its artifact directory.
+
+    event: Only return the events of this type, e.g. runner_on_failed.
+    """
+
+    if crud.get_ansible_job(db=db, job_id=job_id) == None:
+        err = f"Job {job_id} not found"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+
+    events = get_run_events(run_id=job_id, event=event)
+    if events == None:
+        err = f"Artifacts of job {job_id} not found, either it has not started yet or it is expired"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+    return events
+
+
+@router.get("/{job_id}/hosts", response_model=list[JobHostOutcome])
+def get_job_hosts(job_id: Annotated[str, Path()], db: Session = Depends(get_db)) -> Any:
+    """
+    Get the outcome of every host of a job, derived from its ansible-runner events.
+
+    It can be polled while the job is running, hosts appear once they finish a task.
+    """
+
+    job = crud.get_ansible_job(db=db, job_id=job_id)
+    if job == None:
+        err = f"Job {job_id} not found"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+
+    events = get_run_events(run_id=job_id)
+    if events == None:
+        err = f"Artifacts of job {job_id} not found, either it has not started yet or it is expired"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+
+    ip_addresses = {
+        str(host.host_pattern): str(host.ip_address)
+        for host in crud.get_cached_remote_hosts_by_fl_identifier(
+            db=db, fl_identifier=str(job.fl_identifier)
+        )
+    }
+    return [
+        JobHostOutcome(
+            host_pattern=host_pattern,
+            ip_address=ip_addresses.get(host_pattern),
+            **counts,
+        )
+        for host_pattern, counts in summarize_host_outcomes(events).items()
+    ]
+
+
+def format_server_sent_event(offset: int, message: dict) -> str:
+    return f"id: {offset}\nevent: {message['event']}\ndata: {json.dumps(message)}\n\n"
+
+
+async def channel_event_generator(channel: EventChannel, offset: int | None):
+    async for item in channel.subscribe(
+        offset=offset, idle_timeout=EVENT_STREAM_KEEPALIVE_INTERVAL
+    ):
+        if item == None:
+            # a comment line, keeps idle connections open through proxies
+            yield ": keepalive\n\n"
+        else:
+            yield format_server_sent_event(*item)
+
+
+def event_stream_response(content) -> StreamingResponse:
+    return StreamingResponse(
+        content,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def get_stream_offset(offset: int | None, last_event_id: str | None) -> int | None:
+    # reconnecting clients send the id of the last event they have received
+    if offset == None and last_event_id != None and last_event_id.isdigit():
+        return int(last_event_id) + 1
+    return offset
+
+
+@router.get("/fl-identifier/{fl_identifier}/events/stream")
+async def stream_federation_events(
+    fl_identifier: Annotated[str, Path()],
+    offset: int | None = Query(None, ge=0),
+    last_event_id: str | None = Header(None),
+):
+    """
+    Stream the task events of every ansible run of a federation as server-sent events,
+    including the single host deploy and ping runs.
+
+    Only new events are streamed, unless an offset to replay from is given.
+    """
+
+    channel = event_broker.get_channel(get_federation_topic(fl_identifier), create=True)
+    assert channel != None
+    return event_stream_response(
+        channel_event_generator(channel, get_stream_offset(offset, last_event_id))
+    )
+
+
+@router.get("/{job_id}/events/stream")
+async def stream_job_events(
+    job_id: Annotated[str, Path()],
+    offset: int | None = Query(None, ge=0),
+    last_event_id: str | None = Header(None),
+    db: Session = Depends(get_db),
+):
+    """
+    Stream the task events of a job as server-sent events, until it finishes.
+
+    Events are replayed from the given offset, which is the id of an event, or from
+    the first one. The last event tells the final status of the job.
+    """
+
+    job = await run_in_threadpool(crud.get_ansible_job, db=db, job_id=job_id)
+    if job == None:
+        err = f"Job {job_id} not found"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+
+    offset = get_stream_offset(offset, last_event_id) or 0
+    channel = event_broker.get_channel(job_id)
+    if channel != None:
+        return event_stream_response(channel_event_generator(channel, offset))
+
+    # the live events are gone, e.g. after a restart, replay them from the artifacts
+    events = await run_in_threadpool(get_run_events, run_id=job_id)
+    if events == None or job.status in UNFINISHED_JOB_STATUSES:
+        err = f"Events of job {job_id} not found, either it has not started yet or it is expired"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+
+    messages = [
+        to_live_event(job_id, str(job.fl_identifier), data)
+        for data in events
+        if str(data.get("event", "")).startswith("runner_on_")
+    ]
+    messages.append(
+        {
+            "run_id": job_id,
+            "fl_identifier": job.fl_identifier,
+            "event": RUN_FINISHED_EVENT,
+            "status": job.status,
+        }
+    )
+    return event_stream_response(
+        format_server_sent_event(i, message)
+        for i, message in enumerate(messages)
+        if i >= offset
+    )
+
+
+def get_job_status(job_id: str) -> AnsibleJob:
+    """
+    Read the job in a session of its own, the streams outlive the request session.
+    """
+
+    db = SesssionLocal()
+    try:
+        return AnsibleJob.from_orm(crud.get_ansible_job(db=db, job_id=job_id))
+    finally:
+        db.close()
+
+
+@router.get("/{job_id}/stream")
+async def stream_job(job_id: Annotated[str, Path()], db: Session = Depends(get_db)):
+    """
+    Stream status changes of an ansible job as newline delimited JSON until it finishes.
+    """
+
+    if await run_in_threadpool(crud.get_ansible_job, db=db, job_id=job_id) == None:
+        err = f"Job {job_id} not found"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+
+    async def job_status_generator():
+        last_status = None
+        while True:
+            # each poll is a database round trip, it doesn't hold up the loop
+            job = await run_in_threadpool(get_job_status, job_id)
+            if job.status != last_status:
+                last_status = job.status
+                yield job.json() + "\n"
+            if job.status not in UNFINISHED_JOB_STATUSES:
+                return
+            await asyncio.sleep(JOB_STREAM_POLL_INTERVAL)
+
+    return StreamingResponse(job_status_generator(), media_type="application/x-ndjson")
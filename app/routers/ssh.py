@@ -1,20 +1,36 @@
 import logging
 import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Annotated, Any
 
 import paramiko
-from fastapi import APIRouter, Body, Depends, HTTPException, status
+from fastapi import APIRouter, Body, Depends, HTTPException, Path, status
 from sqlalchemy.orm import Session
 
 from app.ansible.inventory import dynamic_inventory
-from app.internal.schema import RemoteHostCreate, Status, StatusType
-from app.internal.sql import crud
+from app.definitions import SSH_MAX_CONCURRENT_CONNECTIONS
+from app.internal.schema import (
+    RemoteHostCreate,
+    RemoteHostRegistration,
+    SSHKeyRotation,
+    SSHKeyRotationResult,
+    Status,
+    StatusType,
+)
+from app.internal.sql import crud, models
 from app.internal.utils.enum import OsType
-from app.internal.utils.ssh import validate_command
+from app.internal.utils.ssh import (
+    build_authorized_key_script,
+    ssh_pool,
+    validate_command,
+)
 from app.internal.utils.validator import validate_ip_address
 from app.routers.database import get_db
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(
     prefix="/ssh",
     tags=["ssh"],
@@ -37,7 +53,7 @@ def generate_ssh_key_pair() -> Any:
 
     if os.path.exists(DEFAULT_SSH_PRIVATE_KEY_PATH):
         err = "SSH key already exists!"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=err)
 
     if not os.path.exists(DEFAULT_SSH_PATH):
@@ -45,7 +61,7 @@ def generate_ssh_key_pair() -> Any:
 
     if not validate_command("ssh-keygen"):
         err = "ssh-keygen command not found!"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=err,
@@ -71,37 +87,32 @@ def generate_ssh_key_pair() -> Any:
 
     if result.returncode != 0:
         err = f"SSH key generation failed: {result.stderr}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=err,
         )
 
-    logging.info("SSH key generated successfully!")
+    logger.info("SSH key generated successfully!")
     return Status(
         status=StatusType.success, description="SSH key generated successfully!"
     )
 
 
-@router.post("/copy-ssh-key-to-remote-host", response_model=Status)
-def copy_ssh_key_to_remote(
-    host: Annotated[RemoteHostCreate, Body()], db: Session = Depends(get_db)
-) -> Any:
+def validate_remote_host(host: RemoteHostCreate) -> None:
     """
-    Copies the SSH key to the remote host.
-
-    host: Remote host information.
+    Validate the remote host before it is registered, raises HTTPException if invalid.
     """
 
     if not validate_ip_address(host.ip_address):
         err = f"Invalid IP address: {host.ip_address}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
 
     # only linux is supported for now
     if host.os_type != OsType.linux:
         err = f"Invalid os_type! (os_type: {host.os_type})"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(
             status_code=400,
             detail=err,
@@ -109,71 +120,69 @@ def copy_ssh_key_to_remote(
 
     if host.fl_identifier.isspace():
         err = "Invalid flower identifier, it cannot contain whitespace characters."
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
 
     if host.host_pattern != None and host.host_pattern.isspace():
         err = "Invalid host pattern, it cannot contain whitespace characters."
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
 
+
+def read_ssh_public_key() -> str:
     if not os.path.exists(DEFAULT_SSH_PUBLIC_KEY_PATH):
         err = "SSH public key does not exist!"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=err,
         )
 
-    client = paramiko.SSHClient()
+    with open(DEFAULT_SSH_PUBLIC_KEY_PATH, "r") as f:
+        return f.read()
 
-    try:
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(
-            hostname=host.ip_address,
-            username=host.ssh_username,
-            password=host.ssh_password,
-            port=host.ssh_port,
-        )
-
-        _, _, _ = client.exec_command("mkdir -p ~/.ssh")
-        _, _, _ = client.exec_command("touch ~/.ssh/authorized_keys")
-
-        with open(DEFAULT_SSH_PUBLIC_KEY_PATH, "r") as f:
-            content = f.read()
 
-        cmd = f'grep -q "{content}" ~/.ssh/authorized_keys || echo "{content}" >> ~/.ssh/authorized_keys'
-        logging.info(f"{host.ip_address}: {cmd}")
-
-        _, _, stderr = client.exec_command(cmd)
+def copy_ssh_key(
+    host: RemoteHostCreate | models.RemoteHost,
+    content: str,
+    revoked_content: str | None = None,
+) -> None:
+    """
+    Install the public key into the authorized keys of the remote host, unless it is there.
 
-        stderr_output = stderr.read().decode("utf-8")
-        if stderr_output:
-            err = f"SSH key copy failed: {stderr_output}"
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=err,
-            )
+    The key is installed by a single idempotent script in one round trip, the revoked
+    key, if given, is removed by the same script. The connection is borrowed from the
+    SSH connection pool and returned afterwards.
 
-        crud.register_remote_host(db=db, remote_host=host)
-        dynamic_inventory.add_new_host_to_flower_inventory(
-            inventory_dirname=host.fl_identifier,
-            host_pattern=host.host_pattern,
-            ansible_host=host.ip_address,
-            ansible_user=host.ssh_username,
-            flower_type=host.flower_type,
-            db=db,
-        )
+    Raises HTTPException if the key could not be installed.
+    """
 
-        logging.info("SSH key copied to remote host successfully!")
-        return Status(
-            status=StatusType.success,
-            description="SSH key copied to remote host successfully!",
-        )
+    try:
+        with ssh_pool.connection(
+            hostname=str(host.ip_address),
+            port=int(host.ssh_port),
+            username=str(host.ssh_username),
+            password=host.ssh_password,
+        ) as client:
+            cmd = build_authorized_key_script(content, revoked_content)
+            logger.info(f"{host.ip_address}: installing SSH key")
+            logger.debug(f"{host.ip_address}: {cmd}")
+
+            _, stdout, stderr = client.exec_command(cmd)
+
+            # waits for the script to finish
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                stderr_output = stderr.read().decode("utf-8", "replace")
+                err = f"SSH key copy failed with exit status {exit_status}: {stderr_output}"
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail=err,
+                )
 
     except paramiko.BadHostKeyException as e:
         err = f"Host key could not be verified: \n{e}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=err,
@@ -181,7 +190,7 @@ def copy_ssh_key_to_remote(
 
     except paramiko.AuthenticationException as e:
         err = f"Authentication failed: \n{e}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=err,
@@ -189,24 +198,248 @@ def copy_ssh_key_to_remote(
 
     except paramiko.SSHException as e:
         err = f"SSH connection failed: \n{e}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=err,
         )
 
     except HTTPException as e:
-        logging.error(e.detail)
+        logger.error(e.detail)
         # intentionally to avoid double logging
         raise e
 
     except Exception as e:
         err = f"Unknown error: \n{e}"
-        logging.error(err)
+        logger.error(err)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=err,
         )
 
-    finally:
-        client.close()
+
+@router.post("/copy-ssh-key-to-remote-host", response_model=Status)
+def copy_ssh_key_to_remote(
+    host: Annotated[RemoteHostCreate, Body()], db: Session = Depends(get_db)
+) -> Any:
+    """
+    Copies the SSH key to the remote host.
+
+    host: Remote host information.
+    """
+
+    validate_remote_host(host)
+    content = read_ssh_public_key()
+    copy_ssh_key(host, content)
+
+    try:
+        crud.register_remote_host(db=db, remote_host=host)
+        dynamic_inventory.add_new_host_to_flower_inventory(
+            inventory_dirname=host.fl_identifier,
+            host_pattern=host.host_pattern,
+            ansible_host=host.ip_address,
+            ansible_user=host.ssh_username,
+            flower_type=host.flower_type,
+            db=db,
+        )
+
+    except HTTPException as e:
+        logger.error(e.detail)
+        # intentionally to avoid double logging
+        raise e
+
+    except Exception as e:
+        err = f"Unknown error: \n{e}"
+        logger.error(err)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=err,
+        )
+
+    logger.info("SSH key copied to remote host successfully!")
+    return Status(
+        status=StatusType.success,
+        description="SSH key copied to remote host successfully!",
+    )
+
+
+@router.post(
+    "/copy-ssh-key-to-remote-hosts", response_model=list[RemoteHostRegistration]
+)
+def copy_ssh_key_to_remote_hosts(
+    hosts: Annotated[list[RemoteHostCreate], Body()], db: Session = Depends(get_db)
+) -> Any:
+    """
+    Copies the SSH key to many remote hosts concurrently, then registers them.
+
+    Hosts are registered in a single transaction and the inventory of each federation
+    is written once. A result is returned for every given host, in the given order,
+    a failing host doesn't fail the others.
+    """
+
+    content = read_ssh_public_key()
+
+    results: dict[int, RemoteHostRegistration] = {}
+
+    def fail(index: int, description: str) -> None:
+        results[index] = RemoteHostRegistration(
+            ip_address=hosts[index].ip_address,
+            status=StatusType.error,
+            description=description,
+        )
+
+    registered = {
+        str(host.ip_address)
+        for host in crud.get_remote_hosts_by_ip_addresses(
+            db=db, ip_addresses=[host.ip_address for host in hosts]
+        )
+    }
+    taken_host_patterns: dict[str, set[str]] = {}
+    ip_addresses: set[str] = set()
+    candidates: list[int] = []
+    for index, host in enumerate(hosts):
+        try:
+            validate_remote_host(host)
+        except HTTPException as e:
+            fail(index, e.detail)
+            continue
+
+        if host.ip_address in ip_addresses:
+            fail(index, f"IP address {host.ip_address} is given more than once")
+            continue
+        ip_addresses.add(host.ip_address)
+
+        if host.ip_address in registered:
+            fail(index, "Remote host with the given IP address already exists")
+            continue
+
+        if host.host_pattern != None:
+            if host.fl_identifier not in taken_host_patterns:
+                taken_host_patterns[
+                    host.fl_identifier
+                ] = dynamic_inventory.get_flower_inventory_host_patterns(
+                    host.fl_identifier
+                )
+            host_patterns = taken_host_patterns[host.fl_identifier]
+            if host.host_pattern in host_patterns:
+                fail(index, f"Host pattern {host.host_pattern} already exists")
+                continue
+            host_patterns.add(host.host_pattern)
+
+        candidates.append(index)
+
+    copied: list[int] = []
+    if candidates:
+        with ThreadPoolExecutor(
+            max_workers=min(len(candidates), SSH_MAX_CONCURRENT_CONNECTIONS),
+            thread_name_prefix="ssh-key",
+        ) as executor:
+            futures = {
+                index: executor.submit(copy_ssh_key, hosts[index], content)
+                for index in candidates
+            }
+        for index, future in futures.items():
+            try:
+                future.result()
+                copied.append(index)
+            except HTTPException as e:
+                fail(index, e.detail)
+
+    groups: dict[str, list[int]] = {}
+    for index in copied:
+        groups.setdefault(hosts[index].fl_identifier, []).append(index)
+
+    # each federation is registered in a transaction of its own, which is only
+    # committed once its inventory is written, so a failed write registers nothing
+    for fl_identifier, group in groups.items():
+        try:
+            db_hosts = crud.register_remote_hosts(
+                db=db,
+                remote_hosts=[hosts[index] for index in group],
+                before_commit=partial(
+                    dynamic_inventory.add_hosts_to_flower_inventory, fl_identifier
+                ),
+            )
+        except HTTPException as e:
+            logger.error(e.detail)
+            for index in group:
+                fail(index, e.detail)
+            continue
+
+        for index, db_host in zip(group, db_hosts):
+            results[index] = RemoteHostRegistration(
+                ip_address=str(db_host.ip_address),
+                status=StatusType.success,
+                host_pattern=str(db_host.host_pattern),
+                description="SSH key copied to remote host successfully!",
+            )
+
+    results_in_order = [results[index] for index in range(len(hosts))]
+    succeeded = sum(result.status == StatusType.success for result in results_in_order)
+    logger.info(f"{succeeded} of {len(hosts)} remote hosts are registered")
+    return results_in_order
+
+
+@router.post(
+    "/rotate-ssh-key/{fl_identifier}", response_model=list[SSHKeyRotationResult]
+)
+def rotate_ssh_key(
+    fl_identifier: Annotated[str, Path()],
+    rotation: Annotated[SSHKeyRotation, Body()] = SSHKeyRotation(),
+    db: Session = Depends(get_db),
+) -> Any:
+    """
+    Install the current SSH key on every remote host of the FL identifier concurrently.
+
+    If a revoked public key is given, it is removed from the authorized keys of each
+    host in the same step, after the current key is installed. A result is returned
+    for every host, a failing host doesn't fail the others.
+    """
+
+    content = read_ssh_public_key()
+    if (
+        rotation.revoked_public_key != None
+        and rotation.revoked_public_key.strip() == content.strip()
+    ):
+        err = "The revoked public key is the current SSH key of the service"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err)
+
+    hosts = crud.get_remote_hosts_by_fl_identifier(db=db, fl_identifier=fl_identifier)
+    if len(hosts) == 0:
+        err = f"No hosts found with FL identifier {fl_identifier}"
+        logger.error(err)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=err)
+
+    with ThreadPoolExecutor(
+        max_workers=min(len(hosts), SSH_MAX_CONCURRENT_CONNECTIONS),
+        thread_name_prefix="ssh-key",
+    ) as executor:
+        futures = [
+            executor.submit(copy_ssh_key, host, content, rotation.revoked_public_key)
+            for host in hosts
+        ]
+
+    results = []
+    for host, future in zip(hosts, futures):
+        try:
+            future.result()
+            results.append(
+                SSHKeyRotationResult(
+                    ip_address=str(host.ip_address),
+                    status=StatusType.success,
+                    description="SSH key rotated successfully!",
+                )
+            )
+        except HTTPException as e:
+            results.append(
+                SSHKeyRotationResult(
+                    ip_address=str(host.ip_address),
+                    status=StatusType.error,
+                    description=e.detail,
+                )
+            )
+
+    succeeded = sum(result.status == StatusType.success for result in results)
+    logger.info(f"SSH key is rotated on {succeeded} of {len(hosts)} remote hosts")
+    return results
@@ -0,0 +1,401 @@
+"""
+Latency and throughput of the API endpoints under concurrent clients, against local
+stand-ins for the remote hosts, ansible-runner and docker.
+
+    python -m tests.benchmark.bench_api [--requests 100] [--concurrency 8]
+        [--federations 4] [--only register lookup ...] [--save-baseline]
+
+Requests go through the TestClient to the app in this process, so the numbers
+include the whole app but no network. The hosts are loopback addresses served by a
+stub SSH server, ansible runs report every task as ok without connecting anywhere
+and docker is a shell script.
+
+No baseline is committed, the numbers depend on the machine. To measure a change,
+run with --save-baseline on the revision before it, which writes the results to
+tests/benchmark/baseline_api.json (ignored by git), then run again on the change
+with the same settings, its results are printed next to the saved ones.
+"""
+
+import argparse
+import io
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from typing import Callable
+
+from .standins import (
+    FakeAnsibleRunner,
+    StubSSHServer,
+    install_fake_docker,
+    write_public_key,
+)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline_api.json")
+# in the order they run, each one after the scenarios it depends on
+SCENARIOS = (
+    "register",
+    "lookup",
+    "federation lookup",
+    "ping",
+    "ping federation",
+    "states",
+    "install",
+    "poll job",
+    "upload",
+    "poll build",
+    "deploy",
+    "deploy federation",
+    "poll deployment",
+)
+# scenarios which need the hosts, jobs or builds created by another one
+DEPENDENCIES = {
+    "poll job": "install",
+    "poll build": "upload",
+    "deploy": "poll build",
+    "deploy federation": "poll build",
+    "poll deployment": "deploy federation",
+}
+UNFINISHED_STATUSES = ("queued", "pending", "running")
+
+
+def percentile(latencies: list[float], q: float) -> float:
+    """
+    Nearest rank percentile of sorted latencies.
+    """
+
+    if not latencies:
+        return 0.0
+    return latencies[max(math.ceil(q * len(latencies)) - 1, 0)]
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50 ms": percentile(latencies, 0.50) * 1000,
+        "p99 ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def run_scenario(requests: int, concurrency: int, request: Callable) -> dict:
+    """
+    Send the requests from concurrent clients, each request is made by request(i).
+    """
+
+    counter = itertools.count()
+    latencies: list[float] = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client() -> None:
+        while True:
+            i = next(counter)
+            if i >= requests:
+                return
+            started_at = time.perf_counter()
+            response = request(i)
+            elapsed = time.perf_counter() - started_at
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400:
+                    errors[0] += 1
+
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    started_at = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - started_at)
+
+
+def poll_until_done(client, paths: list[str], timeout: float) -> dict:
+    """
+    Poll the jobs or builds at the given paths one after the other until all of them
+    are finished, like a client waiting for them does.
+    """
+
+    pending = list(paths)
+    latencies: list[float] = []
+    errors = 0
+    deadline = time.monotonic() + timeout
+    started_at = time.perf_counter()
+    while pending and time.monotonic() < deadline:
+        for path in list(pending):
+            request_started_at = time.perf_counter()
+            response = client.get(path)
+            latencies.append(time.perf_counter() - request_started_at)
+            if response.status_code >= 400:
+                errors += 1
+                pending.remove(path)
+            elif response.json()["status"] not in UNFINISHED_STATUSES:
+                pending.remove(path)
+    if pending:
+        print(f"{len(pending)} of {len(paths)} are not finished after {timeout}s")
+    return summarize(latencies, errors, time.perf_counter() - started_at)
+
+
+def make_source_zip(size_kb: int) -> bytes:
+    """
+    Zip of a project source with its definition and random content, so every upload
+    is a new bundle.
+    """
+
+    definition = {
+        "entrypoint": ["python", "main.py"],
+        "image_name": "bench/fl-client:latest",
+        "sourcedir": "/tmp/fl-data",
+        "targetdir": "/data",
+    }
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("definition.yaml", json.dumps(definition))
+        zip_file.writestr("main.py", "print('hello')\n")
+        zip_file.writestr("data.bin", random.randbytes(size_kb * 1024))
+    return buffer.getvalue()
+
+
+def get_host(n: int, federations: int, ssh_port: int) -> dict:
+    # every address of 127.0.0.0/8 reaches the stub SSH server
+    return {
+        "contact_info": "bench",
+        "ip_address": f"127.{(n >> 16) + 1}.{(n >> 8) & 255}.{n & 255}",
+        "fl_identifier": f"bench{n % federations}",
+        "flower_type": "server" if n < federations else "client",
+        "ssh_username": "bench",
+        "ssh_password": "bench",
+        "ssh_port": ssh_port,
+    }
+
+
+def get_needed_scenarios(only: list[str]) -> list[str]:
+    needed = {"register"}
+    for name in only:
+        while name != None:
+            needed.add(name)
+            name = DEPENDENCIES.get(name)
+    return [name for name in SCENARIOS if name in needed]
+
+
+def run(args, client, ssh_port: int) -> dict[str, dict]:
+    federations = [f"bench{i}" for i in range(args.federations)]
+    ip_addresses: list[str] = []
+    servers: list[str] = []
+    install_jobs: list[str] = []
+    deployment_jobs: list[str] = []
+    builds: list[str] = []
+
+    def register(i: int):
+        hosts = [
+            get_host(i * args.batch + j, args.federations, ssh_port)
+            for j in range(args.batch)
+        ]
+        response = client.post("/ssh/copy-ssh-key-to-remote-hosts", json=hosts)
+        for host, result in zip(hosts, response.json()):
+            if result["status"] == "success":
+                ip_addresses.append(host["ip_address"])
+                if host["flower_type"] == "server":
+                    servers.append(host["ip_address"])
+        return response
+
+    def submit(jobs: list[str], path: Callable, body: Callable) -> Callable:
+        def request(i: int):
+            response = client.post(path(i), json=body(i))
+            if response.status_code == 202:
+                submitted = response.json()
+                if not isinstance(submitted, list):
+                    submitted = [submitted]
+                jobs.extend(f"/jobs/{job['id']}" for job in submitted)
+            return response
+
+        return request
+
+    def upload(i: int):
+        response = client.post(
+            f"/docker/upload-source-files/{server(i)}/linux/amd64/",
+            files={"file": ("source.zip", make_source_zip(args.upload_kb))},
+        )
+        if response.status_code == 202:
+            builds.extend(f"/docker/builds/{build['id']}" for build in response.json())
+        return response
+
+    def host(i: int) -> str:
+        return random.choice(ip_addresses)
+
+    def server(i: int) -> str:
+        return servers[i % len(servers)]
+
+    def federation(i: int) -> str:
+        return federations[i % len(federations)]
+
+    def scenario(request: Callable) -> Callable[[], dict]:
+        return lambda: run_scenario(args.requests, args.concurrency, request)
+
+    scenarios: dict[str, Callable[[], dict]] = {
+        "register": scenario(register),
+        "lookup": scenario(lambda i: client.get(f"/remote-hosts/{host(i)}")),
+        "federation lookup": scenario(
+            lambda i: client.get(f"/remote-hosts/fl-identifier/{federation(i)}")
+        ),
+        "ping": scenario(lambda i: client.get(f"/ping/{host(i)}")),
+        "ping federation": scenario(
+            lambda i: client.post("/ping", json={"fl_identifier": federation(i)})
+        ),
+        "states": scenario(lambda i: client.get(f"/docker/states/{host(i)}")),
+        "install": scenario(
+            submit(
+                install_jobs,
+                lambda i: "/docker/install",
+                lambda i: {"ip_addresses": [host(i)]},
+            )
+        ),
+        "poll job": lambda: poll_until_done(client, install_jobs, args.timeout),
+        "upload": scenario(upload),
+        "poll build": lambda: poll_until_done(client, builds, args.timeout),
+        "deploy": scenario(lambda i: client.post(f"/docker/deploy/{server(i)}/")),
+        "deploy federation": scenario(
+            submit(
+                deployment_jobs,
+                lambda i: f"/docker/deploy/fl-identifier/{federation(i)}",
+                lambda i: {"serial": "25%"},
+            )
+        ),
+        "poll deployment": lambda: poll_until_done(
+            client, deployment_jobs, args.timeout
+        ),
+    }
+
+    results = {}
+    for name in get_needed_scenarios(args.only):
+        result = scenarios[name]()
+        if name == "register" and not servers:
+            raise RuntimeError("No federation server could be registered")
+        if name in args.only:
+            results[name] = result
+    return results
+
+
+def report(results: dict[str, dict], baseline: dict[str, dict] | None) -> None:
+    def change(name: str, column: str) -> str:
+        if baseline == None or name not in baseline:
+            return ""
+        before = baseline[name][column]
+        if before == 0:
+            return ""
+        return f" ({(results[name][column] - before) / before * 100:+.0f}%)"
+
+    print(
+        f"{'endpoint':<18} {'requests':>8} {'errors':>6}"
+        f" {'req/s':>16} {'p50 ms':>16} {'p99 ms':>16}"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:<18} {result['requests']:>8} {result['errors']:>6}"
+            f" {result['rps']:>9.1f}{change(name, 'rps'):<7}"
+            f" {result['p50 ms']:>9.2f}{change(name, 'p50 ms'):<7}"
+            f" {result['p99 ms']:>9.2f}{change(name, 'p99 ms'):<7}"
+        )
+
+
+def get_settings(args) -> dict:
+    # the settings which make results comparable, any scenario can be compared
+    return {
+        name: value
+        for name, value in vars(args).items()
+        if name not in ("only", "baseline", "save_baseline")
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--federations", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=5, help="hosts per registration")
+    parser.add_argument("--upload-kb", type=int, default=256)
+    parser.add_argument("--task-seconds", type=float, default=0.0)
+    parser.add_argument("--docker-seconds", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--only", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument(
+        "--baseline",
+        default=DEFAULT_BASELINE,
+        help="results of a previous run on this machine, compared when it exists",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="write the results of this run to the baseline file",
+    )
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="fl-service-bench-")
+    bin_dir = os.path.join(tmpdir, "bin")
+    os.makedirs(bin_dir)
+    install_fake_docker(bin_dir)
+
+    # the service reads its settings when it is imported
+    os.environ["FL_SERVICE_DATABASE_URL"] = f"sqlite:///{tmpdir}/bench.db"
+    os.environ["FL_SERVICE_LOG_FILE"] = os.path.join(tmpdir, "bench.log")
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    os.environ["FAKE_DOCKER_SECONDS"] = str(args.docker_seconds)
+
+    import ansible_runner
+    from fastapi.testclient import TestClient
+
+    from app.definitions import ANSIBLE_INVENTORY_DIR
+    from app.main import app
+    from app.routers import ssh
+
+    ansible_runner.run = FakeAnsibleRunner(args.task_seconds)
+    ssh.DEFAULT_SSH_PUBLIC_KEY_PATH = write_public_key(
+        os.path.join(tmpdir, "id_rsa.pub")
+    )
+
+    ssh_server = StubSSHServer().start()
+    try:
+        with TestClient(app) as client:
+            results = run(args, client, ssh_server.port)
+    finally:
+        ssh_server.stop()
+        for i in range(args.federations):
+            shutil.rmtree(os.path.join(ANSIBLE_INVENTORY_DIR, f"bench{i}"), True)
+        shutil.rmtree(tmpdir, True)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r") as baseline_file:
+            saved = json.load(baseline_file)
+        baseline = saved["results"]
+        if saved["settings"] != get_settings(args):
+            print(f"Baseline {args.baseline} was measured with other settings")
+    report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(
+                {
+                    "python": sys.version.split()[0],
+                    "machine": platform.machine(),
+                    "settings": get_settings(args),
+                    "results": results,
+                },
+                baseline_file,
+                indent=2,
+            )
+        print(f"Baseline is saved to {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
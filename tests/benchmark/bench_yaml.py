@@ -0,0 +1,105 @@
+"""
+Load and dump time of flower inventories, pure Python PyYAML against the libyaml
+loader and dumper, and repeated reads through the parse cache.
+
+    python -m tests.benchmark.bench_yaml [--hosts 100 1000 10000] [--repeat 5]
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import yaml
+
+from app.ansible.inventory.dynamic_inventory import (
+    FLOWER_CLIENTS_GROUP,
+    FLOWER_SERVER_GROUP,
+    build_flower_inventory,
+)
+from app.internal.sql import models
+from app.internal.utils.ansible import (
+    YamlDumper,
+    YamlLoader,
+    ansible_export_to_yaml,
+    load_yaml_file,
+)
+from app.internal.utils.enum import FlowerType
+
+
+def make_inventory(hosts: int) -> dict:
+    return build_flower_inventory(
+        [
+            models.RemoteHost(
+                ip_address=f"10.{i // 65536}.{i // 256 % 256}.{i % 256}",
+                ssh_username="ubuntu",
+                ssh_password="password",
+                flower_type=FlowerType.server if i == 0 else FlowerType.client,
+                host_pattern=f"host_{i + 1}",
+            )
+            for i in range(hosts)
+        ]
+    )
+
+
+def measure(func, repeat: int) -> float:
+    """
+    Median time of the given function in milliseconds.
+    """
+
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started_at)
+    return statistics.median(timings) * 1000
+
+
+def run(hosts: int, repeat: int, filepath: str) -> dict:
+    content = make_inventory(hosts)
+    ansible_export_to_yaml(content, filepath)
+    with open(filepath, "r") as yaml_file:
+        text = yaml_file.read()
+
+    loaded = yaml.load(text, Loader=YamlLoader)
+    assert len(loaded["all"]["children"][FLOWER_CLIENTS_GROUP]["hosts"]) == hosts - 1
+    assert len(loaded["all"]["children"][FLOWER_SERVER_GROUP]["hosts"]) == 1
+
+    def dump(dumper):
+        return lambda: yaml.dump(
+            content, Dumper=dumper, default_flow_style=False, sort_keys=False
+        )
+
+    # the first read fills the cache
+    load_yaml_file(filepath)
+    return {
+        "load python": measure(lambda: yaml.load(text, Loader=yaml.SafeLoader), repeat),
+        "load libyaml": measure(lambda: yaml.load(text, Loader=YamlLoader), repeat),
+        "load cached": measure(lambda: load_yaml_file(filepath), repeat),
+        "dump python": measure(dump(yaml.SafeDumper), repeat),
+        "dump libyaml": measure(dump(YamlDumper), repeat),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--hosts", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if not yaml.__with_libyaml__:
+        print("PyYAML is built without libyaml, libyaml timings are pure Python")
+
+    columns = None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for hosts in args.hosts:
+            result = run(hosts, args.repeat, os.path.join(tmpdir, f"{hosts}.yaml"))
+            if columns == None:
+                columns = list(result)
+                print(f"{'hosts':>6}" + "".join(f"{c:>14}" for c in columns) + "  (ms)")
+            print(f"{hosts:>6}" + "".join(f"{result[c]:>14.2f}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+Local stand-ins for the remote side of the service, so the API can be benchmarked
+without remote hosts: ansible-runner, an SSH server and the docker command line.
+"""
+
+import os
+import socket
+import stat
+import threading
+import time
+from types import SimpleNamespace
+
+import paramiko
+import yaml
+
+FAKE_DOCKER_SCRIPT = """#!/bin/sh
+# fake docker command line, sleeps like a slow build and succeeds
+sleep "${FAKE_DOCKER_SECONDS:-0}"
+if [ "$1" = "save" ]; then
+    head -c 65536 /dev/urandom
+fi
+exit 0
+"""
+# the stub SSH server closes a command channel this long after the command
+CHANNEL_CLOSE_DELAY_SECONDS = 0.5
+
+
+def _get_inventory_hosts(inventory: dict) -> dict[str, set[str]]:
+    """
+    Return the host patterns of every group of an inventory, and of all.
+    """
+
+    groups: dict[str, set[str]] = {"all": set()}
+
+    def visit(name: str, group: dict) -> set[str]:
+        hosts = set((group.get("hosts") or {}).keys())
+        for child_name, child in (group.get("children") or {}).items():
+            hosts |= visit(child_name, child or {})
+        groups[name] = hosts
+        return hosts
+
+    for name, group in inventory.items():
+        groups["all"] |= visit(name, group or {})
+    return groups
+
+
+def _get_task_names(tasks: list[dict]) -> list[str]:
+    names = []
+    for task in tasks or []:
+        if "block" in task:
+            names.extend(_get_task_names(task["block"]))
+        else:
+            names.append(task.get("name") or next(iter(task), "task"))
+    return names
+
+
+class FakeAnsibleRunner:
+    """
+    Replacement of ansible_runner.run which reports every task of the playbook as ok
+    on every targeted host, through the event handler, without connecting to them.
+
+    Each task takes `task_seconds`, on all of its hosts at once like parallel forks.
+    """
+
+    def __init__(self, task_seconds: float = 0.0):
+        self.task_seconds = task_seconds
+        self.runs = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, **kwargs) -> SimpleNamespace:
+        with self._lock:
+            self.runs += 1
+
+        playbook = kwargs["playbook"]
+        if isinstance(playbook, str):
+            with open(playbook, "r") as playbook_file:
+                plays = yaml.safe_load(playbook_file)
+            playbook_name = os.path.basename(playbook)
+        else:
+            plays = playbook
+            playbook_name = "main.json"
+
+        groups = _get_inventory_hosts(kwargs.get("inventory") or {})
+        limit = kwargs.get("limit")
+        targeted = set(limit.split(":")) if limit else groups["all"]
+        event_handler = kwargs.get("event_handler") or (lambda data: True)
+
+        counter = 0
+        for play in plays:
+            hosts = set()
+            for pattern in str(play.get("hosts", "all")).split(":"):
+                hosts |= groups.get(pattern, {pattern} & groups["all"])
+            hosts &= targeted
+            for task in _get_task_names(play.get("tasks")):
+                if self.task_seconds > 0:
+                    time.sleep(self.task_seconds)
+                for host in sorted(hosts):
+                    counter += 1
+                    event_handler(
+                        {
+                            "event": "runner_on_ok",
+                            "counter": counter,
+                            "created": time.time(),
+                            "event_data": {
+                                "playbook": playbook_name,
+                                "play": play.get("name"),
+                                "task": task,
+                                "host": host,
+                                "duration": self.task_seconds,
+                                "res": {"changed": False},
+                            },
+                        }
+                    )
+        event_handler({"event": "playbook_on_stats", "counter": counter + 1})
+        return SimpleNamespace(status="successful", rc=0)
+
+
+class _StubServerInterface(paramiko.ServerInterface):
+    def __init__(self, password: str | None):
+        self.password = password
+
+    def get_allowed_auths(self, username: str) -> str:
+        if self.password != None:
+            return "password"
+        return "password,publickey"
+
+    def check_auth_password(self, username: str, password: str) -> int:
+        if self.password in (None, password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_publickey(self, username: str, key: paramiko.PKey) -> int:
+        if self.password == None:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind: str, chanid: int) -> int:
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel: paramiko.Channel, command) -> bool:
+        channel.send_exit_status(0)
+        # closed only once the request is acknowledged, a client whose channel is
+        # closed before it gets the acknowledgement takes the command as failed
+        timer = threading.Timer(CHANNEL_CLOSE_DELAY_SECONDS, channel.close)
+        timer.daemon = True
+        timer.start()
+        return True
+
+
+class StubSSHServer:
+    """
+    SSH server which runs any command successfully. It accepts any credentials, or
+    only the given password.
+
+    It listens on every loopback address, so each host of a benchmark can have an
+    address of its own in 127.0.0.0/8 while they all reach this server.
+    """
+
+    def __init__(self, password: str | None = None):
+        self.password = password
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("0.0.0.0", 0))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+        self._transports: list[paramiko.Transport] = []
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+
+    def start(self) -> "StubSSHServer":
+        self._thread.start()
+        return self
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                sock, _ = self._socket.accept()
+            except OSError:
+                # the listening socket is closed
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            self._transports.append(transport)
+            # negotiates in the thread of the transport, the next client is accepted
+            transport.start_server(
+                event=threading.Event(), server=_StubServerInterface(self.password)
+            )
+
+    def stop(self) -> None:
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+
+
+def install_fake_docker(bin_dir: str) -> str:
+    """
+    Write the fake docker command into the directory, which has to come first in PATH.
+    """
+
+    path = os.path.join(bin_dir, "docker")
+    with open(path, "w") as script:
+        script.write(FAKE_DOCKER_SCRIPT)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def write_public_key(path: str) -> str:
+    """
+    Write a freshly generated public key, the one the service installs on the hosts.
+    """
+
+    key = paramiko.RSAKey.generate(2048)
+    with open(path, "w") as key_file:
+        key_file.write(f"{key.get_name()} {key.get_base64()} bench\n")
+    return path
@@ -0,0 +1,14 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from app.internal.sql.database import Base, create_database_engine
+
+
+@pytest.fixture
+def db():
+    engine = create_database_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
@@ -0,0 +1,86 @@
+import pytest
+
+from app.internal.sql import cache
+from app.internal.sql.cache import HostLookupCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    return clock
+
+
+def test_lookup_is_cached_until_ttl(clock):
+    host_cache = HostLookupCache(ttl_seconds=30, max_entries=10)
+    builds = []
+
+    def build():
+        builds.append(1)
+        return len(builds)
+
+    assert host_cache.get("ip_address", "10.0.0.1", build) == 1
+    clock.now = 29
+    assert host_cache.get("ip_address", "10.0.0.1", build) == 1
+    clock.now = 31
+    assert host_cache.get("ip_address", "10.0.0.1", build) == 2
+
+    stats = host_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["expirations"]) == (1, 2, 1)
+
+
+def test_missing_host_is_not_cached(clock):
+    host_cache = HostLookupCache(ttl_seconds=30, max_entries=10)
+
+    assert host_cache.get("ip_address", "10.0.0.1", lambda: None) == None
+    assert host_cache.get("ip_address", "10.0.0.1", lambda: "host") == "host"
+
+
+def test_invalidate_by_kind_and_keys(clock):
+    host_cache = HostLookupCache(ttl_seconds=30, max_entries=10)
+    for kind, key in [("ip_address", "a"), ("ip_address", "b"), ("fl_identifier", "a")]:
+        host_cache.get(kind, key, lambda: "cached")
+
+    host_cache.invalidate("ip_address", ["a"])
+    assert host_cache.get("ip_address", "a", lambda: "fresh") == "fresh"
+    assert host_cache.get("ip_address", "b", lambda: "fresh") == "cached"
+    assert host_cache.get("fl_identifier", "a", lambda: "fresh") == "cached"
+
+    host_cache.invalidate("ip_address")
+    assert host_cache.get("ip_address", "b", lambda: "fresh") == "fresh"
+    assert host_cache.get("fl_identifier", "a", lambda: "fresh") == "cached"
+
+    host_cache.invalidate()
+    assert host_cache.stats()["size"] == 0
+
+
+def test_value_built_during_invalidation_is_not_stored(clock):
+    host_cache = HostLookupCache(ttl_seconds=30, max_entries=10)
+
+    def build():
+        # e.g. the host is changed by another request while it is looked up
+        host_cache.invalidate("ip_address", ["a"])
+        return "stale"
+
+    assert host_cache.get("ip_address", "a", build) == "stale"
+    assert host_cache.get("ip_address", "a", lambda: "fresh") == "fresh"
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    host_cache = HostLookupCache(ttl_seconds=30, max_entries=2)
+    host_cache.get("ip_address", "a", lambda: "a")
+    host_cache.get("ip_address", "b", lambda: "b")
+    host_cache.get("ip_address", "a", lambda: "a")
+    host_cache.get("ip_address", "c", lambda: "c")
+
+    assert host_cache.get("ip_address", "a", lambda: "fresh") == "a"
+    assert host_cache.get("ip_address", "b", lambda: "fresh") == "fresh"
+    assert host_cache.stats()["evictions"] == 2
@@ -0,0 +1,137 @@
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+
+from app.internal.schema import RemoteHostCreate
+from app.internal.sql import crud, models
+from app.internal.utils.enum import (
+    DOCKER_INSTALLATION_NAME,
+    DOCKER_INSTALLATION_PLAYBOOK,
+    FlowerType,
+    InstallationStatus,
+)
+
+
+def make_host(i: int, fl_identifier: str = "fed", **kwargs) -> RemoteHostCreate:
+    values = {
+        "contact_info": "contact",
+        "ip_address": f"10.0.0.{i}",
+        "fl_identifier": fl_identifier,
+        "flower_type": FlowerType.client,
+        "ssh_username": "user",
+        "host_pattern": None,
+    }
+    values.update(kwargs)
+    return RemoteHostCreate(**values)
+
+
+class _DriverError(Exception):
+    def __init__(self, message: str, pgcode: str | None = None):
+        super().__init__(message)
+        self.pgcode = pgcode
+
+
+def test_is_unique_violation_of_sqlite(db):
+    db.add(models.RemoteHost(ip_address="10.0.0.1"))
+    db.commit()
+    db.add(models.RemoteHost(ip_address="10.0.0.1"))
+    with pytest.raises(IntegrityError) as e:
+        db.commit()
+    db.rollback()
+
+    assert crud.is_unique_violation(e.value)
+
+
+def test_is_unique_violation_by_sqlstate():
+    unique = IntegrityError("INSERT", {}, _DriverError("duplicate key", "23505"))
+    not_null = IntegrityError("INSERT", {}, _DriverError("null value", "23502"))
+
+    assert crud.is_unique_violation(unique)
+    assert not crud.is_unique_violation(not_null)
+
+
+def test_is_unique_violation_of_other_constraint():
+    e = IntegrityError("INSERT", {}, _DriverError("NOT NULL constraint failed"))
+
+    assert not crud.is_unique_violation(e)
+
+
+def test_register_remote_host_conflict(db):
+    crud.register_remote_host(db=db, remote_host=make_host(1))
+
+    with pytest.raises(HTTPException) as e:
+        crud.register_remote_host(db=db, remote_host=make_host(1))
+    assert e.value.status_code == 409
+
+
+def register_hosts(db, hosts: list[RemoteHostCreate]) -> list[models.RemoteHost]:
+    for host in hosts:
+        crud.register_remote_host(db=db, remote_host=host)
+    return db.query(models.RemoteHost).order_by(models.RemoteHost.id).all()
+
+
+def test_get_remote_hosts_pages_by_id(db):
+    register_hosts(db, [make_host(i) for i in range(7)])
+
+    pages = []
+    after = None
+    while True:
+        page = crud.get_remote_hosts(db=db, after=after, limit=3)
+        if not page:
+            break
+        pages.append([host.ip_address for host in page])
+        after = page[-1].id
+
+    assert pages == [
+        ["10.0.0.0", "10.0.0.1", "10.0.0.2"],
+        ["10.0.0.3", "10.0.0.4", "10.0.0.5"],
+        ["10.0.0.6"],
+    ]
+
+
+def test_get_remote_hosts_pages_within_filter(db):
+    register_hosts(db, [make_host(i, "a" if i % 2 else "b") for i in range(6)])
+
+    first = crud.get_remote_hosts(db=db, limit=2, fl_identifier="a")
+    second = crud.get_remote_hosts(
+        db=db, after=first[-1].id, limit=2, fl_identifier="a"
+    )
+
+    assert [host.ip_address for host in first] == ["10.0.0.1", "10.0.0.3"]
+    assert [host.ip_address for host in second] == ["10.0.0.5"]
+
+
+def test_get_remote_hosts_by_docker_state(db):
+    hosts = register_hosts(db, [make_host(i) for i in range(4)])
+    task = DOCKER_INSTALLATION_NAME.state_check_docker_command.value
+    crud.update_remote_host_task_states(
+        db=db,
+        playbook=DOCKER_INSTALLATION_PLAYBOOK,
+        updated_task_states={
+            hosts[0].id: {task: InstallationStatus.ok},
+            hosts[1].id: {task: InstallationStatus.failed},
+            hosts[3].id: {task: InstallationStatus.ok},
+        },
+    )
+
+    page = crud.get_remote_hosts(db=db, limit=1, docker_state=InstallationStatus.ok)
+    next_page = crud.get_remote_hosts(
+        db=db, after=page[-1].id, limit=1, docker_state=InstallationStatus.ok
+    )
+
+    assert [host.id for host in page] == [hosts[0].id]
+    assert [host.id for host in next_page] == [hosts[3].id]
+
+
+def test_empty_federation_is_not_cached(db):
+    crud.host_cache.invalidate()
+    assert (
+        crud.get_cached_remote_hosts_by_fl_identifier(db=db, fl_identifier="new") == []
+    )
+
+    # added without register_remote_host, which would invalidate the lookup itself
+    db.add(models.RemoteHost(ip_address="10.0.0.1", fl_identifier="new"))
+    db.commit()
+
+    hosts = crud.get_cached_remote_hosts_by_fl_identifier(db=db, fl_identifier="new")
+    assert [host.ip_address for host in hosts] == ["10.0.0.1"]
@@ -0,0 +1,57 @@
+import asyncio
+
+from app.internal.utils.events import EventChannel
+
+
+async def collect(channel: EventChannel, offset: int | None) -> list[int]:
+    return [item[0] async for item in channel.subscribe(offset=offset)]
+
+
+def test_replay_from_offset():
+    channel = EventChannel(buffer_size=10, queue_size=10)
+    for n in range(5):
+        channel.publish({"n": n})
+    channel.close()
+
+    assert asyncio.run(collect(channel, 2)) == [2, 3, 4]
+    # without an offset only new messages are yielded, there are none anymore
+    assert asyncio.run(collect(channel, None)) == []
+
+
+def test_replay_skips_messages_left_the_buffer():
+    channel = EventChannel(buffer_size=3, queue_size=10)
+    for n in range(5):
+        channel.publish({"n": n})
+    channel.close()
+
+    assert asyncio.run(collect(channel, 0)) == [2, 3, 4]
+
+
+async def flood(channel: EventChannel, count: int) -> list[int]:
+    """
+    Publish more messages than the queue of the subscriber holds, once it is subscribed.
+    """
+
+    channel.publish({"n": 0})
+    received = []
+    async for offset, _ in channel.subscribe(offset=0):
+        received.append(offset)
+        if offset == 0:
+            for n in range(1, count):
+                channel.publish({"n": n})
+            channel.close()
+    return received
+
+
+def test_lagging_subscriber_catches_up_from_buffer():
+    channel = EventChannel(buffer_size=100, queue_size=2)
+
+    assert asyncio.run(flood(channel, 10)) == list(range(10))
+    assert channel.subscriber_count == 0
+
+
+def test_lagging_subscriber_skips_messages_left_the_buffer():
+    channel = EventChannel(buffer_size=3, queue_size=2)
+
+    # the queue holds 1 and 2, 3 to 6 are dropped and only 7 to 9 are still buffered
+    assert asyncio.run(flood(channel, 10)) == [0, 1, 2, 7, 8, 9]
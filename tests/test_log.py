@@ -0,0 +1,21 @@
+import pytest
+
+from app.internal.utils.log import parse_log_levels
+
+
+def test_parse_log_levels():
+    assert parse_log_levels("sqlalchemy.engine=warning, app.routers.ssh = DEBUG") == {
+        "sqlalchemy.engine": "WARNING",
+        "app.routers.ssh": "DEBUG",
+    }
+
+
+def test_parse_log_levels_skips_empty_pairs():
+    assert parse_log_levels("") == {}
+    assert parse_log_levels("paramiko=ERROR,,") == {"paramiko": "ERROR"}
+
+
+@pytest.mark.parametrize("levels", ["paramiko", "=DEBUG", "paramiko=ERROR,asyncio"])
+def test_parse_log_levels_rejects_malformed_pairs(levels):
+    with pytest.raises(ValueError):
+        parse_log_levels(levels)
@@ -0,0 +1,92 @@
+import os
+import stat
+import subprocess
+
+import paramiko
+import pytest
+
+from app.internal.utils.ssh import SSHConnectionPool, build_authorized_key_script
+from tests.benchmark.standins import StubSSHServer
+
+PASSWORD = "secret"
+
+
+@pytest.fixture
+def ssh_server():
+    server = StubSSHServer(password=PASSWORD).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def pool():
+    pool = SSHConnectionPool(connect_timeout=5)
+    yield pool
+    pool.close_all()
+
+
+def test_pool_reuses_client_for_same_credentials(ssh_server, pool):
+    with pool.connection("127.0.0.1", ssh_server.port, "user", PASSWORD) as client:
+        first = client
+    with pool.connection("127.0.0.1", ssh_server.port, "user", PASSWORD) as client:
+        assert client is first
+
+
+def test_wrong_password_fails_against_warm_pool(ssh_server, pool):
+    with pool.connection("127.0.0.1", ssh_server.port, "user", PASSWORD):
+        pass
+
+    with pytest.raises(paramiko.AuthenticationException):
+        with pool.connection("127.0.0.1", ssh_server.port, "user", "wrong"):
+            pass
+
+
+def run_authorized_key_script(home, script: str) -> str:
+    subprocess.run(
+        ["sh", "-c", script], env={**os.environ, "HOME": str(home)}, check=True
+    )
+    return (home / ".ssh" / "authorized_keys").read_text()
+
+
+def test_authorized_key_script_installs_key_once(tmp_path):
+    script = build_authorized_key_script("ssh-rsa AAAA new\n")
+
+    run_authorized_key_script(tmp_path, script)
+    keys = run_authorized_key_script(tmp_path, script)
+
+    assert keys == "ssh-rsa AAAA new\n"
+    assert stat.S_IMODE((tmp_path / ".ssh").stat().st_mode) == 0o700
+    assert stat.S_IMODE((tmp_path / ".ssh" / "authorized_keys").stat().st_mode) == 0o600
+
+
+def test_authorized_key_script_appends_on_own_line(tmp_path):
+    (tmp_path / ".ssh").mkdir()
+    (tmp_path / ".ssh" / "authorized_keys").write_text("ssh-rsa AAAA other")
+
+    keys = run_authorized_key_script(
+        tmp_path, build_authorized_key_script("ssh-rsa AAAA new")
+    )
+
+    assert keys == "ssh-rsa AAAA other\nssh-rsa AAAA new\n"
+
+
+def test_authorized_key_script_revokes_old_key(tmp_path):
+    (tmp_path / ".ssh").mkdir()
+    (tmp_path / ".ssh" / "authorized_keys").write_text(
+        "ssh-rsa AAAA old\nssh-rsa AAAA other\n"
+    )
+
+    keys = run_authorized_key_script(
+        tmp_path, build_authorized_key_script("ssh-rsa AAAA new", "ssh-rsa AAAA old")
+    )
+
+    assert keys == "ssh-rsa AAAA other\nssh-rsa AAAA new\n"
+
+
+def test_authorized_key_script_quotes_key(tmp_path):
+    keys = run_authorized_key_script(
+        tmp_path, build_authorized_key_script("ssh-rsa AAAA it's; touch pwned")
+    )
+
+    assert keys == "ssh-rsa AAAA it's; touch pwned\n"
+    assert not (tmp_path / "pwned").exists()
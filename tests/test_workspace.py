@@ -0,0 +1,28 @@
+import os
+import time
+
+from app.internal.utils import workspace
+
+
+def make_workspace(runs_dir, run_id: str, age: float, finished: bool) -> None:
+    path = runs_dir / run_id
+    path.mkdir()
+    mtime = time.time() - age
+    if finished:
+        marker = path / workspace.FINISHED_MARKER
+        marker.touch()
+        os.utime(marker, (mtime, mtime))
+    os.utime(path, (mtime, mtime))
+
+
+def test_cleanup_removes_expired_and_abandoned_workspaces(tmp_path, monkeypatch):
+    monkeypatch.setattr(workspace, "ANSIBLE_RUNS_DIR", str(tmp_path))
+    monkeypatch.setattr(workspace, "ANSIBLE_RUN_RETENTION_SECONDS", 100)
+    monkeypatch.setattr(workspace, "ANSIBLE_RUN_MAX_AGE_SECONDS", 1000)
+    make_workspace(tmp_path, "finished-recent", 10, finished=True)
+    make_workspace(tmp_path, "finished-expired", 200, finished=True)
+    make_workspace(tmp_path, "running", 200, finished=False)
+    make_workspace(tmp_path, "abandoned", 2000, finished=False)
+
+    assert workspace.cleanup_run_workspaces() == 2
+    assert sorted(os.listdir(tmp_path)) == ["finished-recent", "running"]